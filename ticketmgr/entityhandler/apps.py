@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class EntityhandlerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'entityhandler'
+
+    def ready(self):
+        from . import cache, counters, roles, signals
@@ -0,0 +1,115 @@
+"""Cache of rendered ``Event`` responses.
+
+Entries hold response bodies that are already serialized and rendered to JSON,
+so cache hits cost no database query, serialization or rendering. Every event
+and the event list has a version, which is part of the keys of its entries.
+Changes to events replace their versions rather than deleting entries, so
+entries of older versions are never read again and simply expire.
+
+Entries are refreshed by a single worker when they expire, while other workers
+keep serving the expired entry, or wait for it when there is none. The cache is
+the ``EVENT_CACHE`` alias, which should be a cache shared by all worker processes
+in production, as versions are only replaced in the cache of the process that
+changed the event otherwise.
+"""
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Event
+from .signals import counters_changed
+
+# Number of seconds after which entries are refreshed.
+CACHE_TIMEOUT = 300
+# Number of seconds that expired entries are kept, and served while one worker
+# refreshes them.
+STALE_TIMEOUT = 60
+# Number of seconds after which a worker that failed to refresh an entry is
+# assumed dead, so another can refresh it.
+LOCK_TIMEOUT = 10
+# Interval and number of polls of workers waiting for an entry being built, in seconds.
+LOCK_POLL_INTERVAL = 0.05
+LOCK_POLLS = 20
+
+LIST_SCOPE = 'list'
+
+def _cache():
+    return caches[getattr(settings, 'EVENT_CACHE', 'default')]
+
+def _version(cache, scope: str) -> str:
+    """Return the current version of scope, which is an event uuid or ``LIST_SCOPE``."""
+    key = f'entityhandler:version:{scope}'
+    version = cache.get(key)
+    if version is None:
+        # Random, so entries of a version that was evicted are never read again
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+def _replace_versions(scopes):
+    _cache().set_many({f'entityhandler:version:{scope}': uuid.uuid4().hex
+                       for scope in scopes}, timeout=None)
+
+def invalidate(scopes):
+    """Replaces the versions of scopes, which are event uuids or ``LIST_SCOPE``."""
+    scopes = list(scopes)
+    _replace_versions(scopes)
+    # Entries built from the database before the change was committed
+    # are of the replaced versions too
+    transaction.on_commit(lambda: _replace_versions(scopes))
+
+def _build(cache, key: str, version: str, build):
+    try:
+        value = build()
+        cache.set(key, (time.time() + CACHE_TIMEOUT, value),
+                  timeout=CACHE_TIMEOUT + STALE_TIMEOUT, version=version)
+    finally:
+        cache.delete(key + ':lock', version=version)
+    return value
+
+def get_or_build(scope: str, name: str, build):
+    """Returns a cached value, building it if needed.
+
+    Args:
+        ``scope`` (``str``): The event uuid or ``LIST_SCOPE`` that the value is
+        derived from.
+        ``name`` (``str``): The name of the value within scope.
+        ``build``: A callable that returns the value. Exceptions it raises
+        are propagated and nothing is cached.
+
+    Returns:
+        The value.
+    """
+    cache = _cache()
+    version = _version(cache, scope)
+    key = f'entityhandler:{scope}:{name}'
+    entry = cache.get(key, version=version)
+    if entry is not None:
+        fresh_until, value = entry
+        if time.time() < fresh_until or not cache.add(key + ':lock', 1, LOCK_TIMEOUT,
+                                                      version=version):
+            return value
+        return _build(cache, key, version, build)
+
+    for _ in range(LOCK_POLLS):
+        if cache.add(key + ':lock', 1, LOCK_TIMEOUT, version=version):
+            return _build(cache, key, version, build)
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key, version=version)
+        if entry is not None:
+            return entry[1]
+    # The worker building the entry is too slow, build it without caching
+    return build()
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def _event_changed(sender, instance, **kwargs):
+    invalidate([instance.uuid, LIST_SCOPE])
+
+@receiver(counters_changed, sender=Event)
+def _event_counters_changed(sender, pks, **kwargs):
+    uuids = list(Event.objects.filter(pk__in=pks).values_list('uuid', flat=True))
+    invalidate(uuids + [LIST_SCOPE])
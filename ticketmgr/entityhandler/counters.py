@@ -0,0 +1,128 @@
+"""Maintains the denormalized counters of ``Event`` and ``TktUser``.
+
+Counters are updated with ``F()`` expressions, so concurrent changes never
+overwrite each other, on every path that adds or removes relationships through
+the ORM: related managers, saves and deletes of the through models and agents,
+cascades, and ``TktAgent`` queryset updates. Raw SQL and queryset updates or
+deletes of ``TktAdmin.events.through`` bypass them; ``manage.py
+reconcile_counters`` repairs any drift.
+"""
+from collections import Counter, defaultdict
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import Event, Registration, TktAdmin, TktAgent, TktUser
+from .signals import counters_changed, registrations_changed
+
+def adjust_counters(model, field: str, deltas: dict):
+    """Adds to a counter field of many objects.
+
+    Also sets ``updated_at`` of the objects, which all counted models have.
+
+    Args:
+        ``model``: The model of the objects.
+        ``field`` (``str``): The name of the counter field.
+        ``deltas`` (``dict``): Maps primary keys to the amounts to add.
+    """
+    # One query per distinct amount rather than per object
+    by_delta = defaultdict(list)
+    for pk, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(pk)
+    now = timezone.now()
+    for delta, pks in by_delta.items():
+        model._base_manager.filter(pk__in=pks).update(**{field: F(field) + delta,
+                                                         'updated_at': now})
+    if by_delta:
+        counters_changed.send(sender=model, pks=[pk for pks in by_delta.values() for pk in pks])
+
+def _count(model, field: str):
+    """Return an expression counting the rows of model whose field references the outer row."""
+    return Coalesce(Subquery(model.objects.filter(**{field: OuterRef('pk')})
+                                          .order_by()
+                                          .values(field)
+                                          .annotate(count=Count('*'))
+                                          .values('count')), 0)
+
+def expected_counts() -> dict:
+    """Return the expressions that compute the counters from the relationships.
+
+    Returns:
+        ``dict``: Maps models to dicts that map their counter fields to expressions.
+    """
+    return {
+        Event: {'user_count': _count(Registration, 'event'),
+                'admin_count': _count(TktAdmin.events.through, 'event'),
+                'agent_count': _count(TktAgent, 'event')},
+        TktUser: {'event_count': _count(Registration, 'tktuser')},
+    }
+
+@receiver(registrations_changed)
+def _registrations_changed(sender, action, pairs, **kwargs):
+    sign = 1 if action == 'add' else -1
+    event_deltas = Counter()
+    user_deltas = Counter()
+    for event_id, tktuser_id in pairs:
+        event_deltas[event_id] += sign
+        user_deltas[tktuser_id] += sign
+    adjust_counters(Event, 'user_count', event_deltas)
+    adjust_counters(TktUser, 'event_count', user_deltas)
+
+@receiver(m2m_changed, sender=TktAdmin.events.through)
+def _admins_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add' and pk_set:
+        if reverse:
+            deltas = {instance.pk: len(pk_set)}
+        else:
+            deltas = {pk: 1 for pk in pk_set}
+    elif action == 'pre_remove' and pk_set:
+        # pk_set holds every given pk, including those that are not related,
+        # so the removed relationships are only known before they are removed
+        if reverse:
+            removed = sender.objects.filter(event_id=instance.pk, tktadmin_id__in=pk_set)
+            instance._removed_admin_deltas = {instance.pk: -removed.count()}
+        else:
+            removed = sender.objects.filter(tktadmin_id=instance.pk, event_id__in=pk_set)
+            instance._removed_admin_deltas = {pk: -1 for pk in
+                                              removed.values_list('event_id', flat=True)}
+        return
+    elif action == 'post_remove':
+        deltas = instance.__dict__.pop('_removed_admin_deltas', None)
+        if not deltas:
+            return
+    elif action == 'pre_clear':
+        # The cleared relationships are only known before they are removed
+        if reverse:
+            deltas = {instance.pk: -instance.tktadmin_set.count()}
+        else:
+            deltas = {pk: -1 for pk in instance.events.values_list('pk', flat=True)}
+    else:
+        return
+    adjust_counters(Event, 'admin_count', deltas)
+
+@receiver(pre_delete, sender=TktAdmin)
+def _admin_deleted(sender, instance, **kwargs):
+    # Rows of auto-created through models are deleted without signals
+    adjust_counters(Event, 'admin_count',
+                    {pk: -1 for pk in instance.events.values_list('pk', flat=True)})
+
+@receiver(pre_save, sender=TktAgent)
+def _agent_saving(sender, instance, raw, **kwargs):
+    if not instance._state.adding:
+        instance._saved_event_id = (TktAgent.objects.filter(pk=instance.pk)
+                                                    .values_list('event_id', flat=True)
+                                                    .first())
+
+@receiver(post_save, sender=TktAgent)
+def _agent_saved(sender, instance, created, **kwargs):
+    previous = instance.__dict__.pop('_saved_event_id', None)
+    if created:
+        adjust_counters(Event, 'agent_count', {instance.event_id: 1})
+    elif previous is not None and previous != instance.event_id:
+        adjust_counters(Event, 'agent_count', {previous: -1, instance.event_id: 1})
+
+@receiver(post_delete, sender=TktAgent)
+def _agent_deleted(sender, instance, **kwargs):
+    adjust_counters(Event, 'agent_count', {instance.event_id: -1})
@@ -0,0 +1,56 @@
+"""Streaming export of event rosters as CSV or NDJSON.
+
+Rows are read through a server-side cursor where the database supports one,
+and encoded and sent in chunks, so memory use does not depend on the size of
+the roster.
+"""
+import csv
+import itertools
+import json
+from .models import Event
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+# Columns of exported users, and the fields they are read from.
+USER_COLUMNS = ('uuid', 'username', 'first_name', 'last_name', 'email')
+USER_FIELDS = ('uuid', 'user__username', 'user__first_name', 'user__last_name', 'user__email')
+# Number of rows fetched from the database and sent to the client at once.
+CHUNK_SIZE = 2000
+
+class _Echo:
+    """File-like object whose ``write()`` returns what is written, so ``csv.writer``
+    can encode rows without buffering them."""
+    def write(self, value):
+        return value
+
+def _encode_csv(rows):
+    writer = csv.writer(_Echo())
+    # Sent before the query runs, so the response starts right away
+    yield writer.writerow(USER_COLUMNS).encode()
+    while chunk := list(itertools.islice(rows, CHUNK_SIZE)):
+        yield ''.join(writer.writerow(row) for row in chunk).encode()
+
+def _encode_ndjson(rows):
+    while chunk := list(itertools.islice(rows, CHUNK_SIZE)):
+        yield ''.join(json.dumps(dict(zip(USER_COLUMNS, row))) + '\n'
+                      for row in chunk).encode()
+
+def export_users(event: Event, format: str):
+    """Returns the encoded roster of an event, in chunks.
+
+    Args:
+        ``event`` (``Event``): The event whose registered ``TktUser``s are exported.
+        ``format`` (``str``): ``'csv'`` or ``'ndjson'``.
+
+    Returns:
+        A generator of ``bytes``, which queries the database once it is first advanced.
+    """
+    rows = (event.tktuser_set.order_by('pk')
+                             .values_list(*USER_FIELDS)
+                             .iterator(chunk_size=CHUNK_SIZE))
+    rows = ((str(row[0]),) + row[1:] for row in rows)
+    if format == 'csv':
+        return _encode_csv(rows)
+    return _encode_ndjson(rows)
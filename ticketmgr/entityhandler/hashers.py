@@ -0,0 +1,14 @@
+"""Password hashers for accounts created by bulk imports.
+"""
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+class ImportPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """PBKDF2 hasher with few iterations, so that hundreds of thousands of imported
+    passwords can be hashed in minutes rather than days.
+
+    It is listed in ``PASSWORD_HASHERS`` after the default hasher. Django therefore
+    rehashes the password of an imported account with the default hasher the first
+    time its user logs in.
+    """
+    algorithm = 'pbkdf2_sha256_import'
+    iterations = 1000
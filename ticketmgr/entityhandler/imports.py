@@ -0,0 +1,147 @@
+"""Streaming bulk import of ``TktUser``s and ``Event``s from CSV or NDJSON.
+
+Rows are validated with the rules of ``UserSerializer`` and ``EventSerializer``
+and written in batches, each in its own transaction. Only one batch is held in
+memory at a time, so sources of any size can be imported.
+
+Imports report their progress after every committed batch as the number of
+source rows consumed so far. After a failure, an import resumes by skipping
+that many rows. Users whose username already exists are skipped rather than
+reported as invalid, so repeating an import of users is also safe.
+"""
+import csv
+import itertools
+import json
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+from rest_framework.validators import UniqueValidator
+from . import cache
+from .hashers import ImportPBKDF2PasswordHasher
+from .models import Event, TktUser
+from .serializers import EventSerializer, UserSerializer
+
+FORMATS = ('csv', 'ndjson')
+KINDS = ('users', 'events')
+# Number of rows written per transaction.
+BATCH_SIZE = 1000
+# Number of invalid rows whose errors are reported, so memory stays bounded.
+MAX_REPORTED_ERRORS = 100
+
+def read_rows(lines, format: str):
+    """Parses rows from a source.
+
+    Args:
+        ``lines``: An iterable of the lines of the source, as ``str`` or ``bytes``.
+        ``format`` (``str``): ``'csv'``, with a header row, or ``'ndjson'``.
+
+    Returns:
+        A generator of the rows as dicts, or ``None`` for malformed rows.
+    """
+    lines = (line.decode('utf-8') if isinstance(line, bytes) else line for line in lines)
+    if format == 'csv':
+        yield from csv.DictReader(lines)
+        return
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield row if isinstance(row, dict) else None
+
+def _validator(serializer_class):
+    """Return a function that validates a row with serializer_class, returning
+    its validated data or raising ``ValidationError``."""
+    serializer = serializer_class()
+    # Uniqueness is checked per batch rather than with one query per row
+    for field in serializer.fields.values():
+        field.validators = [v for v in field.validators if not isinstance(v, UniqueValidator)]
+    return serializer.run_validation
+
+def _create_users(rows: list) -> tuple:
+    """Creates the ``User``s and ``TktUser``s of validated rows whose username does
+    not exist yet. Return the number of created and existing users."""
+    usernames = [row['username'] for row in rows]
+    existing = set(User.objects.filter(username__in=usernames)
+                               .values_list('username', flat=True))
+    users = {}
+    for row in rows:
+        if row['username'] not in existing and row['username'] not in users:
+            users[row['username']] = User(
+                username=row['username'],
+                first_name=row.get('first_name', ''),
+                last_name=row.get('last_name', ''),
+                email=row.get('email', ''),
+                password=make_password(row['password'],
+                                       hasher=ImportPBKDF2PasswordHasher.algorithm))
+    User.objects.bulk_create(users.values())
+    # Primary keys are not returned by bulk_create() on every backend
+    user_ids = User.objects.filter(username__in=users).values_list('pk', flat=True)
+    TktUser.objects.bulk_create([TktUser(user_id=user_id) for user_id in user_ids])
+    return len(users), len(rows) - len(users)
+
+def _create_events(rows: list) -> tuple:
+    """Creates the ``Event``s of validated rows. Return the number of created
+    and existing events."""
+    Event.objects.bulk_create([Event(**row) for row in rows])
+    if rows:
+        # bulk_create() sends no post_save, which cached event lists are invalidated on
+        cache.invalidate([cache.LIST_SCOPE])
+    return len(rows), 0
+
+class BulkImport:
+    """An import of users or events, which can be resumed after a failure.
+
+    Attributes:
+        ``progress``: A dict of the number of ``rows`` consumed by committed batches,
+        including skipped rows, the numbers of ``created``, ``existing`` and
+        ``invalid`` rows, and the ``errors`` of up to ``MAX_REPORTED_ERRORS``
+        invalid rows, keyed by row number.
+    """
+    def __init__(self, kind: str, skip: int = 0, batch_size: int = BATCH_SIZE):
+        """
+        Args:
+            ``kind`` (``str``): ``'users'`` or ``'events'``.
+            ``skip`` (``int``, optional): Number of leading rows to skip, which were
+            committed by a previous import. Defaults to 0.
+            ``batch_size`` (``int``, optional): Number of rows per transaction.
+            Defaults to ``BATCH_SIZE``.
+        """
+        if kind == 'users':
+            self._validate, self._create = _validator(UserSerializer), _create_users
+        else:
+            self._validate, self._create = _validator(EventSerializer), _create_events
+        self.skip = skip
+        self.batch_size = batch_size
+        self.progress = {'rows': skip, 'created': 0, 'existing': 0, 'invalid': 0, 'errors': {}}
+
+    def run(self, rows):
+        """Imports rows, as returned by ``read_rows()``.
+
+        Returns:
+            A generator that yields ``progress`` after every committed batch.
+        """
+        progress = self.progress
+        rows = itertools.islice(rows, self.skip, None)
+        while batch := list(itertools.islice(rows, self.batch_size)):
+            valid = []
+            errors = {}
+            for number, row in enumerate(batch, progress['rows'] + 1):
+                try:
+                    if row is None:
+                        raise ValidationError({'non_field_errors': ['Malformed row.']})
+                    valid.append(self._validate(row))
+                except ValidationError as e:
+                    errors[number] = e.detail
+            with transaction.atomic():
+                created, existing = self._create(valid)
+            progress['rows'] += len(batch)
+            progress['created'] += created
+            progress['existing'] += existing
+            progress['invalid'] += len(errors)
+            for number in itertools.islice(errors, MAX_REPORTED_ERRORS - len(progress['errors'])):
+                progress['errors'][number] = errors[number]
+            yield progress
@@ -0,0 +1,79 @@
+"""Imports users or events from a CSV or NDJSON file, see ``entityhandler.imports``.
+
+With ``--checkpoint``, the number of committed rows is saved after every batch,
+and an import interrupted by a failure resumes from there when run again::
+
+    python manage.py import_entities users attendees.csv --checkpoint attendees.ckpt
+"""
+
+import json
+import os
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from entityhandler import imports
+
+def _read_checkpoint(path: str) -> int:
+    """Return the number of rows committed according to the checkpoint at path."""
+    try:
+        with open(path) as f:
+            return json.load(f)['rows']
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError, KeyError) as e:
+        raise CommandError(f'Could not read checkpoint {path}: {e}')
+
+def _write_checkpoint(path: str, rows: int):
+    # Replaced atomically, so a crash never leaves a partial checkpoint
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'rows': rows}, f)
+    os.replace(path + '.tmp', path)
+
+class Command(BaseCommand):
+    help = ('Imports users or events from a CSV or NDJSON file in batched '
+            'transactions, and can resume an interrupted import.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=imports.KINDS)
+        parser.add_argument('path', help='File to import, or - for standard input.')
+        parser.add_argument('--format', choices=imports.FORMATS,
+                            help='Format of the file. Defaults to its extension.')
+        parser.add_argument('--batch-size', type=int, default=imports.BATCH_SIZE,
+                            help='Number of rows per transaction.')
+        parser.add_argument('--checkpoint',
+                            help='File that progress is saved to and resumed from.')
+        parser.add_argument('--skip', type=int, default=0,
+                            help='Number of leading rows to skip.')
+
+    def handle(self, *args, **options):
+        format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if format not in imports.FORMATS:
+            raise CommandError('Could not infer the format of the file, use --format')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        checkpoint = options['checkpoint']
+        skip = options['skip']
+        if checkpoint:
+            skip = max(skip, _read_checkpoint(checkpoint))
+            if skip:
+                self.stdout.write(f'Resuming after row {skip}')
+
+        job = imports.BulkImport(options['kind'], skip, options['batch_size'])
+        if options['path'] == '-':
+            f = sys.stdin
+        else:
+            f = open(options['path'], newline='', encoding='utf-8')
+        try:
+            for progress in job.run(imports.read_rows(f, format)):
+                if checkpoint:
+                    _write_checkpoint(checkpoint, progress['rows'])
+                if options['verbosity'] > 1:
+                    self.stdout.write(f"{progress['rows']} rows committed")
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        progress = job.progress
+        for number, errors in progress['errors'].items():
+            self.stderr.write(f'Row {number}: {json.dumps(errors)}')
+        self.stdout.write(f"{progress['rows']} rows: {progress['created']} created, "
+                          f"{progress['existing']} existing, {progress['invalid']} invalid")
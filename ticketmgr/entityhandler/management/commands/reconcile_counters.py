@@ -0,0 +1,60 @@
+"""Recomputes the denormalized counters of ``Event`` and ``TktUser`` from their
+relationships and repairs those that drifted.
+
+Rows are processed in batches, each locked and updated in its own transaction,
+so the command can run against a live database.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from entityhandler.counters import expected_counts
+from entityhandler.signals import counters_changed
+
+class Command(BaseCommand):
+    help = 'Recomputes the attendance counters of events and users and repairs drifted ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of rows recomputed per transaction.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        for model, counters in expected_counts().items():
+            checked, repaired = self._reconcile(model, counters, options['batch_size'])
+            self.stdout.write(f'{model.__name__}: {checked} checked, {repaired} repaired')
+
+    def _reconcile(self, model, counters: dict, batch_size: int) -> tuple:
+        """Return the number of checked and repaired rows of model."""
+        expected = {f'expected_{field}': expression for field, expression in counters.items()}
+        checked = repaired = 0
+        last_pk = 0
+        while True:
+            with transaction.atomic():
+                batch = list(model.objects.select_for_update()
+                                          .filter(pk__gt=last_pk)
+                                          .order_by('pk')
+                                          .only('pk', *counters)
+                                          .annotate(**expected)[:batch_size])
+                if not batch:
+                    break
+                drifted = []
+                now = timezone.now()
+                for obj in batch:
+                    changed = False
+                    for field in counters:
+                        value = getattr(obj, f'expected_{field}')
+                        if getattr(obj, field) != value:
+                            setattr(obj, field, value)
+                            changed = True
+                    if changed:
+                        obj.updated_at = now
+                        drifted.append(obj)
+                model.objects.bulk_update(drifted, [*counters, 'updated_at'])
+                if drifted:
+                    counters_changed.send(sender=model, pks=[obj.pk for obj in drifted])
+            checked += len(batch)
+            repaired += len(drifted)
+            last_pk = batch[-1].pk
+        return checked, repaired
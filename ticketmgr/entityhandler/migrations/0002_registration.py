@@ -0,0 +1,45 @@
+# Replaces the implicit TktUser.events M2M table with the explicit Registration
+# model. The existing table and its rows are reused as-is.
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entityhandler', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='Registration',
+                    fields=[
+                        ('id', models.AutoField(primary_key=True, serialize=False)),
+                        ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='entityhandler.event')),
+                        ('tktuser', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='entityhandler.tktuser')),
+                    ],
+                    options={
+                        'db_table': 'entityhandler_tktuser_events',
+                        'unique_together': {('tktuser', 'event')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='tktuser',
+                    name='events',
+                    field=models.ManyToManyField(blank=True, through='entityhandler.Registration', to='entityhandler.event'),
+                ),
+            ],
+        ),
+        migrations.AlterModelTable(
+            name='registration',
+            table=None,
+        ),
+        migrations.AddField(
+            model_name='registration',
+            name='secret',
+            field=models.BinaryField(null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generates ticket secrets for registrations that existed before 0002.
+# Runs outside of a single transaction so that each batch is committed separately.
+
+import os
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+# otphandler.services.SECRET_LENGTH at the time of writing
+SECRET_LENGTH = 20
+
+
+def generate_secrets(apps, schema_editor):
+    Registration = apps.get_model('entityhandler', 'Registration')
+    db = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        with transaction.atomic(using=db):
+            batch = list(Registration.objects.using(db)
+                                             .filter(pk__gt=last_pk, secret__isnull=True)
+                                             .order_by('pk')
+                                             .only('pk')[:BATCH_SIZE])
+            if not batch:
+                break
+            for registration in batch:
+                registration.secret = os.urandom(SECRET_LENGTH)
+            Registration.objects.using(db).bulk_update(batch, ['secret'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('entityhandler', '0002_registration'),
+    ]
+
+    operations = [
+        migrations.RunPython(generate_secrets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+import os
+
+from django.db import migrations, models
+import entityhandler.models
+
+BATCH_SIZE = 1000
+# otphandler.services.SECRET_LENGTH at the time of writing
+SECRET_LENGTH = 20
+
+
+def generate_secrets(apps, schema_editor):
+    # Registrations created without a secret since 0003 ran. The default of
+    # the AlterField below is evaluated once, which would give them all the
+    # same secret, so each is given its own before the column is NOT NULL
+    Registration = apps.get_model('entityhandler', 'Registration')
+    db = schema_editor.connection.alias
+    last_pk = 0
+    while batch := list(Registration.objects.using(db)
+                                            .filter(pk__gt=last_pk, secret__isnull=True)
+                                            .order_by('pk')
+                                            .only('pk')[:BATCH_SIZE]):
+        for registration in batch:
+            registration.secret = os.urandom(SECRET_LENGTH)
+        Registration.objects.using(db).bulk_update(batch, ['secret'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entityhandler', '0003_registration_secret_data'),
+    ]
+
+    operations = [
+        migrations.RunPython(generate_secrets, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='registration',
+            name='secret',
+            field=models.BinaryField(default=entityhandler.models._registration_secret),
+        ),
+        migrations.AddConstraint(
+            model_name='registration',
+            constraint=models.UniqueConstraint(fields=('event', 'tktuser'), name='entityhandler_registration_event_tktuser_uniq'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='registration',
+            unique_together=set(),
+        ),
+    ]
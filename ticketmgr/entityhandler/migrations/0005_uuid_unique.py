@@ -0,0 +1,54 @@
+# Makes Event.uuid and TktUser.uuid unique, which also indexes them.
+# On PostgreSQL the indexes are built concurrently so that the tables stay
+# writable, which cannot be done inside of a transaction.
+
+from django.db import migrations, models
+import uuid
+
+INDEXES = [
+    ('entityhandler_event_uuid_uniq', 'entityhandler_event'),
+    ('entityhandler_tktuser_uuid_uniq', 'entityhandler_tktuser'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    concurrently = 'CONCURRENTLY ' if schema_editor.connection.vendor == 'postgresql' else ''
+    quote = schema_editor.quote_name
+    for name, table in INDEXES:
+        schema_editor.execute('CREATE UNIQUE INDEX %s%s ON %s (%s)'
+                              % (concurrently, quote(name), quote(table), quote('uuid')))
+
+
+def drop_indexes(apps, schema_editor):
+    concurrently = 'CONCURRENTLY ' if schema_editor.connection.vendor == 'postgresql' else ''
+    for name, _ in INDEXES:
+        schema_editor.execute('DROP INDEX %s%s' % (concurrently, schema_editor.quote_name(name)))
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('entityhandler', '0004_registration_constraints'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='event',
+                    name='uuid',
+                    field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+                ),
+                migrations.AlterField(
+                    model_name='tktuser',
+                    name='uuid',
+                    field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(create_indexes, drop_indexes),
+            ],
+        ),
+    ]
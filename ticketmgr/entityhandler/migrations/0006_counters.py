@@ -0,0 +1,63 @@
+# Generated by Django 4.1.3 on 2026-10-18 10:16
+# Adds the denormalized counters of Event and TktUser and computes their initial values.
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def _count(model, field):
+    """Return an expression counting the rows of model whose field references the outer row."""
+    return Coalesce(Subquery(model.objects.filter(**{field: OuterRef('pk')})
+                                          .order_by()
+                                          .values(field)
+                                          .annotate(count=Count('*'))
+                                          .values('count')), 0)
+
+
+def populate_counters(apps, schema_editor):
+    Event = apps.get_model('entityhandler', 'Event')
+    TktUser = apps.get_model('entityhandler', 'TktUser')
+    TktAdmin = apps.get_model('entityhandler', 'TktAdmin')
+    TktAgent = apps.get_model('entityhandler', 'TktAgent')
+    Registration = apps.get_model('entityhandler', 'Registration')
+    db = schema_editor.connection.alias
+    Event.objects.using(db).update(user_count=_count(Registration, 'event'),
+                                   admin_count=_count(TktAdmin.events.through, 'event'),
+                                   agent_count=_count(TktAgent, 'event'))
+    TktUser.objects.using(db).update(event_count=_count(Registration, 'tktuser'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entityhandler', '0005_uuid_unique'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='tktagent',
+            options={'base_manager_name': 'objects'},
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='admin_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='agent_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='user_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='tktuser',
+            name='event_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -1,22 +1,51 @@
 """Module that contains Django Models representing events and users.
 """
 import uuid
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count
+from django.db.models.expressions import BaseExpression, Combinable
 from django.contrib.auth.models import User
 
-class Event(models.Model):
+class _CountedModel:
+    """Mixin of models whose ``counter_fields`` are maintained in bulk by
+    ``entityhandler.counters``. The counters of instances may be stale, so
+    saves of existing rows do not write them unless listed in ``update_fields``.
+    """
+    counter_fields = ()
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if not self._state.adding and not force_insert and update_fields is None:
+            update_fields = [field.name for field in self._meta.concrete_fields
+                             if not field.primary_key and field.name not in self.counter_fields]
+        super().save(force_insert=force_insert, force_update=force_update,
+                     using=using, update_fields=update_fields)
+
+class Event(_CountedModel, models.Model):
     """Django Model that represents an event.
 
     Attributes:
         ``title``: A ``TextField`` that contains the event name.
         ``description``: A ``TextField`` that contains the event description.
         ``date``: A ``DateTimefield`` that contains the starting date and time of the event.
-        ``uuid``: A ``UUIDField`` that contains the v4 UUID of the event.
+        ``uuid``: A unique ``UUIDField`` that contains the v4 UUID of the event.
+        ``user_count``: The number of ``TktUser``s registered to the event.
+        ``admin_count``: The number of ``TktAdmin``s of the event.
+        ``agent_count``: The number of ``TktAgent``s assigned to the event.
+        ``updated_at``: A ``DateTimeField`` that contains the time of the latest
+        change to the event or its counters.
+
+    The counters are maintained by ``entityhandler.counters``.
     """
     title = models.TextField()
     description = models.TextField()
     datetime = models.DateTimeField()
-    uuid = models.UUIDField(default=uuid.uuid4, editable=False)
+    uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    user_count = models.IntegerField(default=0, editable=False)
+    admin_count = models.IntegerField(default=0, editable=False)
+    agent_count = models.IntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    counter_fields = ('user_count', 'admin_count', 'agent_count')
 
     def user_is_registered(self, user: 'TktUser') -> bool:
         """Checks if a user is registered for an event.
@@ -44,13 +73,20 @@ class Event(models.Model):
         """
         return agent.event.pk == self.pk
 
-class TktUser(models.Model):
+class TktUser(_CountedModel, models.Model):
     """Django model that represents a typical user.
     A user cannot create, modify, and register for events.
+    ``event_count`` is the number of events the user is registered to, maintained
+    by ``entityhandler.counters``, and ``updated_at`` the time of the latest change
+    to the user, its ``User`` or its registrations.
     """
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    events = models.ManyToManyField(Event, blank=True)
-    uuid = models.UUIDField(default=uuid.uuid4, editable=False)
+    events = models.ManyToManyField(Event, through='Registration', blank=True)
+    uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    event_count = models.IntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    counter_fields = ('event_count',)
 
     def registered_to_event(self, event: Event) -> bool:
         """Checks if an event contains a user in its roster.
@@ -64,6 +100,60 @@ class TktUser(models.Model):
         """
         return self.events.filter(pk=event.pk).exists()
 
+def _registration_secret() -> bytes:
+    """Return a new pseudo-random ticket secret for a ``Registration``."""
+    # Imported here as otphandler.services depends on this module
+    from otphandler.services import SECRET_LENGTH, _generate_secret
+    return _generate_secret(SECRET_LENGTH)
+
+class RegistrationQuerySet(models.QuerySet):
+    def delete(self):
+        """Deletes the registrations, sending a single ``registrations_changed``
+        for all of them. Related managers remove and clear registrations through
+        this method.
+        """
+        # Imported here as entityhandler.signals depends on this module
+        from .signals import registrations_changed
+        with transaction.atomic(using=self.db):
+            # Locked, so that rows deleted concurrently are not reported twice
+            pairs = list(self.select_for_update().values_list('event_id', 'tktuser_id'))
+            deleted = super().delete()
+            if pairs:
+                registrations_changed.send(sender=self.model, action='remove', pairs=pairs)
+        return deleted
+
+class Registration(models.Model):
+    """Django model that represents the registration of a ``TktUser`` to an ``Event``.
+
+    Attributes:
+        ``event``: A ``ForeignKey`` to the ``Event`` that the user is registered to.
+        ``tktuser``: A ``ForeignKey`` to the registered ``TktUser``.
+        ``secret``: A ``BinaryField`` that contains the pseudo-random ticket secret.
+    """
+    # Kept from the implicit M2M table that this model replaced
+    id = models.AutoField(primary_key=True)
+    event = models.ForeignKey(Event, on_delete=models.CASCADE)
+    tktuser = models.ForeignKey(TktUser, on_delete=models.CASCADE)
+    secret = models.BinaryField(default=_registration_secret)
+
+    objects = RegistrationQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['event', 'tktuser'],
+                                    name='entityhandler_registration_event_tktuser_uniq'),
+        ]
+
+    def delete(self, *args, **kwargs):
+        # Imported here as entityhandler.signals depends on this module
+        from .signals import registrations_changed
+        with transaction.atomic(using=kwargs.get('using')):
+            deleted = super().delete(*args, **kwargs)
+            if deleted[0]:
+                registrations_changed.send(sender=Registration, action='remove',
+                                           pairs=[(self.event_id, self.tktuser_id)])
+        return deleted
+
 class TktAdmin(models.Model):
     """Django model that represents event administrators.
     An admin can create, modify, and register users and agents for events.
@@ -71,6 +161,27 @@ class TktAdmin(models.Model):
     admin = models.OneToOneField(User, on_delete=models.CASCADE)
     events = models.ManyToManyField(Event, blank=True)
 
+class TktAgentQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        """Updates the agents, keeping ``Event.agent_count`` in step when they are
+        reassigned. Reverse relation managers (``event.tktagent_set.add()``)
+        reassign agents through this method.
+        """
+        event = kwargs.get('event', kwargs.get('event_id'))
+        if event is None or isinstance(event, (BaseExpression, Combinable)):
+            return super().update(**kwargs)
+        # Imported here as entityhandler.counters depends on this module
+        from .counters import adjust_counters
+        with transaction.atomic(using=self.db):
+            previous = (self.order_by().values_list('event_id')
+                            .annotate(count=Count('pk')))
+            deltas = {event_id: -count for event_id, count in previous}
+            rows = super().update(**kwargs)
+            event_id = getattr(event, 'pk', event)
+            deltas[event_id] = deltas.get(event_id, 0) + rows
+            adjust_counters(Event, 'agent_count', deltas)
+        return rows
+
 class TktAgent(models.Model):
     # TODO: Consider allowing event to be blank on init but write-once
     """Django model that represents event agents.
@@ -78,3 +189,9 @@ class TktAgent(models.Model):
     """
     agent = models.OneToOneField(User, on_delete=models.CASCADE)
     event = models.ForeignKey(Event, on_delete=models.CASCADE, blank=False)
+
+    objects = TktAgentQuerySet.as_manager()
+
+    class Meta:
+        # Related managers update through the base manager
+        base_manager_name = 'objects'
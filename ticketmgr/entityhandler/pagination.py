@@ -0,0 +1,55 @@
+"""Keyset pagination for list endpoints.
+"""
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+class KeysetPagination(CursorPagination):
+    """Cursor pagination ordered by primary key.
+
+    Pages are fetched with ``WHERE pk > <cursor> ORDER BY pk LIMIT <page size>``,
+    so every page costs the same as the first, and rows inserted while a client
+    pages through a list never shift or repeat entries. Cursors are opaque.
+
+    Responses keep the plain list body of unpaginated endpoints. Links to the
+    neighboring pages are sent in the ``Link`` header (RFC 8288).
+    The page size defaults to the ``PAGE_SIZE`` DRF setting and can be requested
+    with the ``page_size`` query parameter, up to the ``MAX_PAGE_SIZE`` setting.
+    """
+    ordering = 'pk'
+    page_size_query_param = 'page_size'
+
+    @property
+    def max_page_size(self) -> int:
+        return settings.MAX_PAGE_SIZE
+
+    def get_paginated_response(self, data):
+        links = [f'<{url}>; rel="{rel}"'
+                 for url, rel in ((self.get_next_link(), 'next'),
+                                  (self.get_previous_link(), 'prev'))
+                 if url is not None]
+        headers = {'Link': ', '.join(links)} if links else None
+        return Response(data, headers=headers)
+
+def paginated_response(request, queryset, serializer_class):
+    """Returns a response containing a page of a queryset.
+
+    Args:
+        ``request`` (``Request``): The request, which may contain ``cursor``
+        and ``page_size`` query parameters, and a ``fields`` query parameter
+        restricting the serialized fields if serializer_class supports it.
+        ``queryset`` (``QuerySet``): The queryset to paginate.
+        ``serializer_class``: The serializer of the objects of the queryset.
+
+    Returns:
+        ``Response``: The serialized page, with links to the neighboring pages.
+    """
+    kwargs = {}
+    if hasattr(serializer_class, 'parse_fields'):
+        fields = serializer_class.parse_fields(request.query_params.get('fields'))
+        if fields is not None:
+            queryset = serializer_class.prune_queryset(queryset, fields)
+            kwargs['fields'] = fields
+    paginator = KeysetPagination()
+    page = paginator.paginate_queryset(queryset, request)
+    return paginator.get_paginated_response(serializer_class(page, many=True, **kwargs).data)
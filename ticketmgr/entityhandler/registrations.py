@@ -0,0 +1,118 @@
+"""Bulk registration of ``TktUser``s to ``Event``s.
+"""
+import itertools
+import uuid
+from django.db import transaction
+from .models import Event, Registration, TktUser
+from .signals import registrations_changed
+
+# Number of user uuids resolved and registered per query.
+CHUNK_SIZE = 1000
+
+def _parse_uuid(value):
+    """Return value as a ``UUID``, or ``None`` if it is not a valid UUID string."""
+    try:
+        return uuid.UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+class PartialRegistrationError(ValueError):
+    """Raised when reading the user uuids of ``register_users()`` fails with a
+    ``ValueError``, such as a malformed stream. ``result`` holds the outcome of
+    the uuids read before, which were registered.
+    """
+    def __init__(self, result: dict):
+        super().__init__('Reading user uuids failed after ' + str(result['registered'])
+                         + ' users were registered.')
+        self.result = result
+
+def register_users(event: Event, user_uuids) -> dict:
+    """Registers many ``TktUser``s to an ``Event``.
+
+    User uuids are consumed in chunks of ``CHUNK_SIZE``, so ``user_uuids`` can
+    be a stream of any length. Each chunk is registered in its own transaction,
+    so that streams do not hold locks for as long as they are read, and costs
+    one query to resolve the users, one to find their existing registrations,
+    one to insert the new ones and one to find which of them were not inserted
+    concurrently first.
+
+    Args:
+        ``event`` (``Event``): The event to register the users to.
+        ``user_uuids``: An iterable of the uuid strings of the users.
+
+    Returns:
+        ``dict``: ``registered``, the number of users that were registered,
+        ``already_registered``, the uuids of users that were registered before,
+        and ``unknown``, the items of ``user_uuids`` that are not the uuid of a user.
+        Every item belongs to exactly one outcome, in the order of ``user_uuids``.
+
+    Raises:
+        ``PartialRegistrationError``: If iterating ``user_uuids`` raises a
+        ``ValueError``. The items before it are registered all the same.
+    """
+    registered = 0
+    already_registered = []
+    unknown = []
+    # Users registered by this call, so that repeated uuids are reported once
+    seen = set()
+    user_uuids = iter(user_uuids)
+
+    while True:
+        chunk = []
+        error = None
+        try:
+            chunk.extend(itertools.islice(user_uuids, CHUNK_SIZE))
+        except ValueError as e:
+            error = e
+        if chunk:
+            with transaction.atomic():
+                parsed = [_parse_uuid(value) for value in chunk]
+                users = dict(TktUser.objects.filter(uuid__in=[u for u in parsed if u is not None])
+                                            .values_list('uuid', 'pk'))
+                existing = set(Registration.objects.filter(event=event,
+                                                           tktuser_id__in=users.values())
+                                                   .values_list('tktuser_id', flat=True))
+                new = {}
+                # The user uuid and pk of each registration to report, and whether
+                # it was first seen there, in the order of chunk
+                outcomes = []
+                for value, user_uuid in zip(chunk, parsed):
+                    user_id = users.get(user_uuid)
+                    if user_id is None:
+                        unknown.append(value)
+                        continue
+                    is_new = user_id not in existing and user_id not in seen
+                    if is_new:
+                        seen.add(user_id)
+                        new[user_id] = Registration(event=event, tktuser_id=user_id)
+                    outcomes.append((user_uuid, user_id, is_new))
+                inserted = set()
+                if new:
+                    # Rows inserted concurrently since the lookup above are skipped,
+                    # like related managers do
+                    Registration.objects.bulk_create(new.values(), ignore_conflicts=True)
+                    # Which rows were skipped is not returned, but their secrets
+                    # are not the ones of the registrations built above
+                    inserted = {user_id for user_id, secret
+                                in Registration.objects.filter(event=event, tktuser_id__in=new)
+                                                       .values_list('tktuser_id', 'secret')
+                                if bytes(secret) == new[user_id].secret}
+                if inserted:
+                    # bulk_create() sends no model signals
+                    registrations_changed.send(sender=Registration, action='add',
+                                               pairs=[(event.pk, user_id) for user_id in new
+                                                      if user_id in inserted])
+                    registered += len(inserted)
+                for user_uuid, user_id, is_new in outcomes:
+                    if not (is_new and user_id in inserted):
+                        already_registered.append(str(user_uuid))
+        if error is not None:
+            raise PartialRegistrationError({'registered': registered,
+                                            'already_registered': already_registered,
+                                            'unknown': unknown}) from error
+        if not chunk:
+            break
+
+    return {'registered': registered,
+            'already_registered': already_registered,
+            'unknown': unknown}
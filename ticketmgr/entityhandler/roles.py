@@ -0,0 +1,138 @@
+"""Resolution of the role of the client of a request.
+
+The role of a ``User`` is given by which of ``TktUser``, ``TktAgent`` and
+``TktAdmin`` references it, which takes a query per reverse relation to find
+out. Roles are instead resolved with a single query when users log in, and kept
+in their session. As sessions are stored in signed cookies, most requests learn
+the role of their client without any query.
+
+Every user has a role version in the ``ROLE_CACHE`` cache, which is stored in
+the session along with the role. Creating or deleting a profile replaces the
+version, so the roles stored in sessions are resolved again on their next use, as
+are those whose version was evicted. The cache must be shared by all worker
+processes in production, as versions are only replaced in the cache of the
+process that changed the profile otherwise, which settings enforce when DEBUG is off.
+"""
+import uuid
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import TktAdmin, TktAgent, TktUser
+
+USER = 'user'
+AGENT = 'agent'
+ADMIN = 'admin'
+SUPERUSER = 'superuser'
+
+SESSION_KEY = '_tkt_role'
+SESSION_VERSION_KEY = '_tkt_role_version'
+
+# Profile models of each role.
+PROFILES = {USER: TktUser, AGENT: TktAgent, ADMIN: TktAdmin}
+
+def _cache():
+    return caches[getattr(settings, 'ROLE_CACHE', 'default')]
+
+def _version_key(user_id: int) -> str:
+    return f'entityhandler:role:{user_id}'
+
+def resolve_role(user: User) -> str:
+    """Queries the role of a user.
+
+    Args:
+        ``user`` (``User``): The user whose role is resolved.
+
+    Returns:
+        ``str``: ``USER``, ``AGENT`` or ``ADMIN`` if the user is referenced by a
+        ``TktUser``, ``TktAgent`` or ``TktAdmin``, checked in that order.
+        Otherwise ``SUPERUSER`` for superusers, and ``None`` for other users.
+    """
+    profiles = (User.objects.filter(pk=user.pk)
+                            .values_list('tktuser', 'tktagent', 'tktadmin')
+                            .first())
+    for role, profile in zip((USER, AGENT, ADMIN), profiles or ()):
+        if profile is not None:
+            return role
+    return SUPERUSER if user.is_superuser else None
+
+def _store_role(request, user: User) -> str:
+    """Resolve the role of user and store it in the session of request, with
+    the current role version of user. Return the role."""
+    key = _version_key(user.pk)
+    cache = _cache()
+    # Read before resolving, so that roles changed meanwhile are resolved again
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    role = resolve_role(user)
+    request.session[SESSION_KEY] = role
+    request.session[SESSION_VERSION_KEY] = version
+    request._tkt_role = role
+    return role
+
+def get_role(request) -> str:
+    """Returns the role of the client of a request, as returned by ``resolve_role()``.
+    The role is read from the session, and only resolved again if the profiles
+    of the client changed since it was stored. Anonymous clients have no role.
+    """
+    # Memoized on the Django request, which DRF requests wrap
+    request = getattr(request, '_request', request)
+    if not hasattr(request, '_tkt_role'):
+        if not request.user.is_authenticated:
+            request._tkt_role = None
+        elif (SESSION_KEY in request.session
+                and request.session.get(SESSION_VERSION_KEY) is not None
+                and request.session[SESSION_VERSION_KEY]
+                    == _cache().get(_version_key(request.user.pk))):
+            request._tkt_role = request.session[SESSION_KEY]
+        else:
+            _store_role(request, request.user)
+    return request._tkt_role
+
+def get_profile(request, role: str):
+    """Returns the ``TktUser``, ``TktAgent`` or ``TktAdmin`` of the client of a
+    request if its role is role, or ``None`` otherwise, including if the profile
+    was deleted since the role was resolved.
+    """
+    if get_role(request) != role:
+        return None
+    model = PROFILES[role]
+    try:
+        return getattr(request.user, model._meta.model_name)
+    except model.DoesNotExist:
+        return None
+
+@receiver(user_logged_in)
+def _user_logged_in(sender, request, user, **kwargs):
+    # login() flushes the session of other users, so it never holds their role
+    _store_role(getattr(request, '_request', request), user)
+
+def _replace_version(user_id: int):
+    key = _version_key(user_id)
+    cache = _cache()
+    cache.delete(key)
+    # Roles resolved before the change was committed are of the replaced version too
+    transaction.on_commit(lambda: cache.delete(key))
+
+@receiver(post_save, sender=TktUser)
+@receiver(post_delete, sender=TktUser)
+def _user_changed(sender, instance, **kwargs):
+    if kwargs.get('created', True):
+        _replace_version(instance.user_id)
+
+@receiver(post_save, sender=TktAgent)
+@receiver(post_delete, sender=TktAgent)
+def _agent_changed(sender, instance, **kwargs):
+    if kwargs.get('created', True):
+        _replace_version(instance.agent_id)
+
+@receiver(post_save, sender=TktAdmin)
+@receiver(post_delete, sender=TktAdmin)
+def _admin_changed(sender, instance, **kwargs):
+    if kwargs.get('created', True):
+        _replace_version(instance.admin_id)
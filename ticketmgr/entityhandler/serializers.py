@@ -1,8 +1,72 @@
 """Django REST Framework serializers for ``entityhandler`` models.
 """
 from .models import *
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db.models import Count
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.exceptions import ParseError
+
+class SparseFieldsMixin:
+    """Mixin of serializers whose output can be restricted to some of their fields,
+    given with the ``fields`` keyword argument, and whose querysets can be restricted
+    to the columns that those fields are read from.
+    """
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def parse_fields(cls, value: str) -> list:
+        """Parses the value of a ``fields`` query parameter.
+
+        Args:
+            ``value`` (``str``): Comma separated names of readable fields, or ``None``.
+
+        Returns:
+            ``list``: The field names, or ``None`` for all fields if value is
+            ``None`` or empty.
+
+        Raises:
+            ``ParseError``: If any field is unknown or write-only.
+        """
+        fields = [name.strip() for name in (value or '').split(',') if name.strip()]
+        if not fields:
+            return None
+        readable = {name for name, field in cls().fields.items() if not field.write_only}
+        unknown = [name for name in fields if name not in readable]
+        if unknown:
+            raise ParseError(f'Unknown fields: {", ".join(unknown)}.')
+        return fields
+
+    @classmethod
+    def prune_queryset(cls, queryset, fields: list):
+        """Returns ``queryset`` loading only the columns that fields are read from,
+        and only joining the relations of nested serializers among fields.
+        Primary keys and annotations are always loaded.
+        """
+        serializer = cls()
+        concrete = {f.name for f in queryset.model._meta.concrete_fields}
+        loaded = []
+        related = []
+        for name in fields:
+            field = serializer.fields[name]
+            if isinstance(field, serializers.BaseSerializer):
+                related.append(field.source)
+                loaded.append(field.source)
+                loaded += [f'{field.source}__{nested.source}'
+                           for nested in field.fields.values() if not nested.write_only]
+            elif field.source in concrete:
+                loaded.append(field.source)
+        # Deferred relations can not be joined
+        if queryset.query.select_related:
+            queryset = queryset.select_related(None)
+            if related:
+                queryset = queryset.select_related(*related)
+        return queryset.only(*loaded)
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -15,22 +79,25 @@ class UserSerializer(serializers.ModelSerializer):
             'password': {'write_only': True}
         }
 
-class TktUserSerializer(serializers.ModelSerializer):
+class TktUserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """DRF serializer for ``entityhandler.models.TktUser``.
     """
     user = UserSerializer(read_only=True)
-    event_count = serializers.SerializerMethodField()
 
     class Meta:
         model = TktUser
         fields = ['user', 'uuid', 'event_count']
         read_only_fields = ['user', 'uuid', 'event_count']
         depth = 1
-    
-    def get_event_count(self, obj):
-        return obj.events.count()
 
-class TktAdminSerializer(serializers.ModelSerializer):
+    @staticmethod
+    def prepare_queryset(queryset):
+        """Returns ``queryset`` with the related ``User`` joined, so that its
+        objects are serialized without further queries.
+        """
+        return queryset.select_related('user')
+
+class TktAdminSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """DRF serializer for ``entityhandler.models.TktAdmin``.
     """
     admin = UserSerializer(read_only=True)
@@ -42,10 +109,21 @@ class TktAdminSerializer(serializers.ModelSerializer):
         read_only_fields = ['admin', 'event_count']
         depth = 1
 
+    @staticmethod
+    def prepare_queryset(queryset):
+        """Returns ``queryset`` with the related ``User`` joined and ``event_count``
+        annotated, so that its objects are serialized without further queries.
+        Must be applied before filtering on ``events``, which would otherwise
+        restrict the count to the filtered events.
+        """
+        return queryset.select_related('admin').annotate(event_count=Count('events'))
+
     def get_event_count(self, obj):
+        if hasattr(obj, 'event_count'):
+            return obj.event_count
         return obj.events.count()
 
-class TktAgentSerializer(serializers.ModelSerializer):
+class TktAgentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """DRF serializer for ``entityhandler.models.TktAgent``.
     """
     agent = UserSerializer()
@@ -56,10 +134,86 @@ class TktAgentSerializer(serializers.ModelSerializer):
         read_only_fields = ['agent']
         depth = 1
 
-class EventSerializer(serializers.ModelSerializer):
+class EventSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """DRF serializer for ``entityhandler.models.Event``.
     """
     class Meta:
         model = Event
-        fields = ['title', 'description', 'datetime', 'uuid']
-        read_only_fields = ['uuid']
+        fields = ['title', 'description', 'datetime', 'uuid',
+                  'user_count', 'admin_count', 'agent_count']
+        read_only_fields = ['uuid', 'user_count', 'admin_count', 'agent_count']
+
+class ValuesSerializer(serializers.BaseSerializer):
+    """Base of read-only serializers of lists, which build the output of a
+    ``ModelSerializer`` straight from ``values()`` rows, without the per-field
+    machinery of DRF serializers. ``UUID``s and ``datetime``s are left for the
+    renderer to encode.
+
+    Subclasses map the fields of the output to the ``values()`` lookups that they
+    are read from with ``columns``, in output order. Fields mapped to dicts of
+    lookups are nested objects.
+    """
+    columns = {}
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            self.columns = {name: source for name, source in self.columns.items()
+                            if name in fields}
+
+    @classmethod
+    def parse_fields(cls, value: str) -> list:
+        """Parses the value of a ``fields`` query parameter, see
+        ``SparseFieldsMixin.parse_fields()``. Returns all fields rather than
+        ``None`` if value is ``None`` or empty, so that list responses always
+        prune their querysets to ``values()`` rows.
+        """
+        fields = [name.strip() for name in (value or '').split(',') if name.strip()]
+        if not fields:
+            return list(cls.columns)
+        unknown = [name for name in fields if name not in cls.columns]
+        if unknown:
+            raise ParseError(f'Unknown fields: {", ".join(unknown)}.')
+        return fields
+
+    @classmethod
+    def prune_queryset(cls, queryset, fields: list):
+        """Returns ``queryset`` as ``values()`` rows of fields and the primary key,
+        which pagination reads.
+        """
+        lookups = ['pk']
+        for name in fields:
+            source = cls.columns[name]
+            lookups += source.values() if isinstance(source, dict) else [source]
+        return queryset.values(*lookups)
+
+    def to_representation(self, row):
+        return {name: ({nested: row[lookup] for nested, lookup in source.items()}
+                       if isinstance(source, dict) else row[source])
+                for name, source in self.columns.items()}
+
+class EventListSerializer(ValuesSerializer):
+    """Read-only list version of ``EventSerializer``, with the same output.
+    """
+    columns = {name: name for name in EventSerializer.Meta.fields}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Resolved once rather than per row like serializers.DateTimeField
+        self._timezone = timezone.get_current_timezone() if settings.USE_TZ else None
+
+    def to_representation(self, row):
+        data = super().to_representation(row)
+        if 'datetime' in data and self._timezone is not None:
+            data['datetime'] = data['datetime'].astimezone(self._timezone)
+        return data
+
+class TktUserListSerializer(ValuesSerializer):
+    """Read-only list version of ``TktUserSerializer``, with the same output.
+    """
+    columns = {
+        'user': {name: f'user__{name}' for name in UserSerializer.Meta.fields
+                 if name != 'password'},
+        'uuid': 'uuid',
+        'event_count': 'event_count',
+    }
@@ -0,0 +1,59 @@
+"""Signals sent by ``entityhandler`` when relationships between entities change.
+"""
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.dispatch import Signal, receiver
+from django.utils import timezone
+from .models import Event, Registration, TktUser
+
+# Fields of ``User``s that are serialized with their ``TktUser``s.
+USER_FIELDS = frozenset(['username', 'first_name', 'last_name', 'email'])
+
+# Sent whenever ``TktUser``s are registered to or unregistered from ``Event``s,
+# regardless of which side of the relationship was modified, once per operation.
+# Arguments: ``action`` (``'add'`` or ``'remove'``) and ``pairs``, a list of
+# ``(event_id, tktuser_id)`` tuples affected by the change.
+registrations_changed = Signal()
+
+# Sent with the model as sender after counter fields of its objects are updated
+# in bulk, which sends no model signals.
+# Arguments: ``pks``, a list of the primary keys of the updated objects.
+counters_changed = Signal()
+
+@receiver(m2m_changed, sender=Registration)
+def _registrations_added(sender, instance, action, reverse, pk_set, **kwargs):
+    # Removals are reported by Registration.objects.delete(), which related
+    # managers remove registrations with
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        pairs = [(instance.pk, pk) for pk in pk_set]
+    else:
+        pairs = [(pk, instance.pk) for pk in pk_set]
+    registrations_changed.send(sender=sender, action='add', pairs=pairs)
+
+@receiver(post_save, sender=Registration)
+def _registration_created(sender, instance, created, **kwargs):
+    if created:
+        registrations_changed.send(sender=sender, action='add',
+                                   pairs=[(instance.event_id, instance.tktuser_id)])
+
+@receiver(pre_delete, sender=Event)
+@receiver(pre_delete, sender=TktUser)
+def _registrations_cascaded(sender, instance, **kwargs):
+    # Registrations deleted by cascades are deleted with a single query that
+    # sends no signals. This is sent before the deleted TktUser or Event is
+    # removed, so receivers can still look up both sides of the registrations
+    field = 'event' if sender is Event else 'tktuser'
+    pairs = list(Registration.objects.filter(**{field: instance.pk})
+                                     .values_list('event_id', 'tktuser_id'))
+    if pairs:
+        registrations_changed.send(sender=Registration, action='remove', pairs=pairs)
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, created, update_fields, **kwargs):
+    # Rosters and user event lists are validated by updated_at of the TktUsers,
+    # which saving their User does not change. Logins only save last_login
+    if created or (update_fields is not None and not USER_FIELDS & set(update_fields)):
+        return
+    TktUser.objects.filter(user=instance).update(updated_at=timezone.now())
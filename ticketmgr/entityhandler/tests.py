@@ -1,11 +1,28 @@
 #TODO: Refactor tests using self.<var> in setup method
+import csv
+import json
+import os
+import re
+import tempfile
 import uuid
+from io import StringIO
+from unittest.mock import patch
 
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
 
+from . import cache, exports, imports, registrations, roles
 from .models import *
+from .renderers import FastJSONRenderer
+from .serializers import (EventListSerializer, EventSerializer, TktUserListSerializer,
+                          TktUserSerializer)
 
 TEST_EV_DATETIME = timezone.datetime.now(timezone.utc)
 
@@ -126,6 +143,24 @@ class ModelRelationshipTestCase(TestCase):
         users[0].delete()
         self.assertEqual(evs[1].tktuser_set.count(), 0)
 
+    def test_registration_model(self):
+        users = [user for user in TktUser.objects.all()]
+        evs = [event for event in Event.objects.all()]
+
+        users[0].events.add(evs[0], evs[1])
+        Registration.objects.create(tktuser=users[1], event=evs[0])
+        secrets = [bytes(secret) for secret in Registration.objects.values_list('secret', flat=True)]
+
+        # Every registration has its own random secret
+        self.assertEqual(len(secrets), 3)
+        self.assertTrue(all(len(secret) == 20 for secret in secrets))
+        self.assertEqual(len(set(secrets)), 3)
+        self.assertEqual(evs[0].tktuser_set.count(), 2)
+
+        # Users can only be registered once to each event
+        with self.assertRaises(IntegrityError):
+            Registration.objects.create(tktuser=users[0], event=evs[0])
+
     def test_admin_event_m2m(self):
         admins = [admin for admin in TktAdmin.objects.all()]
         evs = [event for event in Event.objects.all()]
@@ -167,6 +202,102 @@ class ModelRelationshipTestCase(TestCase):
         agents[2].delete()
         self.assertEqual(evs[1].tktagent_set.count(), 0)
 
+    def assertCountersCorrect(self):
+        for event in Event.objects.all():
+            self.assertEqual(event.user_count, event.tktuser_set.count())
+            self.assertEqual(event.admin_count, event.tktadmin_set.count())
+            self.assertEqual(event.agent_count, event.tktagent_set.count())
+        for user in TktUser.objects.all():
+            self.assertEqual(user.event_count, user.events.count())
+
+    def test_attendance_counters(self):
+        users = [user for user in TktUser.objects.all()]
+        admins = [admin for admin in TktAdmin.objects.all()]
+        agents = [agent for agent in TktAgent.objects.all()]
+        evs = [event for event in Event.objects.all()]
+        self.assertCountersCorrect()
+
+        # Registrations, through both sides and the through model
+        users[0].events.add(evs[0], evs[1])
+        evs[0].tktuser_set.add(users[1], users[2])
+        Registration.objects.create(tktuser=users[1], event=evs[1])
+        self.assertCountersCorrect()
+        users[0].events.remove(evs[0])
+        evs[1].tktuser_set.clear()
+        Registration.objects.filter(tktuser=users[2]).delete()
+        self.assertCountersCorrect()
+        users[0].events.set(evs)
+        self.assertCountersCorrect()
+        # Saves of instances with stale counters
+        evs[0].title = 'Renamed'
+        evs[0].save()
+        users[0].save()
+        self.assertCountersCorrect()
+        self.assertEqual(Event.objects.get(pk=evs[0].pk).title, 'Renamed')
+        # Admins
+        evs[0].tktadmin_set.add(*admins)
+        admins[0].events.add(evs[1], evs[2])
+        self.assertCountersCorrect()
+        admins[1].events.remove(evs[0])
+        admins[0].events.clear()
+        evs[0].tktadmin_set.clear()
+        self.assertCountersCorrect()
+        admins[2].events.add(evs[1])
+        admins[2].admin.delete()
+        self.assertCountersCorrect()
+        # Removals of unrelated and already removed admins
+        admins[0].events.add(evs[1])
+        admins[0].events.remove(evs[0], evs[1])
+        admins[0].events.remove(evs[1])
+        evs[1].tktadmin_set.remove(admins[0], admins[1])
+        self.assertCountersCorrect()
+        # Agents, including queryset updates of related managers
+        agents[0].event = evs[0]
+        agents[0].save()
+        evs[1].tktagent_set.add(agents[1], agents[2])
+        self.assertCountersCorrect()
+        TktAgent.objects.filter(event=evs[1]).update(event=evs[0])
+        agents[0].delete()
+        self.assertCountersCorrect()
+        # Cascades
+        users[0].user.delete()
+        evs[0].delete()
+        self.assertCountersCorrect()
+
+    def test_reconcile_counters(self):
+        users = [user for user in TktUser.objects.all()]
+        evs = [event for event in Event.objects.all()]
+        users[0].events.add(*evs)
+        evs[0].tktadmin_set.add(*TktAdmin.objects.all())
+        Event.objects.filter(pk=evs[0].pk).update(user_count=10, admin_count=0)
+        TktUser.objects.filter(pk=users[0].pk).update(event_count=-1)
+        Event.objects.filter(pk=evs[2].pk).update(agent_count=0)
+
+        out = StringIO()
+        call_command('reconcile_counters', batch_size=2, stdout=out)
+        self.assertIn('Event: 3 checked, 2 repaired', out.getvalue())
+        self.assertIn('TktUser: 3 checked, 1 repaired', out.getvalue())
+        self.assertCountersCorrect()
+
+    def test_bulk_removal_queries(self):
+        ev = Event.objects.first()
+        TktUser.objects.bulk_create(
+            [TktUser(user=User.objects.create_user(f'bulk{i}')) for i in range(50)])
+        users = list(TktUser.objects.filter(user__username__startswith='bulk'))
+        # Test that removals are reported once per operation rather than per
+        # registration, whatever removes them
+        removals = (lambda: ev.tktuser_set.clear(),
+                    lambda: ev.tktuser_set.remove(*users[:25]),
+                    lambda: Registration.objects.filter(event=ev).delete(),
+                    lambda: ev.delete())
+        for remove in removals:
+            ev.tktuser_set.add(*users)
+            with CaptureQueriesContext(connection) as queries:
+                remove()
+            self.assertLess(len(queries), 25)
+            self.assertCountersCorrect()
+        self.assertEqual(Registration.objects.count(), 0)
+
 class RegistrationCheckTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -421,15 +552,15 @@ class EndpointBehaviorTestCase(TestCase):
         # Test valid GET request
         response = self.su_client.get('/api/event')
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), len(self.events))
-        ev = Event.objects.get(uuid=response.data[0]['uuid'])
-        self.assertEqual(ev.title, response.data[0]['title'])
+        self.assertEqual(len(response.json()), len(self.events))
+        ev = Event.objects.get(uuid=response.json()[0]['uuid'])
+        self.assertEqual(ev.title, response.json()[0]['title'])
 
         # /api/event/<uuid>
         # Test valid GET request
         ev_uuid = self.events[0].uuid
         response = self.su_client.get(f'/api/event/{ev_uuid}')
-        self.assertEqual(self.events[0].title, response.data['title'])
+        self.assertEqual(self.events[0].title, response.json()['title'])
         # Test GET request on non-existent event
         response = self.su_client.get(f'/api/event/{uuid.uuid4()}')
         self.assertEqual(response.status_code, 404)
@@ -464,6 +595,441 @@ class EndpointBehaviorTestCase(TestCase):
         self.assertEqual(self.events[0].tktadmin_set.count(), len(response.data))
         self.assertEqual(response.data[0]['admin']['email'], self.admins[0].admin.email)
 
+    def test_list_pagination(self):
+        for i in range(3, 8):
+            Event.objects.create(title=f'Event {i}',
+                                 description=f'This is event {i}.',
+                                 datetime=timezone.datetime.now(timezone.utc))
+        expected = [str(ev_uuid) for ev_uuid in
+                    Event.objects.order_by('pk').values_list('uuid', flat=True)]
+
+        # Follow next links until the last page
+        uuids = []
+        response = self.su_client.get('/api/event', {'page_size': 3})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.json()), 3)
+            uuids += [event['uuid'] for event in response.json()]
+            if len(uuids) == 3:
+                # Test that events created while paging are not skipped or repeated
+                Event.objects.create(title='Late Event',
+                                     description='This event was created while paging.',
+                                     datetime=timezone.datetime.now(timezone.utc))
+                expected.append(str(Event.objects.get(title='Late Event').uuid))
+            links = response.headers.get('Link', '')
+            if 'rel="next"' not in links:
+                break
+            next_url = links.split('>; rel="next"')[0].split('<')[-1]
+            response = self.su_client.get(next_url)
+        self.assertEqual(uuids, expected)
+        self.assertIn('rel="prev"', response.headers['Link'])
+
+        # Test page size limits and malformed cursors
+        with self.settings(MAX_PAGE_SIZE=2):
+            response = self.su_client.get('/api/event', {'page_size': 5})
+            self.assertEqual(len(response.json()), 2)
+        response = self.su_client.get('/api/event', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+        # Test that single pages have no links
+        self.users[0].events.add(self.events[0])
+        response = self.su_client.get('/api/user/user0/event')
+        self.assertEqual(len(response.data), 1)
+        self.assertNotIn('Link', response.headers)
+
+    def test_list_query_counts(self):
+        ev = self.events[0]
+        self.users[0].events.add(ev, self.events[1], self.events[2])
+        self.admins[0].events.add(ev, self.events[1])
+        endpoints = [f'/api/event/{ev.uuid}/user',
+                     f'/api/event/{ev.uuid}/admin',
+                     f'/api/event/{ev.uuid}/agent']
+        query_counts = []
+        for endpoint in endpoints:
+            with CaptureQueriesContext(connection) as queries:
+                self.su_client.get(endpoint)
+            query_counts.append(len(queries))
+
+        # Grow the rosters and test that the number of queries is unchanged
+        for i in range(3, 13):
+            u = TktUser.objects.create(user=User.objects.create_user(f'user{i}'))
+            u.events.add(ev, self.events[i % 2 + 1])
+            a = TktAdmin.objects.create(admin=User.objects.create_user(f'admin{i}'))
+            a.events.add(ev)
+            TktAgent.objects.create(agent=User.objects.create_user(f'agent{i}'), event=ev)
+        for endpoint, query_count in zip(endpoints, query_counts):
+            with self.assertNumQueries(query_count):
+                response = self.su_client.get(endpoint)
+            self.assertEqual(len(response.data), 11)
+
+        # Test that annotated counts include events other than the listed one
+        response = self.su_client.get(endpoints[0])
+        counts = {u['user']['username']: u['event_count'] for u in response.data}
+        self.assertEqual(counts['user0'], 3)
+        self.assertEqual(counts['user5'], 2)
+        response = self.su_client.get(endpoints[1])
+        counts = {a['admin']['username']: a['event_count'] for a in response.data}
+        self.assertEqual(counts['admin0'], 2)
+        self.assertEqual(counts['admin5'], 1)
+
+    def test_conditional_requests(self):
+        ev = self.events[0]
+        user = self.users[0]
+        user.events.add(ev)
+        uris = (f'/api/event/{ev.uuid}', f'/api/user/{user.user.username}/event')
+        for other_user, uri in zip(self.users[1:], uris):
+            response = self.su_client.get(uri)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            # Test that unchanged resources are not modified, without serializing them
+            with patch('entityhandler.views.paginated_response') as paginated, \
+                 patch('entityhandler.views.EventSerializer') as serializer:
+                response = self.su_client.get(uri, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b'')
+                response = self.su_client.get(
+                    uri, HTTP_IF_MODIFIED_SINCE=response.headers['Last-Modified'])
+                self.assertEqual(response.status_code, 304)
+                paginated.assert_not_called()
+                serializer.assert_not_called()
+
+            # Test that registration changes and event updates change the ETag
+            for change in (lambda: other_user.events.add(ev),
+                           lambda: ev.save(),
+                           lambda: user.events.remove(ev)):
+                change()
+                response = self.su_client.get(uri, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers['ETag'], etag)
+                etag = response.headers['ETag']
+            user.events.add(ev)
+
+        # Test that profile edits change the ETag of the user's events, but logins do not
+        uri = f'/api/user/{user.user.username}/event'
+        etag = self.su_client.get(uri).headers['ETag']
+        user.user.last_login = timezone.now()
+        user.user.save(update_fields=['last_login'])
+        response = self.su_client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        user.user.first_name = 'First'
+        user.user.save()
+        response = self.su_client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # Test the event list, whose ETag also covers deleted events
+        response = self.su_client.get('/api/event')
+        etag = response.headers['ETag']
+        self.assertNotIn('Last-Modified', response.headers)
+        response = self.su_client.get('/api/event', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.events[2].delete()
+        response = self.su_client.get('/api/event', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+        # Test that other methods are not conditional
+        etag = response.headers['ETag']
+        response = self.su_client.post('/api/event', {}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 400)
+
+    def test_roster_conditional_requests(self):
+        ev, other_ev = self.events[0], self.events[1]
+        self.users[0].events.add(ev)
+        self.admins[0].events.add(ev)
+        def edit_profile():
+            self.users[0].user.email = 'user0@example.com'
+            self.users[0].user.save()
+        changes = {
+            'user': (lambda: self.users[1].events.add(ev),
+                     # Changes to the event counts and profiles of listed users
+                     lambda: self.users[0].events.add(other_ev),
+                     lambda: self.users[0].events.remove(other_ev),
+                     edit_profile),
+            'agent': (lambda: TktAgent.objects.create(agent=User.objects.create_user('agent9'),
+                                                      event=ev),
+                      lambda: self.agents[0].delete()),
+            'admin': (lambda: self.admins[1].events.add(ev),
+                      lambda: self.admins[0].events.add(other_ev),
+                      lambda: self.admins[0].events.remove(other_ev),
+                      lambda: ev.tktadmin_set.clear()),
+        }
+        for roster, roster_changes in changes.items():
+            uri = f'/api/event/{ev.uuid}/{roster}'
+            response = self.su_client.get(uri)
+            etag = response.headers['ETag']
+            # Admin lists have no Last-Modified validator, see _event_admins_etag()
+            self.assertEqual('Last-Modified' in response.headers, roster != 'admin')
+            response = self.su_client.get(uri, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            # Test that roster changes change the ETag
+            for change in roster_changes:
+                change()
+                response = self.su_client.get(uri, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers['ETag'], etag)
+                etag = response.headers['ETag']
+            # Test that missing events are not reported as not modified
+            response = self.su_client.get(f'/api/event/{uuid.uuid4()}/{roster}',
+                                          HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 404)
+        # Test that other methods are not conditional
+        response = self.su_client.post(f'/api/event/{ev.uuid}/admin',
+                                       {'admin_username': 'admin2'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_sparse_fields(self):
+        ev = self.events[0]
+        user = self.users[0]
+        user.events.add(ev)
+        # Test that lists only serialize and load the requested fields
+        with CaptureQueriesContext(connection) as queries:
+            response = self.su_client.get('/api/event', {'fields': 'title, datetime'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([set(item) for item in response.json()], [{'title', 'datetime'}] * 3)
+        self.assertFalse(any('"description"' in query['sql'] for query in queries))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.su_client.get(f'/api/event/{ev.uuid}/user', {'fields': 'uuid'})
+        self.assertEqual(response.json(), [{'uuid': str(user.uuid)}])
+        self.assertFalse(any('JOIN "auth_user"' in query['sql'] for query in queries))
+        response = self.su_client.get(f'/api/event/{ev.uuid}/user', {'fields': 'user'})
+        self.assertEqual(response.json()[0]['user']['username'], user.user.username)
+        response = self.su_client.get(f'/api/event/{ev.uuid}/admin', {'fields': 'event_count'})
+        self.assertEqual(response.data, [])
+        # Test details, which are cached separately for every selection
+        response = self.su_client.get(f'/api/event/{ev.uuid}', {'fields': 'title'})
+        self.assertEqual(response.json(), {'title': ev.title})
+        response = self.su_client.get(f'/api/event/{ev.uuid}')
+        self.assertEqual(response.json()['description'], ev.description)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.su_client.get(f'/api/user/{user.user.username}',
+                                          {'fields': 'event_count'})
+        self.assertEqual(response.data, {'event_count': 1})
+        # The username is only looked up, and the user not loaded
+        self.assertFalse(any('"auth_user"."email"' in query['sql'] for query in queries[1:]))
+        self.assertFalse(any('"entityhandler_tktuser"."uuid"' in query['sql']
+                             for query in queries))
+        # Test unknown and write-only fields
+        for uri in (f'/api/event/{ev.uuid}', '/api/event', f'/api/user/{user.user.username}'):
+            response = self.su_client.get(uri, {'fields': 'title,password'})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('password', response.json()['detail'])
+
+    def test_list_serializers(self):
+        ev = self.events[0]
+        ev.description = 'Caf\u00e9 \u2028 line \u2029 "quoted" \U0001f3ab'
+        ev.datetime = timezone.datetime(2022, 12, 1, 10, 0, 0, 123456, timezone.utc)
+        ev.save()
+        for user in self.users:
+            user.events.add(ev)
+        renderers = (JSONRenderer(), FastJSONRenderer())
+        cases = ((Event.objects.all(), EventSerializer, EventListSerializer),
+                 (ev.tktuser_set.select_related('user'), TktUserSerializer, TktUserListSerializer))
+        # Test that output is byte-compatible with the model serializers, with and
+        # without orjson, and for sparse fieldsets
+        for queryset, model_serializer, list_serializer in cases:
+            for fields in (None, ['uuid'], list(list_serializer.columns)[::-1][:2]):
+                expected = JSONRenderer().render(
+                    model_serializer(queryset.order_by('pk'), many=True, fields=fields).data)
+                rows = list_serializer.prune_queryset(queryset.order_by('pk'),
+                                                      fields or list_serializer.columns)
+                data = list_serializer(rows, many=True, fields=fields).data
+                for renderer in renderers:
+                    with self.subTest(serializer=list_serializer, fields=fields,
+                                      renderer=renderer):
+                        self.assertEqual(renderer.render(data), expected)
+                with patch('entityhandler.renderers.orjson', None):
+                    self.assertEqual(FastJSONRenderer().render(data), expected)
+        # Test that the renderer falls back to JSONRenderer for data orjson rejects,
+        # and indented output
+        data = {'big': 2 ** 70, 'event': EventSerializer(ev).data}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(data, 'application/json; indent=2'),
+                         JSONRenderer().render(data, 'application/json; indent=2'))
+        # Test list endpoints
+        response = self.su_client.get(f'/api/event/{ev.uuid}/user')
+        self.assertEqual(response.content, JSONRenderer().render(
+            TktUserSerializer(ev.tktuser_set.order_by('pk'), many=True).data))
+
+    def test_event_users_bulk(self):
+        ev = self.events[0]
+        uri = f'/api/event/{ev.uuid}/user/bulk'
+        users = self.users + [TktUser.objects.create(user=User.objects.create_user(f'user{i}'))
+                              for i in range(3, 8)]
+        users[0].events.add(ev)
+        unknown_uuid = str(uuid.uuid4())
+        user_uuids = [str(user.uuid) for user in users]
+        payload = user_uuids[:4] + [unknown_uuid, 'not-a-uuid', user_uuids[1]]
+
+        # Test chunked registration from a JSON array
+        with patch.object(registrations, 'CHUNK_SIZE', 3):
+            response = self.su_client.post(uri, payload, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'registered': 3,
+                                         'already_registered': [user_uuids[0], user_uuids[1]],
+                                         'unknown': [unknown_uuid, 'not-a-uuid']})
+        self.assertEqual(ev.tktuser_set.count(), 4)
+        ev.refresh_from_db()
+        self.assertEqual(ev.user_count, 4)
+        # Test registration from streamed NDJSON
+        body = '\n'.join(json.dumps(user_uuid) for user_uuid in user_uuids[2:]) + '\n'
+        response = self.su_client.post(uri, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['registered'], 4)
+        self.assertEqual(response.data['already_registered'], user_uuids[2:4])
+        self.assertEqual(ev.tktuser_set.count(), 8)
+
+        # Test that users registered concurrently with the insert are not
+        # reported, nor counted, as registered
+        ev2 = self.events[1]
+        bulk_create = Registration.objects.bulk_create
+        def register_first(objs, **kwargs):
+            objs = list(objs)
+            Registration.objects.create(event=ev2, tktuser_id=objs[0].tktuser_id)
+            return bulk_create(objs, **kwargs)
+        with patch.object(Registration.objects, 'bulk_create', side_effect=register_first), \
+                patch.object(registrations, 'registrations_changed') as signal:
+            result = registrations.register_users(ev2, user_uuids[:3])
+        self.assertEqual(result, {'registered': 2,
+                                  'already_registered': [user_uuids[0]],
+                                  'unknown': []})
+        signal.send.assert_called_once_with(sender=Registration, action='add',
+                                            pairs=[(ev2.pk, users[1].pk),
+                                                   (ev2.pk, users[2].pk)])
+        ev2.tktuser_set.clear()
+
+        # Test that malformed payloads register no one, but the NDJSON lines
+        # before a malformed one, which are committed per chunk
+        uri = f'/api/event/{ev2.uuid}/user/bulk'
+        response = self.su_client.post(uri, {'user_uuids': user_uuids}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(ev2.tktuser_set.count(), 0)
+        body = f'"{user_uuids[0]}"\n"{user_uuids[1]}"\n"bogus"\nnot json\n"{user_uuids[2]}"\n'
+        with patch.object(registrations, 'CHUNK_SIZE', 2):
+            response = self.su_client.post(uri, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': 'Malformed payload.', 'registered': 2,
+                                         'already_registered': [], 'unknown': ['bogus']})
+        self.assertEqual(set(ev2.tktuser_set.all()), {users[0], users[1]})
+        ev2.tktuser_set.clear()
+
+        # Test that chunked bodies, which are read as empty, are rejected
+        response = self.su_client.generic('POST', uri, '', content_type='application/x-ndjson',
+                                          HTTP_TRANSFER_ENCODING='chunked')
+        self.assertEqual(response.status_code, 411)
+        self.assertEqual(ev2.tktuser_set.count(), 0)
+        response = self.su_client.post(f'/api/event/{uuid.uuid4()}/user/bulk',
+                                       user_uuids, format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_event_users_export(self):
+        ev = self.events[0]
+        uri = f'/api/event/{ev.uuid}/user/export'
+        for user in self.users:
+            user.events.add(ev)
+
+        # Test streamed NDJSON and CSV exports, across chunks
+        with patch.object(exports, 'CHUNK_SIZE', 2):
+            response = self.su_client.get(uri)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+            self.assertEqual(rows[0], {'uuid': str(self.users[0].uuid), 'username': 'user0',
+                                       'first_name': 'John0', 'last_name': 'Doe0',
+                                       'email': 'user0@domain.com'})
+            self.assertEqual([row['username'] for row in rows], ['user0', 'user1', 'user2'])
+            response = self.su_client.get(uri, {'type': 'csv'})
+            self.assertEqual(response.status_code, 200)
+            content = b''.join(response.streaming_content).decode()
+        rows = list(csv.reader(content.splitlines()))
+        self.assertEqual(rows[0], ['uuid', 'username', 'first_name', 'last_name', 'email'])
+        self.assertEqual(rows[3], [str(self.users[2].uuid), 'user2', 'John2', 'Doe2',
+                                   'user2@domain.com'])
+
+        # Test that the roster is sent in chunks from a single query
+        with patch.object(exports, 'CHUNK_SIZE', 2):
+            response = self.su_client.get(uri, {'type': 'csv'})
+            with self.assertNumQueries(1):
+                chunks = list(response.streaming_content)
+        self.assertEqual(len(chunks), 3)
+        response = self.su_client.get(uri, {'type': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_entities(self):
+        # Test user import from CSV
+        body = ('username,first_name,last_name,email,password\n'
+                'imported1,Jane,Roe,imported1@domain.com,imported1pass\n'
+                'imported2,"Roe, Jr.",Doe,,imported2pass\n'
+                'user0,John,Doe,,user0pass\n'
+                'imported3,,,not-an-email,imported3pass\n'
+                'imported1,Jane,Roe,,imported1pass\n')
+        response = self.su_client.post('/api/import/user', body, content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rows'], 5)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['existing'], 2)
+        self.assertEqual(response.data['invalid'], 1)
+        self.assertIn('email', response.data['errors'][4])
+        user = User.objects.get(username='imported2')
+        self.assertEqual(user.first_name, 'Roe, Jr.')
+        self.assertIsNotNone(user.tktuser.uuid)
+        # Test that imported passwords are rehashed with the default hasher on login
+        self.assertTrue(user.password.startswith('pbkdf2_sha256_import$'))
+        response = APIClient().post('/api/login', {'username': 'imported2',
+                                                   'password': 'imported2pass'})
+        self.assertEqual(response.status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$'))
+
+        # Test resumed event import from NDJSON, and that cached lists include
+        # imported events
+        etag = self.su_client.get('/api/event').headers['ETag']
+        rows = [json.dumps({'title': f'Imported {i}', 'description': 'Imported event.',
+                            'datetime': '2030-01-01T10:00:00Z'}) for i in range(4)]
+        body = '\n'.join(rows[:2] + ['{not json'] + rows[2:]) + '\n'
+        response = self.su_client.post('/api/import/event?skip=2', body,
+                                       content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rows'], 5)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(list(response.data['errors']), [3])
+        self.assertEqual(sorted(Event.objects.filter(title__startswith='Imported')
+                                             .values_list('title', flat=True)),
+                         ['Imported 2', 'Imported 3'])
+        response = self.su_client.get('/api/event', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([event['title'] for event in response.json()][-2:],
+                         ['Imported 2', 'Imported 3'])
+        response = self.su_client.post('/api/import/event', body, content_type='text/plain')
+        self.assertEqual(response.status_code, 415)
+
+    def test_import_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.ndjson')
+            checkpoint = os.path.join(directory, 'events.ckpt')
+            with open(path, 'w') as f:
+                for i in range(5):
+                    f.write(json.dumps({'title': f'Imported {i}', 'description': 'Imported event.',
+                                        'datetime': '2030-01-01T10:00:00Z'}) + '\n')
+
+            # Test that an import failing in its third batch resumes from the checkpoint
+            create_events = imports._create_events
+            calls = []
+            def fail_third_batch(rows):
+                calls.append(rows)
+                if len(calls) == 3:
+                    raise DatabaseError('connection lost')
+                return create_events(rows)
+            with patch.object(imports, '_create_events', fail_third_batch):
+                with self.assertRaises(DatabaseError):
+                    call_command('import_entities', 'events', path, batch_size=2,
+                                 checkpoint=checkpoint, stdout=StringIO())
+            self.assertEqual(Event.objects.filter(title__startswith='Imported').count(), 4)
+            out = StringIO()
+            call_command('import_entities', 'events', path, batch_size=2,
+                         checkpoint=checkpoint, stdout=out)
+            self.assertIn('Resuming after row 4', out.getvalue())
+            self.assertIn('5 rows: 1 created', out.getvalue())
+            self.assertEqual(Event.objects.filter(title__startswith='Imported').count(), 5)
+
     def test_event_post_endpoints(self):
         # /api/event
         # Test valid POST request
@@ -584,6 +1150,57 @@ class EndpointAuthorizationTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['user']['username'], 'user1')
 
+    def test_role_resolution(self):
+        uri = f'/api/event/{self.event.uuid}/agent'
+        # Test that roles are stored in the session at login
+        for client, role in ((self.usr_client, roles.USER), (self.agt_client, roles.AGENT),
+                             (self.amn_client, roles.ADMIN)):
+            self.assertEqual(client.session[roles.SESSION_KEY], role)
+        # Test that roles are read from the session, without querying profiles
+        for client in (self.usr_client, self.agt_client):
+            with self.assertNumQueries(1):
+                response = client.get(uri)
+            self.assertEqual(response.status_code, 403)
+        # Test that sessions without a role resolve it once
+        session = self.amn_client.session
+        del session[roles.SESSION_KEY]
+        session.save()
+        self.amn_client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        for resolved in (True, False):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.amn_client.get(uri)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(any('"entityhandler_tktadmin"' in query['sql']
+                                 for query in queries), resolved)
+        self.assertEqual(self.amn_client.session[roles.SESSION_KEY], roles.ADMIN)
+
+        # Test that deleted profiles revoke the roles stored in sessions
+        payload = {'title': 'Event 2', 'description': 'This is the second event.',
+                   'datetime': '2030-01-01T10:00:00Z'}
+        self.assertEqual(self.amn_client.post('/api/event', payload).status_code, 201)
+        self.admin.delete()
+        self.assertEqual(self.amn_client.post('/api/event', payload).status_code, 403)
+        # Test that agent views deny agents whose profile was deleted, even with
+        # a stale role
+        self.assertEqual(self.agt_client.get('/api/ticket/bundle').status_code, 200)
+        with patch('entityhandler.roles._replace_version'):
+            self.agent.delete()
+        for method, uri in (('get', '/api/ticket/bundle'), ('post', '/api/ticket/session'),
+                            ('post', '/api/ticket/session/auth'),
+                            ('post', '/api/ticket/auth/scan')):
+            response = getattr(self.agt_client, method)(uri, {'ticket_totp': '000000'})
+            self.assertEqual(response.status_code, 403)
+
+        # Test that role versions are kept in the ROLE_CACHE cache
+        role_cache = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                      'LOCATION': 'roles'}
+        with self.settings(CACHES={**settings.CACHES, 'roles': role_cache}, ROLE_CACHE='roles'):
+            self.util_auth_apiclient('user1', 'user1pass')
+            key = roles._version_key(self.user.user_id)
+            self.assertIsNotNone(caches['roles'].get(key))
+            self.user.delete()
+            self.assertIsNone(caches['roles'].get(key))
+
     """
     def test_user_post_endpoints(self):
         payload = {'event_uuid': str(self.event.uuid)}
@@ -611,13 +1228,13 @@ class EndpointAuthorizationTestCase(TestCase):
         # Test event detail GET request by user, agent, admin
         response = self.usr_client.get(ev_uri)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['title'], self.event.title)
+        self.assertEqual(response.json()['title'], self.event.title)
         response = self.agt_client.get(ev_uri)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['title'], self.event.title)
+        self.assertEqual(response.json()['title'], self.event.title)
         response = self.amn_client.get(ev_uri)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data['title'], self.event.title)
+        self.assertEqual(response.json()['title'], self.event.title)
         # Test event admin and user GET request by user
         response = self.usr_client.get(f'{ev_uri}/user')
         self.assertEqual(response.status_code, 403)
@@ -640,6 +1257,11 @@ class EndpointAuthorizationTestCase(TestCase):
         # Test event agent GET request by admin
         response = self.amn_client.get(f'{ev_uri}/admin')
         self.assertEqual(response.status_code, 200)
+        # Test event user export by user, agent
+        response = self.usr_client.get(f'{ev_uri}/user/export')
+        self.assertEqual(response.status_code, 403)
+        response = self.agt_client.get(f'{ev_uri}/user/export')
+        self.assertEqual(response.status_code, 200)
 
     def test_event_post_endpoints(self):
         ev_data = {'title': 'POST Event',
@@ -674,3 +1296,156 @@ class EndpointAuthorizationTestCase(TestCase):
         response = self.amn_client.post(f'{ev_uri}/admin', payload)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['admin']['username'], self.admin.admin.username)
+        payload = [str(self.user.uuid)]
+        # Test bulk user event registration by user, agent
+        response = self.usr_client.post(f'{ev_uri}/user/bulk', payload, format='json')
+        self.assertEqual(response.status_code, 403)
+        response = self.agt_client.post(f'{ev_uri}/user/bulk', payload, format='json')
+        self.assertEqual(response.status_code, 403)
+        # Test bulk user event registration by admin
+        response = self.amn_client.post(f'{ev_uri}/user/bulk', payload, format='json')
+        self.assertEqual(response.status_code, 200)
+
+class EventCacheTestCase(TestCase):
+    def setUp(self):
+        caches[settings.EVENT_CACHE].clear()
+        User.objects.create_superuser('debug_admin', password='debug_adminpass')
+        self.su_client = APIClient()
+        self.su_client.login(username='debug_admin', password='debug_adminpass')
+        self.event = Event.objects.create(title='Event 0',
+                                          description='This is event 0.',
+                                          datetime=timezone.datetime.now(timezone.utc))
+
+    def test_cached_responses(self):
+        ev_uri = f'/api/event/{self.event.uuid}'
+        for uri in (ev_uri, '/api/event'):
+            response = self.su_client.get(uri)
+            # Test that hits do not query events, and that cached responses are
+            # identical to rendered ones
+            with CaptureQueriesContext(connection) as queries:
+                cached = self.su_client.get(uri)
+            self.assertFalse([q for q in queries if 'entityhandler_event' in q['sql']])
+            self.assertEqual(cached.content, response.content)
+        self.assertEqual(response.content,
+                         JSONRenderer().render(EventSerializer([self.event], many=True).data))
+
+        # Test invalidation by saves, registrations and deletes
+        self.event.title = 'Renamed Event'
+        self.event.save()
+        self.assertEqual(self.su_client.get(ev_uri).json()['title'], 'Renamed Event')
+        self.assertEqual(self.su_client.get('/api/event').json()[0]['title'], 'Renamed Event')
+        TktUser.objects.create(user=User.objects.create_user('user0')).events.add(self.event)
+        self.assertEqual(self.su_client.get(ev_uri).json()['user_count'], 1)
+        self.assertEqual(self.su_client.get('/api/event').json()[0]['user_count'], 1)
+        self.event.delete()
+        self.assertEqual(self.su_client.get(ev_uri).status_code, 404)
+        self.assertEqual(self.su_client.get('/api/event').json(), [])
+
+    def test_stampede_protection(self):
+        builds = []
+        def build():
+            builds.append(None)
+            return len(builds)
+        shared = caches[settings.EVENT_CACHE]
+        lock = 'entityhandler:scope:value:lock'
+
+        # Test that expired entries are served while another worker refreshes them
+        with patch.object(cache, 'CACHE_TIMEOUT', 0):
+            self.assertEqual(cache.get_or_build('scope', 'value', build), 1)
+        version = cache._version(shared, 'scope')
+        shared.add(lock, 1, version=version)
+        self.assertEqual(cache.get_or_build('scope', 'value', build), 1)
+        shared.delete(lock, version=version)
+        self.assertEqual(cache.get_or_build('scope', 'value', build), 2)
+        self.assertEqual(cache.get_or_build('scope', 'value', build), 2)
+
+        # Test that missing entries being built by another worker are waited for,
+        # and built without caching once waiting times out
+        cache.invalidate(['scope'])
+        version = cache._version(shared, 'scope')
+        shared.add(lock, 1, version=version)
+        with patch.object(cache, 'LOCK_POLL_INTERVAL', 0):
+            self.assertEqual(cache.get_or_build('scope', 'value', build), 3)
+            self.assertEqual(cache.get_or_build('scope', 'value', build), 4)
+        shared.delete(lock, version=version)
+        self.assertEqual(cache.get_or_build('scope', 'value', build), 5)
+        self.assertEqual(cache.get_or_build('scope', 'value', build), 5)
+
+class QueryPlanTestCase(TestCase):
+    """Guards the number of queries of every endpoint, and that entities are
+    looked up through indexes rather than full table scans."""
+    # (method, path, payload, maximum number of queries); paths are formatted with
+    # the username of a user, the uuid of that user and the uuid of an event.
+    # Session authentication accounts for two queries of every request.
+    ENDPOINTS = [
+        ('get', '/api/user/{username}', None, 3),
+        ('get', '/api/user/{username}/event', None, 5),
+        ('get', '/api/event', None, 3),
+        ('get', '/api/event/{event}', None, 3),
+        ('get', '/api/event/{event}/user', None, 4),
+        ('get', '/api/event/{event}/user/export', None, 3),
+        ('get', '/api/event/{event}/agent', None, 3),
+        ('get', '/api/event/{event}/admin', None, 4),
+        ('post', '/api/event/{event}/user', {'user_uuid': '{user}'}, 13),
+        ('post', '/api/event/{event}/user/bulk', ['{user}'], 7),
+        ('post', '/api/event/{event}/admin', {'admin_username': 'admin0'}, 9),
+    ]
+    # Lookups that must be served by an index, as a regular expression of their SQL
+    INDEXED_LOOKUPS = r'"(uuid|username|session_key)" (=|IN) '
+
+    def setUp(self):
+        User.objects.create_superuser('debug_admin', password='debug_adminpass')
+        self.su_client = APIClient()
+        self.su_client.login(username='debug_admin', password='debug_adminpass')
+        self.event = Event.objects.create(title='Event 0',
+                                          description='This is event 0.',
+                                          datetime=timezone.datetime.now(timezone.utc))
+        self.user = TktUser.objects.create(user=User.objects.create_user('user0'))
+        TktAdmin.objects.create(admin=User.objects.create_user('admin0'))
+        TktAgent.objects.create(agent=User.objects.create_user('agent0'), event=self.event)
+
+    def format_value(self, value):
+        names = {'username': self.user.user.username, 'user': self.user.uuid,
+                 'event': self.event.uuid}
+        if isinstance(value, str):
+            return value.format(**names)
+        if isinstance(value, list):
+            return [self.format_value(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self.format_value(item) for key, item in value.items()}
+        return value
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Tables of tests are tiny, which makes sequential scans cheapest
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql)
+            else:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertIndexed(self, sql):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            return
+        plan = self.explain(sql)
+        if connection.vendor == 'postgresql':
+            self.assertNotIn('Seq Scan', plan, sql)
+        else:
+            self.assertNotRegex(plan, r'(?m)^SCAN ', sql)
+
+    def test_endpoint_queries(self):
+        for method, path, payload, max_queries in self.ENDPOINTS:
+            path = self.format_value(path)
+            with self.subTest(method=method, path=path):
+                with CaptureQueriesContext(connection) as queries:
+                    response = getattr(self.su_client, method)(path, self.format_value(payload),
+                                                               format='json')
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                self.assertLess(response.status_code, 300)
+                self.assertLessEqual(len(queries), max_queries)
+                for query in queries:
+                    if (query['sql'].startswith('SELECT')
+                            and re.search(self.INDEXED_LOOKUPS, query['sql'])):
+                        self.assertIndexed(query['sql'])
@@ -11,6 +11,10 @@ urlpatterns = [
     path('event', views.event, name='event'),
     path('event/<uuid:event_uuid>', views.event_info, name='event_info'),
     path('event/<uuid:event_uuid>/user', views.event_users, name='event_users'),
+    path('event/<uuid:event_uuid>/user/bulk', views.event_users_bulk, name='event_users_bulk'),
+    path('event/<uuid:event_uuid>/user/export', views.event_users_export, name='event_users_export'),
     path('event/<uuid:event_uuid>/agent', views.event_agents, name='event_agents'),
-    path('event/<uuid:event_uuid>/admin', views.event_admins, name='event_admins')
+    path('event/<uuid:event_uuid>/admin', views.event_admins, name='event_admins'),
+    path('import/user', views.import_entities, {'kind': 'users'}, name='import_users'),
+    path('import/event', views.import_entities, {'kind': 'events'}, name='import_events'),
 ]
\ No newline at end of file
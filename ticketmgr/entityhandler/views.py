@@ -3,17 +3,105 @@
 # TODO: Check disclosed information through serialized models with nested relationships
 #       (do endpoints accidentally show other user info to user through event endpoints, etc)
 # TODO: Support DELETE methods for appropriate endpoints (unregister entities from events, etc)
-# TODO: Pagination for user/event list requests
+import csv
+import hashlib
+import json
+from . import cache, exports, imports, registrations, roles
+from .pagination import paginated_response
+from .renderers import FastJSONRenderer
 from .serializers import *
 from django.contrib.auth import authenticate, login, logout
+from django.db import DatabaseError
+from django.db.models import Count, Max
+from django.http import HttpResponse, StreamingHttpResponse
 from django.middleware.csrf import get_token
 from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import condition
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import permission_classes
 
+def _modification_validators(modified_func):
+    """Returns a ``condition`` decorator that answers conditional ``GET`` requests
+    with the ETag and Last-Modified validators of a resource.
+
+    Args:
+        ``modified_func``: A callable that takes the arguments of the view and
+        returns the time of the latest change to the resource, or ``None`` if
+        it does not exist. It is called once per request.
+    """
+    def last_modified(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        if not hasattr(request, '_modified'):
+            request._modified = modified_func(request, *args, **kwargs)
+        return request._modified
+
+    def etag(request, *args, **kwargs):
+        modified = last_modified(request, *args, **kwargs)
+        return None if modified is None else '%x' % int(modified.timestamp() * 1e6)
+
+    return condition(etag_func=etag, last_modified_func=last_modified)
+
+def _user_events_modified(request, username):
+    # Registration changes update the user, changes to its events update them
+    times = (TktUser.objects.filter(user__username=username)
+                            .annotate(events_updated_at=Max('events__updated_at'))
+                            .values_list('updated_at', 'events_updated_at')
+                            .first())
+    return None if times is None else max(t for t in times if t is not None)
+
+def _event_modified(request, event_uuid):
+    # Cached like the response, so that requests are answered without queries
+    return cache.get_or_build(str(event_uuid), 'modified', lambda: (
+        Event.objects.filter(uuid=event_uuid).values_list('updated_at', flat=True).first()))
+
+def _event_users_modified(request, event_uuid):
+    # Clients that may not list the roster are not told when it changes either
+    if not request.user.is_superuser and roles.get_role(request) == roles.USER:
+        return None
+    # Roster changes update the event, changes to its users' counters update them
+    times = (Event.objects.filter(uuid=event_uuid)
+                          .annotate(users_updated_at=Max('tktuser__updated_at'))
+                          .values_list('updated_at', 'users_updated_at')
+                          .first())
+    return None if times is None else max(t for t in times if t is not None)
+
+def _event_admins_etag(request, event_uuid):
+    # The event counts of admins change with their other events, which are
+    # updated when admins are added to them but not after they are removed,
+    # so the ETag also covers the number of events of the admins
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if not request.user.is_superuser and roles.get_role(request) == roles.USER:
+        return None
+    events = (TktAdmin.events.through.objects
+                      .filter(tktadmin__events__uuid=event_uuid)
+                      .aggregate(count=Count('pk'), updated_at=Max('event__updated_at')))
+    if not events['count']:
+        return None if _event_modified(request, event_uuid) is None else '0'
+    return '%x-%x' % (events['count'], int(events['updated_at'].timestamp() * 1e6))
+
+def _event_agents_modified(request, event_uuid):
+    if not request.user.is_superuser and roles.get_role(request) != roles.ADMIN:
+        return None
+    # Agent changes update the counters of their event
+    return _event_modified(request, event_uuid)
+
+def _event_list_etag(request):
+    # Deleted events leave no modification time behind, so the list has no
+    # Last-Modified validator and its ETag also covers the number of events
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    def build():
+        events = Event.objects.aggregate(count=Count('pk'), updated_at=Max('updated_at'))
+        if not events['count']:
+            return '0'
+        return '%x-%x' % (events['count'], int(events['updated_at'].timestamp() * 1e6))
+    return cache.get_or_build(cache.LIST_SCOPE, 'etag', build)
+
 @api_view()
 def csrf(request):
   return Response({'csrfToken': get_token(request)})
@@ -36,13 +124,14 @@ def tkt_login(request):
                         status.HTTP_400_BAD_REQUEST)
 
     login(request, user)
-    if hasattr(user, 'tktuser'):
+    role = roles.get_role(request)
+    if role == roles.USER:
         serializer = TktUserSerializer(user.tktuser)
-    elif hasattr(user, 'tktagent'):
+    elif role == roles.AGENT:
         serializer = TktAgentSerializer(user.tktagent)
-    elif hasattr(user, 'tktadmin'):
+    elif role == roles.ADMIN:
         serializer = TktAdminSerializer(user.tktadmin)
-    elif user.is_superuser:
+    elif role == roles.SUPERUSER:
         return Response({'message': 'Logged in as superuser.'})
     else:
         return Response({'error': 'Failed to resolve user type.'},
@@ -74,8 +163,12 @@ def user_info(request, username):
     """Returns a JSON representation of a ``TktUser`` with ``username``.
     """
     if request.method == 'GET':
+        fields = TktUserSerializer.parse_fields(request.query_params.get('fields'))
+        users = TktUserSerializer.prepare_queryset(TktUser.objects.filter(user__username=username))
+        if fields is not None:
+            users = TktUserSerializer.prune_queryset(users, fields)
         try:
-            user = User.objects.get(username=username).tktuser
+            user = users.get()
         except:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
@@ -83,18 +176,21 @@ def user_info(request, username):
         # Users can only access own info
         # TODO: Consider adding event enrollment checks so admins and agents
         #       can only access users registered to assigned events
-        if not request.user.is_superuser and hasattr(request.user, 'tktuser'):
-            if request.user.tktuser.uuid != user.uuid:
+        if not request.user.is_superuser and roles.get_role(request) == roles.USER:
+            own = roles.get_profile(request, roles.USER)
+            # Compared by primary key, which is loaded whatever the fields
+            if own is None or own.pk != user.pk:
                 return Response(status=status.HTTP_403_FORBIDDEN)
         
-        serializer = TktUserSerializer(user)
+        serializer = TktUserSerializer(user, fields=fields)
         return Response(serializer.data, status.HTTP_200_OK)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@_modification_validators(_user_events_modified)
 def user_events(request, username):
     """Queries a ``TktUser`` with ``username``, then returns a JSON response
-    containing all ``Event`` objects referenced by the queried ``TktUser``.
+    containing a page of the ``Event`` objects referenced by the queried ``TktUser``.
     """
     try:
         user = User.objects.get(username=username).tktuser
@@ -103,15 +199,13 @@ def user_events(request, username):
                         status.HTTP_404_NOT_FOUND)
 
     if request.method == 'GET':
-        # TODO: Consider defining separate serializers for list/detail view
-        serializer = EventSerializer(list(user.events.all()), many=True)
-        return Response(serializer.data, status.HTTP_200_OK)
+        return paginated_response(request, user.events.all(), EventListSerializer)
     
     """
     elif request.method == 'POST':
         # TODO: Admins should only be able to register users to events that
         #       it is responsible for
-        if not request.user.is_superuser and not hasattr(request.user, 'tktadmin'):
+        if not request.user.is_superuser and roles.get_role(request) != roles.ADMIN:
             return Response({'error': 'Only admin accounts can enroll users to events.'},
                             status.HTTP_403_FORBIDDEN)
         try:
@@ -125,16 +219,29 @@ def user_events(request, username):
 
 @api_view(['GET', 'POST'])
 @permission_classes([IsAuthenticated])
+@condition(etag_func=_event_list_etag)
 def event(request):
-    """``GET``: Returns a JSON representation of all ``Event`` objects.
+    """``GET``: Returns a JSON representation of a page of ``Event`` objects,
+    rendered once and then served from ``cache`` until events change.
     ``POST``: Creates a new ``Event``.
     """
     if request.method == 'GET':
-        serializer = EventSerializer(list(Event.objects.all()), many=True)
-        return Response(serializer.data)
+        def build():
+            response = paginated_response(request, Event.objects.all(), EventListSerializer)
+            return FastJSONRenderer().render(response.data), response.get('Link')
+        # Hashed, as cursors are client input which may not be valid in keys
+        page = hashlib.blake2b('{}\n{}\n{}'.format(request.query_params.get('cursor', ''),
+                                                   request.query_params.get('page_size', ''),
+                                                   request.query_params.get('fields', ''))
+                               .encode(), digest_size=16).hexdigest()
+        body, link = cache.get_or_build(cache.LIST_SCOPE, page, build)
+        response = HttpResponse(body, content_type='application/json')
+        if link is not None:
+            response['Link'] = link
+        return response
 
     elif request.method == 'POST':
-        if not request.user.is_superuser and not hasattr(request.user, 'tktadmin'):
+        if not request.user.is_superuser and roles.get_role(request) != roles.ADMIN:
             return Response(status=status.HTTP_403_FORBIDDEN)
         serial = EventSerializer(data=request.data)
         if serial.is_valid():
@@ -144,21 +251,31 @@ def event(request):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@_modification_validators(_event_modified)
 def event_info(request, event_uuid):
-    """Returns a JSON representation of an ``Event`` with ``event_uuid``.
+    """Returns a JSON representation of an ``Event`` with ``event_uuid``,
+    rendered once and then served from ``cache`` until the event changes.
     """
     if request.method == 'GET':
+        fields = EventSerializer.parse_fields(request.query_params.get('fields'))
+        def build():
+            events = Event.objects.filter(uuid=event_uuid)
+            if fields is not None:
+                events = EventSerializer.prune_queryset(events, fields)
+            return FastJSONRenderer().render(EventSerializer(events.get(), fields=fields).data)
+        name = 'detail' if fields is None else 'detail:' + ','.join(fields)
         try:
-            event = EventSerializer(Event.objects.get(uuid=event_uuid))
-        except:
+            body = cache.get_or_build(str(event_uuid), name, build)
+        except Event.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        return Response(event.data, status.HTTP_200_OK)
+        return HttpResponse(body, content_type='application/json')
 
 @api_view(['GET', 'POST'])
 @permission_classes([IsAuthenticated])
+@_modification_validators(_event_users_modified)
 def event_users(request, event_uuid):
     """First queries an ``Event`` with ``event_uuid``. Then on
-    ``GET``: Returns a JSON representation of all ``TktUser``s that reference
+    ``GET``: Returns a JSON representation of a page of the ``TktUser``s that reference
     the queried ``Event``.
     ``POST``: Adds a reference to the queried ``Event`` to a ``TktUser`` with
     ``user_uuid``.
@@ -171,13 +288,12 @@ def event_users(request, event_uuid):
                         status.HTTP_404_NOT_FOUND)
 
     if request.method == 'GET':
-        if not request.user.is_superuser and hasattr(request.user, 'tktuser'):
+        if not request.user.is_superuser and roles.get_role(request) == roles.USER:
             return Response(status=status.HTTP_403_FORBIDDEN)
-        users = TktUserSerializer(event.tktuser_set.all(), many=True)
-        return Response(users.data)
+        return paginated_response(request, event.tktuser_set.all(), TktUserListSerializer)
 
     elif request.method == 'POST':
-        if not request.user.is_superuser and not hasattr(request.user, 'tktadmin'):
+        if not request.user.is_superuser and roles.get_role(request) != roles.ADMIN:
             return Response(status=status.HTTP_403_FORBIDDEN)
         try:
             user = TktUser.objects.get(uuid=request.data['user_uuid'])
@@ -187,28 +303,94 @@ def event_users(request, event_uuid):
         user.events.add(event)
         return Response(TktUserSerializer(user).data, status.HTTP_200_OK)
         
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def event_users_bulk(request, event_uuid):
+    """Registers many ``TktUser``s to an ``Event`` with ``event_uuid`` at once.
+    Accepts either a JSON array of user uuids (``application/json``), or one
+    JSON string per line (``application/x-ndjson``), which is processed as it
+    is streamed in. Returns the outcome of every uuid:
+    ``{'registered': <int>, 'already_registered': [<str>], 'unknown': [<str>]}``
+    where uuids not listed were registered. NDJSON is registered in chunks that
+    are committed as they are read, so a malformed line fails the request with
+    the outcome of the lines before it, which stay registered.
+    """
+    if not request.user.is_superuser and roles.get_role(request) != roles.ADMIN:
+        return Response(status=status.HTTP_403_FORBIDDEN)
+    try:
+        event = Event.objects.get(uuid=event_uuid)
+    except:
+        return Response({'error': 'Event does not exist.'},
+                        status.HTTP_404_NOT_FOUND)
+
+    # Bodies without a Content-Length are read as empty, so that chunked ones
+    # would register no one
+    if request.stream is None and 'HTTP_TRANSFER_ENCODING' in request.META:
+        return Response({'error': 'Content-Length required.'},
+                        status.HTTP_411_LENGTH_REQUIRED)
+    if request.content_type.startswith('application/x-ndjson'):
+        stream = request.stream
+        lines = (line for line in (stream if stream is not None else ()) if line.strip())
+        try:
+            result = registrations.register_users(event, (json.loads(line) for line in lines))
+        except registrations.PartialRegistrationError as e:
+            # The lines before the malformed one are registered
+            return Response({'error': 'Malformed payload.', **e.result},
+                            status.HTTP_400_BAD_REQUEST)
+    else:
+        if not isinstance(request.data, list):
+            return Response({'error': 'Malformed payload.'}, status.HTTP_400_BAD_REQUEST)
+        result = registrations.register_users(event, request.data)
+    return Response(result, status.HTTP_200_OK)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+def event_users_export(request, event_uuid):
+    """Streams the ``TktUser``s registered to an ``Event`` with ``event_uuid``, as
+    CSV or NDJSON depending on the ``type`` query parameter (``ndjson`` by default).
+    """
+    if not request.user.is_superuser and roles.get_role(request) == roles.USER:
+        return Response(status=status.HTTP_403_FORBIDDEN)
+    try:
+        event = Event.objects.get(uuid=event_uuid)
+    except:
+        return Response({'error': 'Event does not exist.'},
+                        status.HTTP_404_NOT_FOUND)
+    # Not format, which DRF reserves for selecting renderers
+    format = request.query_params.get('type', 'ndjson')
+    if format not in exports.FORMATS:
+        return Response({'error': 'Unsupported export type.'},
+                        status.HTTP_400_BAD_REQUEST)
+
+    response = StreamingHttpResponse(exports.export_users(event, format),
+                                     content_type=exports.FORMATS[format])
+    response['Content-Disposition'] = f'attachment; filename="event-{event.uuid}-users.{format}"'
+    return response
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@_modification_validators(_event_agents_modified)
 def event_agents(request, event_uuid):
-    """Returns a JSON representation of all ``TktAgent``s that reference
+    """Returns a JSON representation of a page of the ``TktAgent``s that reference
     an ``Event`` with ``event_uuid``.
     """
     if request.method == 'GET':
-        if not request.user.is_superuser and not hasattr(request.user, 'tktadmin'):
+        if not request.user.is_superuser and roles.get_role(request) != roles.ADMIN:
             return Response(status=status.HTTP_403_FORBIDDEN)
         try:
             event = Event.objects.get(uuid=event_uuid)
         except:
             return Response({'error': 'Event does not exist.'},
                             status.HTTP_404_NOT_FOUND)
-        agents = TktAgentSerializer(event.tktagent_set.all(), many=True)
-        return Response(agents.data, status.HTTP_200_OK)
+        agents = event.tktagent_set.select_related('agent')
+        return paginated_response(request, agents, TktAgentSerializer)
 
 @api_view(['GET', 'POST'])
 @permission_classes([IsAuthenticated])
+@condition(etag_func=_event_admins_etag)
 def event_admins(request, event_uuid):
     """First queries an ``Event`` with ``event_uuid``. Then on
-    ``GET``: Returns a JSON representation of all ``TktAdmin``s that reference
+    ``GET``: Returns a JSON representation of a page of the ``TktAdmin``s that reference
     the queried ``Event``.
     ``POST``: Adds a reference to the queried ``Event`` to a ``TktAdmin`` with
     ``admin_username``.
@@ -221,13 +403,13 @@ def event_admins(request, event_uuid):
                         status.HTTP_404_NOT_FOUND)
 
     if request.method == 'GET':
-        if not request.user.is_superuser and hasattr(request.user, 'tktuser'):
+        if not request.user.is_superuser and roles.get_role(request) == roles.USER:
             return Response(status=status.HTTP_403_FORBIDDEN)
-        admins = TktAdminSerializer(event.tktadmin_set.all(), many=True)
-        return Response(admins.data, status.HTTP_200_OK)
+        admins = TktAdminSerializer.prepare_queryset(TktAdmin.objects.all()).filter(events=event)
+        return paginated_response(request, admins, TktAdminSerializer)
 
     elif request.method == 'POST':
-        if not request.user.is_superuser and not hasattr(request.user, 'tktadmin'):
+        if not request.user.is_superuser and roles.get_role(request) != roles.ADMIN:
             return Response(status=status.HTTP_403_FORBIDDEN)
         try:
             admin = User.objects.get(username=request.data['admin_username']).tktadmin
@@ -236,3 +418,42 @@ def event_admins(request, event_uuid):
                             status.HTTP_404_NOT_FOUND)
         admin.events.add(event)
         return Response(TktAdminSerializer(admin).data, status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def import_entities(request, kind):
+    """Imports ``TktUser``s or ``Event``s, depending on ``kind``, from CSV
+    (``text/csv``, with a header row) or NDJSON (``application/x-ndjson``) rows,
+    which are processed as they are streamed in. Rows have the fields accepted by
+    ``UserSerializer`` or ``EventSerializer``. The ``skip`` query parameter skips
+    leading rows, to resume an import that failed after committing them.
+    Returns the progress of the import, see ``imports.BulkImport``.
+    """
+    if not request.user.is_superuser and roles.get_role(request) != roles.ADMIN:
+        return Response(status=status.HTTP_403_FORBIDDEN)
+    if request.content_type.startswith('text/csv'):
+        format = 'csv'
+    elif request.content_type.startswith('application/x-ndjson'):
+        format = 'ndjson'
+    else:
+        return Response({'error': 'Unsupported content type.'},
+                        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    try:
+        skip = int(request.query_params.get('skip', 0))
+        if skip < 0:
+            raise ValueError
+    except ValueError:
+        return Response({'error': 'Malformed skip parameter.'}, status.HTTP_400_BAD_REQUEST)
+
+    job = imports.BulkImport(kind, skip)
+    lines = request.stream if request.stream is not None else ()
+    try:
+        for _ in job.run(imports.read_rows(lines, format)):
+            pass
+    except (csv.Error, UnicodeDecodeError):
+        return Response({'error': 'Malformed payload.', 'rows': job.progress['rows']},
+                        status.HTTP_400_BAD_REQUEST)
+    except DatabaseError:
+        return Response({'error': 'Import failed.', 'rows': job.progress['rows']},
+                        status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return Response(job.progress, status.HTTP_200_OK)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class OtphandlerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'otphandler'
+
+    def ready(self):
+        from . import bundles, codeindex, roster, tokens
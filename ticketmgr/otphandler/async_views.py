@@ -0,0 +1,114 @@
+"""Asynchronous versions of the ticket views, for deployments behind an ASGI server.
+Database queries go through the async ORM interface and TOTP verification runs
+in a worker thread, so waiting on either does not block the event loop.
+
+DRF does not support async views, so these are plain Django views that mirror
+the requests and responses of their counterparts in ``otphandler.views``.
+"""
+
+import base64
+import json
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from entityhandler.models import *
+from otphandler import services
+from rest_framework import status
+
+# Neither view relies on the session of the client, so like their DRF
+# counterparts with anonymous clients, they are not subject to CSRF checks.
+# csrf_exempt() can not be used as it wraps views with a synchronous function.
+
+def _request_data(request) -> dict:
+    """Return the parsed body of a JSON or form-encoded request, or None if
+    the body is malformed."""
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
+
+def _method_not_allowed(request) -> JsonResponse:
+    response = JsonResponse({'detail': f'Method "{request.method}" not allowed.'},
+                            status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    response['Allow'] = 'POST, OPTIONS'
+    return response
+
+async def ticket_new(request):
+    """Asynchronous version of ``otphandler.views.ticket_new``.
+    JSON format: {'user_uuid': <str>, 'event_uuid': <str>}
+    """
+    if request.method != 'POST':
+        return _method_not_allowed(request)
+    data = _request_data(request)
+    if data is None:
+        return JsonResponse({'error': 'Malformed request body.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        registration = await services.aresolve_registration(data.get('user_uuid'),
+                                                            data.get('event_uuid'))
+    except TktUser.DoesNotExist:
+        return JsonResponse({'error': 'User does not exist.'},
+                            status=status.HTTP_404_NOT_FOUND)
+    except Event.DoesNotExist:
+        return JsonResponse({'error': 'Event does not exist.'},
+                            status=status.HTTP_404_NOT_FOUND)
+
+    if registration is None:
+        return JsonResponse({'error': 'User not registered to event.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+    tkt_secret = bytes(registration.secret)
+    return JsonResponse({'success': base64.b32encode(tkt_secret).decode()},
+                        status=status.HTTP_200_OK)
+
+ticket_new.csrf_exempt = True
+
+async def ticket_auth(request):
+    """Asynchronous version of ``otphandler.views.ticket_auth``.
+    JSON format: {'user_uuid': <str>, 'event_uuid': <str>, 'ticket_totp': <str>}
+    """
+    if request.method != 'POST':
+        return _method_not_allowed(request)
+    data = _request_data(request)
+    if data is None:
+        return JsonResponse({'error': 'Malformed request body.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        registration = await services.aresolve_registration(data.get('user_uuid'),
+                                                            data.get('event_uuid'))
+    except TktUser.DoesNotExist:
+        return JsonResponse({'error': 'User does not exist.'},
+                            status=status.HTTP_404_NOT_FOUND)
+    except Event.DoesNotExist:
+        return JsonResponse({'error': 'Event does not exist.'},
+                            status=status.HTTP_404_NOT_FOUND)
+
+    totp = data.get('ticket_totp')
+    if totp is None:
+        return JsonResponse({'error': 'TOTP code was not supplied.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+    if registration is None:
+        return JsonResponse({'error': 'User is not registered to event.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+    tkt_secret = bytes(registration.secret)
+    try:
+        # Blocks on the shared cache rather than on the HMAC computation itself.
+        # Does not touch the database, so it need not run in the thread of the
+        # other synchronous code of the request
+        drift = await sync_to_async(services.verify_ticket, thread_sensitive=False)(
+                    tkt_secret, totp, registration.event_id, registration.tktuser_id)
+    except services.CodeReplayedError:
+        return JsonResponse({'error': 'TOTP code was already used.'},
+                            status=status.HTTP_409_CONFLICT)
+    if drift is not None:
+        return JsonResponse({'ticket_is_valid': True, 'drift': drift},
+                            status=status.HTTP_200_OK)
+    else:
+        return JsonResponse({'ticket_is_valid': False},
+                            status=status.HTTP_200_OK)
+
+ticket_auth.csrf_exempt = True
@@ -0,0 +1,232 @@
+"""Microbenchmarks of the TOTP core, the ticket verification paths and the
+serialization of list responses.
+
+Benchmarks create their own fixtures, so they must run against a throwaway
+database. ``python manage.py benchmark`` sets up a test database to run them,
+and can save the results as JSON to compare them between commits.
+
+Every benchmark case is timed in samples of ``number`` consecutive calls.
+Throughput is computed over all samples, while latency percentiles are computed
+from the mean call duration of each sample, as individual calls of the
+primitives are too short to be timed accurately.
+"""
+
+import gc
+import hmac
+import json
+import os
+import time
+import tracemalloc
+import uuid
+from django.contrib.auth.models import User
+from django.test import Client, RequestFactory
+from django.utils import timezone
+from entityhandler.models import Event, TktUser
+from entityhandler.renderers import FastJSONRenderer
+from entityhandler.serializers import (EventListSerializer, EventSerializer,
+                                       TktUserListSerializer, TktUserSerializer)
+from otphandler import fast_views, roster, services, views
+from rest_framework.renderers import JSONRenderer
+
+# Code sent to the verification paths. Practically never valid, so every
+# request is fully verified without being rejected as a replay.
+INVALID_TOTP = '000000'
+# Number of secrets that batched code generation is benchmarked with.
+BATCH_SIZE = 100
+# Number of rows of the list pages that serialization is benchmarked with,
+# so that the per-row cost is the call duration divided by it.
+PAGE_ROWS = 100
+
+def _create_registration() -> tuple:
+    """Return a new (TktUser, Event) pair, with the user registered to the event."""
+    user = TktUser.objects.create(user=User.objects.create_user(
+                                      f'benchmark{User.objects.count()}'))
+    event = Event.objects.create(title='Benchmark',
+                                 description='Benchmark event',
+                                 datetime=timezone.now())
+    user.events.add(event)
+    return user, event
+
+def _call_view(view, request):
+    """Call view like the request handler does, including response rendering."""
+    response = view(request)
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+def primitive_cases() -> dict:
+    """Return the callables that benchmark the TOTP primitives of ``otphandler.services``."""
+    user, event = _create_registration()
+    secret = services.generate_ticket_secret(user, event)
+    secrets = [services._generate_secret(services.SECRET_LENGTH) for _ in range(BATCH_SIZE)]
+    message = services._get_counter_bytes()
+    digest = hmac.digest(secret, message, services.HASH_ALG)
+    # Codes of counters this far in the past are never cached
+    uncached = services._get_counter() - services.CODE_CACHE_STEPS - 10
+
+    return {
+        'hmac.digest': lambda: hmac.digest(secret, message, services.HASH_ALG),
+        'services._builtin_hmac': lambda: services._builtin_hmac(secret, message),
+        'services._custom_hmac': lambda: services._custom_hmac(secret, message),
+        'services._truncate': lambda: services._truncate(digest),
+        'services.generate_totp (builtin)':
+            lambda: services.generate_totp(secret, False, uncached),
+        'services.generate_totp (custom)':
+            lambda: services.generate_totp(secret, True, uncached),
+        'services.generate_totp (cached)': lambda: services.generate_totp(secret),
+        f'services.generate_totp_batch ({BATCH_SIZE})':
+            lambda: services.generate_totp_batch(secrets, uncached),
+        'services.generate_ticket_secret':
+            lambda: services.generate_ticket_secret(user, event),
+    }
+
+def ticket_auth_cases() -> dict:
+    """Return the callables that benchmark the verification of one ticket through
+    each path, along with the service calls that every path has to make."""
+    user, event = _create_registration()
+    secret = services.generate_ticket_secret(user, event)
+    event_roster = roster.load_roster(event.pk)
+    factory = RequestFactory()
+    client = Client()
+    json_body = json.dumps({'user_uuid': str(user.uuid),
+                            'event_uuid': str(event.uuid),
+                            'ticket_totp': INVALID_TOTP})
+    binary_body = user.uuid.bytes + event.uuid.bytes + INVALID_TOTP.encode()
+
+    def post(path, body, content_type):
+        return lambda: factory.post(path, body, content_type=content_type)
+    drf_request = post('/api/ticket/auth', json_body, 'application/json')
+    fast_json_request = post('/api/ticket/auth/fast', json_body, 'application/json')
+    fast_binary_request = post('/api/ticket/auth/fast', binary_body,
+                               'application/octet-stream')
+
+    return {
+        'services.resolve_registration':
+            lambda: services.resolve_registration(user.uuid, event.uuid),
+        'roster.EventRoster.lookup':
+            lambda: event_roster.lookup(user.uuid.bytes),
+        'services.verify_ticket':
+            lambda: services.verify_ticket(secret, INVALID_TOTP, event.pk, user.pk),
+        'views.ticket_auth':
+            lambda: _call_view(views.ticket_auth, drf_request()),
+        'fast_views.ticket_auth (JSON)':
+            lambda: _call_view(fast_views.ticket_auth, fast_json_request()),
+        'fast_views.ticket_auth (binary)':
+            lambda: _call_view(fast_views.ticket_auth, fast_binary_request()),
+        'client /api/ticket/auth':
+            lambda: client.post('/api/ticket/auth', json_body,
+                                content_type='application/json'),
+    }
+
+def list_rendering_cases() -> dict:
+    """Return the callables that benchmark the serialization and rendering of a
+    page of ``PAGE_ROWS`` events and users, by the model serializers and the
+    ``values()`` serializers of list endpoints. Rows are fetched beforehand,
+    so no case queries the database."""
+    user, event = _create_registration()
+    users = [user] + [TktUser(user=User.objects.create_user(f'benchmark{User.objects.count()}'))
+                      for _ in range(PAGE_ROWS - 1)]
+    TktUser.objects.bulk_create(users[1:])
+    Event.objects.bulk_create([Event(title='Benchmark', description='Benchmark event',
+                                     datetime=timezone.now())
+                               for _ in range(PAGE_ROWS - 1)])
+    event.tktuser_set.add(*TktUser.objects.all())
+
+    event_fields = EventListSerializer.parse_fields(None)
+    user_fields = TktUserListSerializer.parse_fields(None)
+    events = list(Event.objects.order_by('pk')[:PAGE_ROWS])
+    event_rows = list(EventListSerializer.prune_queryset(Event.objects.order_by('pk'),
+                                                         event_fields)[:PAGE_ROWS])
+    tktusers = list(TktUserSerializer.prepare_queryset(event.tktuser_set.order_by('pk')))
+    tktuser_rows = list(TktUserListSerializer.prune_queryset(event.tktuser_set.order_by('pk'),
+                                                             user_fields))
+    json_renderer = JSONRenderer()
+    fast_renderer = FastJSONRenderer()
+
+    def render(renderer, serializer_class, page, **kwargs):
+        return lambda: renderer.render(serializer_class(page, many=True, **kwargs).data)
+    return {
+        'EventSerializer + JSONRenderer': render(json_renderer, EventSerializer, events),
+        'EventListSerializer + JSONRenderer':
+            render(json_renderer, EventListSerializer, event_rows, fields=event_fields),
+        'EventListSerializer + FastJSONRenderer':
+            render(fast_renderer, EventListSerializer, event_rows, fields=event_fields),
+        'TktUserSerializer + JSONRenderer': render(json_renderer, TktUserSerializer, tktusers),
+        'TktUserListSerializer + JSONRenderer':
+            render(json_renderer, TktUserListSerializer, tktuser_rows, fields=user_fields),
+        'TktUserListSerializer + FastJSONRenderer':
+            render(fast_renderer, TktUserListSerializer, tktuser_rows, fields=user_fields),
+    }
+
+# Maps suite names to the functions that set up their cases.
+SUITES = {
+    'primitives': primitive_cases,
+    'ticket_auth': ticket_auth_cases,
+    'list_rendering': list_rendering_cases,
+}
+
+def _percentile(values: list, fraction: float) -> float:
+    """Return the value at fraction of the sorted values."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def measure(func, number: int = 1000, samples: int = 20) -> dict:
+    """Times a callable.
+
+    Args:
+        func (callable): The callable to time, called without arguments.
+        number (int, optional): Number of calls per sample. Defaults to 1000.
+        samples (int, optional): Number of samples. Defaults to 20.
+
+    Returns:
+        dict: ``ops_per_sec`` and the ``p50_us``, ``p95_us`` and ``p99_us``
+              percentiles of the mean call duration of the samples, in microseconds.
+    """
+    func()
+    durations = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(samples):
+            start = time.perf_counter_ns()
+            for _ in range(number):
+                func()
+            durations.append((time.perf_counter_ns() - start) / number / 1000)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    total_us = sum(durations)
+    durations.sort()
+    return {'ops_per_sec': 1e6 * samples / total_us,
+            'p50_us': _percentile(durations, 0.5),
+            'p95_us': _percentile(durations, 0.95),
+            'p99_us': _percentile(durations, 0.99)}
+
+def run(cases: dict, number: int = 1000, samples: int = 20) -> list:
+    """Times every case of a benchmark suite.
+
+    Args:
+        cases (dict): Maps case names to the callables to time.
+        number (int, optional): Number of calls per sample. Defaults to 1000.
+        samples (int, optional): Number of samples per case. Defaults to 20.
+
+    Returns:
+        list: Dicts of the ``name`` and measure() results of every case,
+              in the order of cases.
+    """
+    return [dict(name=name, **measure(func, number, samples))
+            for name, func in cases.items()]
+
+def roster_memory(size: int = 100000) -> int:
+    """Return the memory used by an ``EventRoster`` of size registrations, in bytes.
+    The roster is built from generated rows, so no database is needed."""
+    rows = [(uuid.uuid4(), user_id, os.urandom(services.SECRET_LENGTH))
+            for user_id in range(1, size + 1)]
+    tracemalloc.start()
+    try:
+        event_roster = roster.EventRoster(0, 0, rows)
+        used, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del event_roster
+    return used
@@ -0,0 +1,173 @@
+"""Offline verification bundles for gate scanners.
+
+A bundle lets a scanner verify tickets of one event without connectivity and
+without ever receiving ticket secrets. For every registered user it contains
+salted, truncated hashes of the user's codes for the next ``steps`` time steps.
+Bundles are big-endian binary blobs laid out as follows:
+
+    header   magic (4s) version (B) digest length (B) steps (H)
+             start counter (Q) sequence number (Q) salt (16s)
+             removed user count (I) record count (I)
+    removed  user uuid (16s), for each removed user
+    records  user uuid (16s) followed by steps digests, for each user
+
+The digest of a code is the first ``digest length`` bytes of
+``sha256(salt + counter (Q) + user uuid (16s) + code (ASCII))``.
+A scanner verifies a code of a user by hashing it for the current counter
+(and its neighbors, to tolerate clock skew) and comparing it with the digests
+of the user's record.
+
+Incremental refreshes contain only the users whose registration changed after
+the sequence number of a previous bundle of the same event, along with the
+users that were unregistered since. The salt only depends on the event and the start counter,
+so records of refreshes with the same start counter are interchangeable.
+
+Note that with 10^OTP_LENGTH possible codes, the codes of a bundle can be
+recovered by brute force. Bundles protect the secrets, not the codes, and
+should be handled as short-lived credentials.
+"""
+
+import hashlib
+import hmac
+import struct
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from entityhandler.models import Event, Registration, TktUser
+from entityhandler.signals import registrations_changed
+from otphandler import services
+from otphandler.models import RosterChange
+
+BUNDLE_MAGIC = b'TKTB'
+BUNDLE_VERSION = 1
+# Length of stored code digests, in bytes.
+DIGEST_LENGTH = 8
+# Default and maximum number of time steps covered by a bundle.
+BUNDLE_STEPS = 120
+BUNDLE_MAX_STEPS = 960
+# Length of the bundle salt, in bytes.
+SALT_LENGTH = 16
+
+_HEADER = struct.Struct('>4sBBHQQ16sII')
+
+def _bundle_salt(event: Event, start: int) -> bytes:
+    """Return the salt of bundles of an event starting at counter start."""
+    message = b'otphandler.bundles' + event.uuid.bytes + start.to_bytes(8, 'big')
+    return hmac.digest(settings.SECRET_KEY.encode(), message, 'sha256')[:SALT_LENGTH]
+
+def code_digest(salt: bytes, counter: int, user_uuid: bytes, code: str) -> bytes:
+    """Return the digest of a code as stored in bundles.
+
+    Args:
+        salt (bytes): Salt of the bundle.
+        counter (int): The time counter of the code.
+        user_uuid (bytes): The 16-byte uuid of the user.
+        code (str): The TOTP code.
+
+    Returns:
+        bytes: Digest of length DIGEST_LENGTH.
+    """
+    digest = hashlib.sha256(salt + counter.to_bytes(8, 'big') + user_uuid + code.encode())
+    return digest.digest()[:DIGEST_LENGTH]
+
+def build_bundle(event: Event, steps: int = BUNDLE_STEPS, start: int = None,
+                 since: int = None) -> bytes:
+    """Builds the offline verification bundle of an event.
+
+    Args:
+        event (Event): The event to build the bundle for.
+        steps (int, optional): Number of time steps covered by the bundle.
+                               Defaults to BUNDLE_STEPS.
+        start (int, optional): The first time counter covered by the bundle.
+                               Defaults to the current time counter.
+        since (int, optional): Sequence number of a previous bundle. If supplied,
+                               only changes made after that bundle are included.
+
+    Returns:
+        bytes: The encoded bundle.
+    """
+    if start is None:
+        start = services._get_counter()
+    # Read before the roster, so that concurrent changes are part of the next refresh
+    seq = RosterChange.objects.seq(event.pk)
+
+    registrations = Registration.objects.filter(event_id=event.pk)
+    removed = []
+    if since is not None:
+        changes = RosterChange.objects.since(event.pk, since)
+        removed = [u for u, registered in changes.values_list('user_uuid', 'registered')
+                   if not registered]
+        registrations = registrations.filter(
+                            tktuser__uuid__in=changes.filter(registered=True)
+                                                     .values('user_uuid'))
+    roster = list(registrations.values_list('tktuser__uuid', 'secret'))
+
+    salt = _bundle_salt(event, start)
+    secrets = [bytes(secret) for _, secret in roster]
+    records = [[user_uuid.bytes] for user_uuid, _ in roster]
+    for counter in range(start, start + steps):
+        codes = services.generate_totp_batch(secrets, counter)
+        for record, code in zip(records, codes):
+            record.append(code_digest(salt, counter, record[0], code))
+
+    header = _HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, DIGEST_LENGTH, steps,
+                          start, seq, salt, len(removed), len(records))
+    return b''.join([header]
+                    + [user_uuid.bytes for user_uuid in removed]
+                    + [b''.join(record) for record in records])
+
+def parse_bundle(bundle: bytes) -> dict:
+    """Decodes a bundle built by build_bundle.
+    Reference implementation of the scanner side of the format.
+
+    Args:
+        bundle (bytes): The encoded bundle.
+
+    Returns:
+        dict: The header fields, the list of ``removed`` user uuids and
+              ``records``, which maps user uuids to lists of digests.
+    """
+    (magic, version, digest_len, steps, start,
+     seq, salt, n_removed, n_records) = _HEADER.unpack_from(bundle)
+    if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+        raise ValueError('supplied bytes are not a version ' + str(BUNDLE_VERSION) + ' bundle')
+
+    offset = _HEADER.size
+    removed = [bundle[offset + 16 * i:offset + 16 * (i + 1)] for i in range(n_removed)]
+    offset += 16 * n_removed
+    record_len = 16 + steps * digest_len
+    records = {}
+    for i in range(n_records):
+        record = bundle[offset + record_len * i:offset + record_len * (i + 1)]
+        records[record[:16]] = [record[16 + digest_len * j:16 + digest_len * (j + 1)]
+                                for j in range(steps)]
+
+    return {'steps': steps, 'start': start, 'seq': seq, 'salt': salt,
+            'removed': removed, 'records': records}
+
+@receiver(registrations_changed)
+def _record_roster_changes(sender, action, pairs, **kwargs):
+    uuids = dict(TktUser.objects.filter(pk__in={user_id for _, user_id in pairs})
+                                .values_list('pk', 'uuid'))
+    changes = [RosterChange(event_id=event_id, user_uuid=uuids[user_id],
+                            registered=action == 'add')
+               for event_id, user_id in pairs if user_id in uuids]
+    if not changes:
+        return
+
+    # Replace the previous change of each pair, so that ids stay monotonic
+    by_event = {}
+    for change in changes:
+        by_event.setdefault(change.event_id, []).append(change.user_uuid)
+    stale = Q()
+    for event_id, user_uuids in by_event.items():
+        stale |= Q(event_id=event_id, user_uuid__in=user_uuids)
+    with transaction.atomic(savepoint=False):
+        # Held until commit, so that changes of an event commit in the order of
+        # their ids, see RosterChange. Locked in order to avoid deadlocks.
+        list(Event.objects.select_for_update().filter(pk__in=by_event)
+                                              .order_by('pk')
+                                              .values_list('pk', flat=True))
+        RosterChange.objects.filter(stale).delete()
+        RosterChange.objects.bulk_create(changes)
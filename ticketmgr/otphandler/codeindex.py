@@ -0,0 +1,112 @@
+"""Per-event index of the current TOTP code of every registered user.
+Allows tickets to be verified from the TOTP code alone.
+"""
+
+import threading
+from django.dispatch import receiver
+from entityhandler.models import Registration
+from entityhandler.signals import registrations_changed
+from otphandler import services
+
+class EventCodeIndex:
+    """Maps the TOTP codes accepted during a time step to the users that generate them.
+
+    Attributes:
+        counter (int): The time counter that the codes were generated for.
+        codes (dict): Maps each code to a tuple of (``TktUser`` uuid,
+                      ``TktUser`` primary key, drift) tuples.
+                      Tuples longer than one indicate a collision.
+    """
+    __slots__ = ('counter', 'codes')
+
+    def __init__(self, counter: int, codes: dict):
+        self.counter = counter
+        self.codes = codes
+
+# Maps Event primary keys to their EventCodeIndex.
+_indexes = {}
+# Maps Event primary keys to the locks that indexes are built under, so that
+# building the index of one event does not block lookups at other events.
+_build_locks = {}
+# Maps Event primary keys to the number of times their index was invalidated,
+# so that indexes built from rosters read before an invalidation are discarded.
+_generations = {}
+# Guards the above, and is never held while building indexes.
+_indexes_lock = threading.Lock()
+
+def build_index(event_id: int, counter: int) -> EventCodeIndex:
+    """Builds the code index of an event for a time counter, containing the codes
+    of every time step within the verification window.
+    The roster of the event is fetched with a single query and the codes of
+    each time step are generated in one batched pass.
+
+    Args:
+        event_id (int): Primary key of the event to build the index for.
+        counter (int): The time counter to generate codes for.
+
+    Returns:
+        EventCodeIndex: The built index.
+    """
+    roster = list(Registration.objects.filter(event_id=event_id)
+                                      .values_list('tktuser__uuid', 'tktuser_id', 'secret'))
+    secrets = [bytes(secret) for _, _, secret in roster]
+    window = services.get_verify_window()
+    codes = {}
+    for drift in sorted(range(-window, window + 1), key=abs):
+        step_codes = services.generate_totp_batch(secrets, counter + drift)
+        for (user_uuid, user_id, _), code in zip(roster, step_codes):
+            matches = codes.get(code, ())
+            # Keep only the smallest drift if a user repeats a code across steps
+            if all(match[1] != user_id for match in matches):
+                codes[code] = matches + ((user_uuid, user_id, drift),)
+
+    return EventCodeIndex(counter, codes)
+
+def lookup(event_id: int, totp: str, counter: int = None) -> tuple:
+    """Returns all users registered to an event whose TOTP code is totp within
+    the verification window. The index of the event is rebuilt whenever the
+    time counter rolls over.
+
+    Args:
+        event_id (int): Primary key of the event that the code was scanned at.
+        totp (str): The scanned TOTP code.
+        counter (int, optional): The time counter at the center of the
+                                 verification window. Defaults to the current
+                                 time counter.
+
+    Returns:
+        tuple: (uuid, primary key, drift) tuples of the matching ``TktUser``s.
+               Empty if no user matches.
+    """
+    if counter is None:
+        counter = services._get_counter()
+    index = _indexes.get(event_id)
+    if index is None or index.counter != counter:
+        with _indexes_lock:
+            build_lock = _build_locks.setdefault(event_id, threading.Lock())
+        with build_lock:
+            index = _indexes.get(event_id)
+            if index is None or index.counter != counter:
+                generation = _generations.get(event_id, 0)
+                index = build_index(event_id, counter)
+                with _indexes_lock:
+                    # Drop indexes of events that have not been scanned at recently
+                    for stale_id in [k for k, v in _indexes.items() if v.counter < counter - 1]:
+                        del _indexes[stale_id]
+                    current = _indexes.get(event_id)
+                    if (_generations.get(event_id, 0) == generation
+                            and (current is None or current.counter <= counter)):
+                        _indexes[event_id] = index
+
+    return index.codes.get(totp, ())
+
+def invalidate(event_id: int):
+    """Discards the code index of an event."""
+    with _indexes_lock:
+        _indexes.pop(event_id, None)
+        _generations[event_id] = _generations.get(event_id, 0) + 1
+
+@receiver(registrations_changed)
+def _invalidate_on_registration(sender, pairs, **kwargs):
+    for event_id in {event_id for event_id, _ in pairs}:
+        invalidate(event_id)
@@ -0,0 +1,79 @@
+"""Replay protection for accepted TOTP codes.
+"""
+
+import threading
+from django.conf import settings
+from django.core.cache import caches
+
+# Maximum number of accepted codes remembered in-process per time step.
+SLOT_CAPACITY = 65536
+
+class ReplayLedger:
+    """Ledger of accepted codes, keyed by (event, user, time counter).
+
+    Accepted keys are remembered in-process in a ring buffer with one slot per
+    time step, so keys expire automatically as slots are reused by later time
+    steps, and memory stays bounded by ``slots * capacity`` keys. The in-process
+    ring answers repeated scans at the same worker without any I/O. Every key is
+    also added to a shared cache, which lets worker processes agree on which
+    codes have been used.
+
+    Attributes:
+        slots (int): Number of time steps remembered. Must exceed the number of
+                     time steps whose codes can be accepted at once.
+        interval (int): Duration of a time step, in seconds.
+        capacity (int): Maximum number of keys remembered in-process per time step.
+                        Keys beyond the capacity are only recorded in the shared cache.
+    """
+    __slots__ = ('slots', 'interval', 'capacity', '_counters', '_keys', '_lock')
+
+    def __init__(self, slots: int, interval: int, capacity: int = SLOT_CAPACITY):
+        self.slots = slots
+        self.interval = interval
+        self.capacity = capacity
+        self._counters = [None] * slots
+        self._keys = [set() for _ in range(slots)]
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Forgets all keys remembered in-process. The shared cache is left untouched."""
+        with self._lock:
+            self._counters = [None] * self.slots
+            self._keys = [set() for _ in range(self.slots)]
+
+    def _local_keys(self, counter: int) -> set:
+        """Return the keys of the slot of counter, recycling the slot if it
+        belongs to an older time step. Must be called with the lock held."""
+        slot = counter % self.slots
+        if self._counters[slot] != counter:
+            self._counters[slot] = counter
+            self._keys[slot] = set()
+        return self._keys[slot]
+
+    def claim(self, event_id: int, user_id: int, counter: int) -> bool:
+        """Records the use of the code of a user for an event and time counter.
+
+        Args:
+            event_id (int): Primary key of the event.
+            user_id (int): Primary key of the user.
+            counter (int): The time counter of the accepted code.
+
+        Returns:
+            bool: ``True`` if the code had not been used before, ``False`` otherwise.
+        """
+        key = (event_id, user_id)
+        with self._lock:
+            if key in self._local_keys(counter):
+                return False
+
+        shared = caches[getattr(settings, 'TICKET_LEDGER_CACHE', 'default')]
+        first_use = shared.add('otp:used:' + str(event_id) + ':' + str(user_id)
+                               + ':' + str(counter),
+                               1, timeout=self.slots * self.interval)
+
+        with self._lock:
+            keys = self._local_keys(counter)
+            if len(keys) < self.capacity:
+                keys.add(key)
+
+        return first_use
@@ -0,0 +1,115 @@
+"""Runs the microbenchmarks of ``otphandler.benchmarks`` against a throwaway
+test database, so that the configured database is left untouched.
+
+Example, comparing a change against results saved before it::
+
+    python manage.py benchmark --output before.json
+    python manage.py benchmark --compare before.json
+"""
+
+import json
+import platform
+import subprocess
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.utils import timezone
+from otphandler import benchmarks
+
+ROSTER_SIZE = 100000
+
+def _git_commit() -> str:
+    """Return the commit of the working tree, or None if it is not a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Command(BaseCommand):
+    help = ('Measures the throughput and latency of the TOTP primitives, the '
+            'ticket verification paths, including the overhead of DRF request processing, '
+            'and the serialization of list responses.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--suite', action='append', choices=sorted(benchmarks.SUITES),
+                            help='Suite to run; may be repeated. Defaults to all suites.')
+        parser.add_argument('--number', type=int, default=200,
+                            help='Number of calls per sample.')
+        parser.add_argument('--samples', type=int, default=20,
+                            help='Number of samples per case.')
+        parser.add_argument('--output', help='Path to save the results to, as JSON.')
+        parser.add_argument('--compare',
+                            help='Path of results saved by a previous run to compare against.')
+
+    def handle(self, *args, **options):
+        previous = {}
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    previous = {case['name']: case for case in json.load(f)['results']}
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f"Could not read {options['compare']}: {e}")
+
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        runner.setup_test_environment()
+        old_config = runner.setup_databases()
+        try:
+            results = []
+            for suite in options['suite'] or benchmarks.SUITES:
+                suite_results = benchmarks.run(benchmarks.SUITES[suite](),
+                                               options['number'], options['samples'])
+                if suite == 'list_rendering':
+                    for case in suite_results:
+                        case['p50_us_per_row'] = case['p50_us'] / benchmarks.PAGE_ROWS
+                results += suite_results
+        finally:
+            runner.teardown_databases(old_config)
+            runner.teardown_test_environment()
+        roster_bytes = benchmarks.roster_memory(ROSTER_SIZE)
+
+        self._report(results, previous)
+        self.stdout.write(f'EventRoster of {ROSTER_SIZE} registrations: '
+                          f'{roster_bytes / 2 ** 20:.1f} MiB')
+
+        if options['output']:
+            report = {
+                'created': timezone.now().isoformat(),
+                'commit': _git_commit(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'database': connection.vendor,
+                'number': options['number'],
+                'samples': options['samples'],
+                'results': results,
+                'roster_memory': {'registrations': ROSTER_SIZE, 'bytes': roster_bytes},
+            }
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results saved to {options['output']}")
+
+    def _report(self, results: list, previous: dict):
+        # Every view resolves the registration and verifies the code, the rest
+        # is the overhead of the view itself
+        timings = {case['name']: case['p50_us'] for case in results}
+        baseline = None
+        if 'services.resolve_registration' in timings and 'services.verify_ticket' in timings:
+            baseline = timings['services.resolve_registration'] + timings['services.verify_ticket']
+
+        self.stdout.write(f"{'case':<44}{'ops/s':>12}{'p50 us':>10}{'p95 us':>10}"
+                          f"{'p99 us':>10}{'overhead':>10}{'per row':>9}{'vs prev':>9}")
+        for case in results:
+            overhead = ''
+            if baseline is not None and case['name'].startswith(('views.', 'fast_views.')):
+                overhead = f"{case['p50_us'] - baseline:.1f}"
+            per_row = f"{case['p50_us_per_row']:.2f}" if 'p50_us_per_row' in case else ''
+            change = ''
+            if case['name'] in previous:
+                ratio = case['ops_per_sec'] / previous[case['name']]['ops_per_sec']
+                change = f'{ratio - 1:+.0%}'
+            self.stdout.write(f"{case['name']:<44}{case['ops_per_sec']:>12.0f}"
+                              f"{case['p50_us']:>10.2f}{case['p95_us']:>10.2f}"
+                              f"{case['p99_us']:>10.2f}{overhead:>10}{per_row:>9}{change:>9}")
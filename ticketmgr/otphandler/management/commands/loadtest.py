@@ -0,0 +1,104 @@
+"""Compares the sync and async ticket verification paths of a running server.
+
+Example, against a server that serves both paths::
+
+    python manage.py loadtest http://127.0.0.1:8000 \\
+        --user-uuid <uuid> --event-uuid <uuid> --requests 5000 --concurrency 200
+
+Run it once against a WSGI deployment (e.g. gunicorn) and once against an ASGI
+deployment (e.g. uvicorn) of the same database to compare both setups.
+"""
+
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+
+PATHS = {
+    'new': ('/api/ticket/new', '/api/ticket/new/async'),
+    'auth': ('/api/ticket/auth', '/api/ticket/auth/async'),
+}
+
+def _percentile(values: list, fraction: float) -> float:
+    """Return the value at fraction of the sorted values."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Command(BaseCommand):
+    help = ('Sends concurrent requests to the sync and async versions of a ticket '
+            'view of a running server and reports throughput and latencies.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_url', help='URL of the server, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--user-uuid', required=True)
+        parser.add_argument('--event-uuid', required=True)
+        parser.add_argument('--view', choices=sorted(PATHS), default='auth',
+                            help='View to load test. Defaults to auth.')
+        parser.add_argument('--requests', type=int, default=2000,
+                            help='Number of requests sent to each path.')
+        parser.add_argument('--concurrency', type=int, default=64,
+                            help='Number of requests in flight at once.')
+
+    def handle(self, *args, **options):
+        url = urllib.parse.urlsplit(options['base_url'])
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise CommandError('base_url must be an http(s) URL')
+        payload = {'user_uuid': options['user_uuid'],
+                   'event_uuid': options['event_uuid']}
+        if options['view'] == 'auth':
+            # Verified like any other code, but will practically never be accepted,
+            # so repeated requests are not rejected as replays
+            payload['ticket_totp'] = '000000'
+        body = json.dumps(payload).encode()
+
+        self.stdout.write(f"{'path':<28}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+                          f"{'p99 ms':>10}  statuses")
+        for path in PATHS[options['view']]:
+            elapsed, latencies, statuses = self._run(url, path, body,
+                                                     options['requests'],
+                                                     options['concurrency'])
+            latencies.sort()
+            self.stdout.write(f'{path:<28}{len(latencies) / elapsed:>10.1f}'
+                              f'{_percentile(latencies, 0.5) * 1000:>10.1f}'
+                              f'{_percentile(latencies, 0.95) * 1000:>10.1f}'
+                              f'{_percentile(latencies, 0.99) * 1000:>10.1f}'
+                              f'  {dict(sorted(statuses.items()))}')
+
+    def _run(self, url, path: str, body: bytes, requests: int, concurrency: int) -> tuple:
+        """Sends requests POST requests to path over concurrency keep-alive connections.
+
+        Returns:
+            tuple: Elapsed seconds, list of request latencies in seconds, and a
+                   dict that maps response statuses to their number of occurrences.
+        """
+        local = threading.local()
+        conn_class = (http.client.HTTPSConnection if url.scheme == 'https'
+                      else http.client.HTTPConnection)
+        headers = {'Content-Type': 'application/json'}
+
+        def send(_):
+            if not hasattr(local, 'conn'):
+                local.conn = conn_class(url.hostname, url.port, timeout=30)
+            start = time.perf_counter()
+            try:
+                local.conn.request('POST', path, body, headers)
+                response = local.conn.getresponse()
+                response.read()
+                status = str(response.status)
+            except (OSError, http.client.HTTPException):
+                local.conn.close()
+                del local.conn
+                status = 'error'
+            return time.perf_counter() - start, status
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            start = time.perf_counter()
+            results = list(executor.map(send, range(requests)))
+            elapsed = time.perf_counter() - start
+
+        statuses = {}
+        for _, status in results:
+            statuses[status] = statuses.get(status, 0) + 1
+        return elapsed, [latency for latency, _ in results], statuses
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.3 on 2026-10-18 09:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RosterChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.BigIntegerField()),
+                ('user_uuid', models.UUIDField()),
+                ('registered', models.BooleanField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='rosterchange',
+            index=models.Index(fields=['event_id', 'id'], name='otphandler__event_i_6d7744_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rosterchange',
+            index=models.Index(fields=['event_id', 'user_uuid'], name='otphandler__event_i_aa40f8_idx'),
+        ),
+    ]
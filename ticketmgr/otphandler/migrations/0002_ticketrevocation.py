@@ -0,0 +1,22 @@
+# Generated by Django 4.1.3 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('otphandler', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketRevocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.BigIntegerField()),
+                ('user_id', models.BigIntegerField()),
+                ('revoked_at', models.BigIntegerField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Adds the expiry of the revoked tokens to revocations, so that revocations
+# whose tokens have all expired can be deleted.
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+# otphandler.tokens.TOKEN_VALIDITY at the time of writing
+TOKEN_VALIDITY = timedelta(days=1)
+
+
+def set_expiry(apps, schema_editor):
+    TicketRevocation = apps.get_model('otphandler', 'TicketRevocation')
+    Event = apps.get_model('entityhandler', 'Event')
+    db = schema_editor.connection.alias
+    revocations = list(TicketRevocation.objects.using(db).only('pk', 'event_id', 'revoked_at'))
+    datetimes = dict(Event.objects.using(db)
+                                  .filter(pk__in={r.event_id for r in revocations})
+                                  .values_list('pk', 'datetime'))
+    for revocation in revocations:
+        event_datetime = datetimes.get(revocation.event_id)
+        if event_datetime is not None:
+            revocation.expires = int((event_datetime + TOKEN_VALIDITY).timestamp())
+        else:
+            # The datetime of deleted events is unknown, so their revocations
+            # are kept for one validity after they were made
+            revocation.expires = (revocation.revoked_at // 1000
+                                  + int(TOKEN_VALIDITY.total_seconds()))
+    TicketRevocation.objects.using(db).bulk_update(revocations, ['expires'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entityhandler', '0007_updated_at'),
+        ('otphandler', '0002_ticketrevocation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticketrevocation',
+            name='expires',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.RunPython(set_expiry, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='ticketrevocation',
+            name='expires',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AddIndex(
+            model_name='ticketrevocation',
+            index=models.Index(fields=['revoked_at'], name='otphandler__revoked_d12da5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticketrevocation',
+            index=models.Index(fields=['expires'], name='otphandler__expires_004e50_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.1.3 on 2026-10-18 11:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('otphandler', '0003_ticketrevocation_expires'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DriftCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.BigIntegerField()),
+                ('drift', models.SmallIntegerField()),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='driftcount',
+            constraint=models.UniqueConstraint(fields=('event_id', 'drift'), name='otphandler_driftcount_event_drift_uniq'),
+        ),
+    ]
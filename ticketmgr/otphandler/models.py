@@ -1,3 +1,89 @@
+"""Module that contains Django Models used by ``otphandler``.
+"""
 from django.db import models
+from django.db.models import Max
 
-# Create your models here.
+class RosterChangeQuerySet(models.QuerySet):
+    def seq(self, event_id: int) -> int:
+        """Returns the sequence number of the latest committed change of an event,
+        or 0 if it has none.
+        """
+        return self.filter(event_id=event_id).aggregate(seq=Max('id'))['seq'] or 0
+
+    def since(self, event_id: int, seq: int):
+        """Returns the changes of an event made after sequence number ``seq``."""
+        return self.filter(event_id=event_id, id__gt=seq)
+
+class RosterChange(models.Model):
+    """Django Model that records the latest registration change of a user to an event.
+    Only the latest change of each user-event pair is kept, and its ``id`` is
+    used as a monotonic sequence number for incremental roster downloads.
+
+    Ids are allocated on insert, not on commit, so they are only sequence numbers
+    because changes are recorded with the row of their event locked: changes of
+    an event commit in the order of their ids, and a change that is not yet
+    committed gets an id above every committed change of its event. Sequence
+    numbers must therefore only be compared between changes of the same event.
+
+    Attributes:
+        ``event_id``: A ``BigIntegerField`` that contains the primary key of the event.
+        ``user_uuid``: A ``UUIDField`` that contains the v4 UUID of the user.
+        ``registered``: A ``BooleanField`` that is ``True`` if the user was
+        registered to the event, and ``False`` if the user was unregistered.
+    """
+    # Not a ForeignKey, so that changes of deleted events and users can be kept
+    event_id = models.BigIntegerField()
+    user_uuid = models.UUIDField()
+    registered = models.BooleanField()
+
+    objects = RosterChangeQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['event_id', 'id']),
+            models.Index(fields=['event_id', 'user_uuid']),
+        ]
+
+class TicketRevocation(models.Model):
+    """Django Model that revokes the ticket tokens of a user for an event.
+    Tokens issued at or before ``revoked_at`` are rejected.
+
+    Attributes:
+        ``event_id``: A ``BigIntegerField`` that contains the primary key of the event.
+        ``user_id``: A ``BigIntegerField`` that contains the primary key of the user.
+        ``revoked_at``: A ``BigIntegerField`` that contains the Unix time of the
+        revocation in milliseconds, comparable to the issue time encoded in tokens.
+        ``expires``: A ``BigIntegerField`` that contains the Unix time in seconds
+        at which the tokens of the event expire, after which the revocation
+        can be deleted.
+    """
+    # Not a ForeignKey, so that revocations outlive deleted events and users
+    event_id = models.BigIntegerField()
+    user_id = models.BigIntegerField()
+    revoked_at = models.BigIntegerField()
+    expires = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['revoked_at']),
+            models.Index(fields=['expires']),
+        ]
+
+class DriftCount(models.Model):
+    """Django Model that counts the accepted codes of an event by clock drift.
+
+    Attributes:
+        ``event_id``: A ``BigIntegerField`` that contains the primary key of the event.
+        ``drift``: A ``SmallIntegerField`` that contains the drift in time steps.
+        ``count``: A ``BigIntegerField`` that contains the number of accepted codes.
+    """
+    # Not a ForeignKey, so that counting never waits for locks on the event
+    event_id = models.BigIntegerField()
+    drift = models.SmallIntegerField()
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['event_id', 'drift'],
+                                    name='otphandler_driftcount_event_drift_uniq'),
+        ]
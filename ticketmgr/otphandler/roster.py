@@ -0,0 +1,176 @@
+"""In-memory event rosters for gate sessions.
+
+When an agent starts a gate session, the roster of their event (the uuid,
+primary key and ticket secret of every registered user) is loaded into a
+compact per-process structure, so that tickets of the event can be verified
+without querying the database.
+
+Rosters are patched incrementally from the ``RosterChange`` log that is also
+used by offline bundles. Changes made by this process are applied on the next
+lookup, changes made by other processes within ROSTER_REFRESH_INTERVAL seconds.
+Processes that serve a lookup for an event without a loaded roster load it on
+demand, and rosters that were not used for ROSTER_IDLE_TIMEOUT seconds are
+dropped.
+"""
+
+import threading
+import time
+from array import array
+from django.dispatch import receiver
+from entityhandler.models import Registration
+from entityhandler.signals import registrations_changed
+from otphandler import services
+from otphandler.models import RosterChange
+
+# Maximum age of a roster before changes of other processes are applied, in seconds.
+ROSTER_REFRESH_INTERVAL = 5
+# Duration after which unused rosters are dropped, in seconds.
+ROSTER_IDLE_TIMEOUT = 3600
+
+class EventRoster:
+    """Registered users of an event, stored in flat arrays indexed by slot.
+
+    Attributes:
+        event_id (int): Primary key of the event.
+        seq (int): Sequence number of the last ``RosterChange`` applied to the roster.
+        refreshed_at (float): Monotonic time at which changes were last applied.
+        used_at (float): Monotonic time of the last lookup.
+    """
+    __slots__ = ('event_id', 'seq', 'refreshed_at', 'used_at',
+                 '_slots', '_user_ids', '_secrets', '_free', '_lock', '_refresh_lock')
+
+    def __init__(self, event_id: int, seq: int, rows):
+        """Builds a roster from (user uuid, user primary key, secret) rows."""
+        self.event_id = event_id
+        self.seq = seq
+        self.refreshed_at = self.used_at = time.monotonic()
+        # Maps the 16-byte uuid of every user to their slot
+        self._slots = {}
+        self._user_ids = array('q')
+        self._secrets = bytearray()
+        self._free = []
+        self._lock = threading.Lock()
+        # Held for whole refreshes, so that they do not apply the same changes
+        # concurrently, while lookups only wait for the changes to be applied
+        self._refresh_lock = threading.Lock()
+        for user_uuid, user_id, secret in rows:
+            self._add(user_uuid.bytes, user_id, bytes(secret))
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _add(self, user_uuid: bytes, user_id: int, secret: bytes):
+        """Adds or replaces a user. Must be called with the lock held, or during init."""
+        if len(secret) != services.SECRET_LENGTH:
+            raise ValueError('supplied secret is not ' + str(services.SECRET_LENGTH)
+                             + ' bytes long')
+        slot = self._slots.get(user_uuid)
+        if slot is None:
+            slot = self._free.pop() if self._free else len(self._user_ids)
+            self._slots[user_uuid] = slot
+        if slot == len(self._user_ids):
+            self._user_ids.append(user_id)
+            self._secrets += secret
+        else:
+            self._user_ids[slot] = user_id
+            self._secrets[slot * services.SECRET_LENGTH:
+                          (slot + 1) * services.SECRET_LENGTH] = secret
+
+    def lookup(self, user_uuid: bytes) -> tuple:
+        """Return the (primary key, ticket secret) of a registered user.
+
+        Args:
+            user_uuid (bytes): The 16-byte uuid of the user.
+
+        Returns:
+            tuple: The primary key and secret, or None if the user is not registered.
+        """
+        self.used_at = time.monotonic()
+        with self._lock:
+            slot = self._slots.get(user_uuid)
+            if slot is None:
+                return None
+            return (self._user_ids[slot],
+                    bytes(self._secrets[slot * services.SECRET_LENGTH:
+                                        (slot + 1) * services.SECRET_LENGTH]))
+
+    def refresh(self):
+        """Applies changes to the registrations of the event made since the last refresh."""
+        with self._refresh_lock:
+            changes = list(RosterChange.objects.since(self.event_id, self.seq)
+                                               .values_list('id', 'user_uuid', 'registered'))
+            self.refreshed_at = time.monotonic()
+            if not changes:
+                return
+
+            added = [user_uuid for _, user_uuid, registered in changes if registered]
+            rows = (Registration.objects.filter(event_id=self.event_id,
+                                                tktuser__uuid__in=added)
+                                        .values_list('tktuser__uuid', 'tktuser_id', 'secret'))
+            with self._lock:
+                for _, user_uuid, registered in changes:
+                    if not registered:
+                        slot = self._slots.pop(user_uuid.bytes, None)
+                        if slot is not None:
+                            self._free.append(slot)
+                for user_uuid, user_id, secret in rows:
+                    self._add(user_uuid.bytes, user_id, bytes(secret))
+                self.seq = max(self.seq, max(seq for seq, _, _ in changes))
+
+# Maps Event primary keys to their EventRoster.
+_rosters = {}
+_rosters_lock = threading.Lock()
+
+def load_roster(event_id: int) -> EventRoster:
+    """Loads the roster of an event from the database, replacing any loaded roster.
+    The registrations of the event are fetched with a single query.
+
+    Args:
+        event_id (int): Primary key of the event.
+
+    Returns:
+        EventRoster: The loaded roster.
+    """
+    # Read before the roster, so that concurrent changes are applied on refresh
+    seq = RosterChange.objects.seq(event_id)
+    rows = (Registration.objects.filter(event_id=event_id)
+                                .values_list('tktuser__uuid', 'tktuser_id', 'secret')
+                                .iterator())
+    roster = EventRoster(event_id, seq, rows)
+
+    now = time.monotonic()
+    with _rosters_lock:
+        for stale_id in [k for k, v in _rosters.items()
+                         if now - v.used_at > ROSTER_IDLE_TIMEOUT]:
+            del _rosters[stale_id]
+        _rosters[event_id] = roster
+    return roster
+
+def get_roster(event_id: int) -> EventRoster:
+    """Returns the up-to-date roster of an event, loading it if necessary.
+
+    Args:
+        event_id (int): Primary key of the event.
+
+    Returns:
+        EventRoster: The roster of the event.
+    """
+    roster = _rosters.get(event_id)
+    if roster is None:
+        return load_roster(event_id)
+    if time.monotonic() - roster.refreshed_at >= ROSTER_REFRESH_INTERVAL:
+        roster.refresh()
+    return roster
+
+def drop_roster(event_id: int):
+    """Discards the roster of an event."""
+    with _rosters_lock:
+        _rosters.pop(event_id, None)
+
+@receiver(registrations_changed)
+def _refresh_on_registration(sender, pairs, **kwargs):
+    # Changes are applied on the next lookup, after they were logged
+    for event_id in {event_id for event_id, _ in pairs}:
+        roster = _rosters.get(event_id)
+        if roster is not None:
+            roster.refreshed_at = float('-inf')
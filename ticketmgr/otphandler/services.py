@@ -1,11 +1,20 @@
 """Handles various TOTP-related duties.
 """
 
+import collections
+import functools
 import hmac
 import hashlib
 import os
+import threading
 import time
-from entityhandler.models import TktUser, Event
+import uuid
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from entityhandler.models import Event, Registration, TktUser
+from otphandler.ledger import ReplayLedger
+from otphandler.models import DriftCount
 
 # Duration of generated code, in seconds.
 TIME_INTERVAL = 30
@@ -17,13 +26,29 @@ OTP_LENGTH = 6
 HASH_ALG = 'sha256'
 # Internal block length for HASH_ALG, in bytes.
 BLOCK_SIZE = 64
+# Maximum number of tickets accepted by a single batch verification.
+BATCH_SIZE_LIMIT = 500
+# Maximum number of pre-keyed HMAC states, and of codes per time step, kept in memory.
+HMAC_CACHE_SIZE = 4096
+# Number of time steps before and after the current one whose codes are accepted.
+# Can be overridden with the TOTP_VERIFY_WINDOW setting.
+VERIFY_WINDOW = 1
+# Number of time steps before and after the current one whose computed codes
+# are kept in memory.
+CODE_CACHE_STEPS = 2
+# Maximum age of the drift counts kept in memory, in seconds.
+DRIFT_FLUSH_INTERVAL = 5
 # Translation tables for .translate() used during the XOR padding step.
 OPAD = bytes((x ^ 0x5c) for x in range(256))
 IPAD = bytes((x ^ 0x36) for x in range(256))
 
-def _get_counter_bytes(time_0: float = 0) -> bytes:
+def _get_counter(time_0: float = 0) -> int:
     """Return computed time counter as outlined in RFC6238."""
-    return int((time.time() - time_0) / TIME_INTERVAL).to_bytes(8, 'big')
+    return int((time.time() - time_0) / TIME_INTERVAL)
+
+def _get_counter_bytes(time_0: float = 0) -> bytes:
+    """Return computed time counter as an 8-byte big-endian bytestring."""
+    return _get_counter(time_0).to_bytes(8, 'big')
 
 def _generate_secret(length: int) -> bytes:
     """Return length-byte long pseudo-random bytestring."""
@@ -47,6 +72,29 @@ def _truncate(hash_raw: bytes) -> int:
 
     return res & 0x7fffffff
 
+@functools.lru_cache(maxsize=HMAC_CACHE_SIZE)
+def _keyed_hmac(secret: bytes, custom: bool) -> tuple:
+    """Return the HMAC state(s) keyed with secret, before any message is hashed.
+    The returned states are shared between callers and must be copy()'d
+    before being updated.
+
+    Args:
+        secret (bytes): The secret key to key the HMAC state(s) with.
+        custom (bool): Return the inner and outer hash states of the custom
+                       HMAC implementation instead of a built-in HMAC object.
+
+    Returns:
+        tuple: (inner, outer) hash objects if custom, (hmac_object,) otherwise.
+    """
+    if not custom:
+        return (hmac.new(secret, digestmod=HASH_ALG),)
+
+    s_pad = secret.ljust(BLOCK_SIZE, b'\0')
+    hash_i = hashlib.new(HASH_ALG, s_pad.translate(IPAD))
+    hash_o = hashlib.new(HASH_ALG, s_pad.translate(OPAD))
+
+    return hash_i, hash_o
+
 def _custom_hmac(secret: bytes, message: bytes) -> bytes:
     """Custom implementation of HMAC as outlined in RFC2104.
 
@@ -62,63 +110,434 @@ def _custom_hmac(secret: bytes, message: bytes) -> bytes:
     if len(message) == 0:
         raise ValueError('supplied empty message')
 
-    s_pad = secret.ljust(BLOCK_SIZE, b'\0')
-    s_ipad = s_pad.translate(IPAD)
-    s_opad = s_pad.translate(OPAD)
-    hash_i = hashlib.new(HASH_ALG, s_ipad + message).digest()
-    hash_hmac = hashlib.new(HASH_ALG, s_opad + hash_i).digest()
+    keyed_i, keyed_o = _keyed_hmac(secret, True)
+    hash_i = keyed_i.copy()
+    hash_i.update(message)
+    hash_hmac = keyed_o.copy()
+    hash_hmac.update(hash_i.digest())
 
-    return hash_hmac
+    return hash_hmac.digest()
 
-def generate_totp(secret: bytes, custom: bool='False') -> str:
+def _builtin_hmac(secret: bytes, message: bytes) -> bytes:
+    """Compute HMAC with the built-in module, reusing the keyed state of secret."""
+    hash_hmac = _keyed_hmac(secret, False)[0].copy()
+    hash_hmac.update(message)
+
+    return hash_hmac.digest()
+
+def _format_code(hash_truncated: int) -> str:
+    """Return the OTP_LENGTH digit code for a truncated HMAC hash."""
+    return str(hash_truncated % (10 ** OTP_LENGTH)).zfill(OTP_LENGTH)
+
+# Maps time counters to dicts of secret -> computed code.
+_code_cache = {}
+_code_cache_lock = threading.Lock()
+
+def _get_code_cache(counter: int) -> dict:
+    """Return the code cache of a time counter, or None if it is not cacheable.
+    Caches of time counters that fell out of CODE_CACHE_STEPS are evicted on
+    time step rollover.
+    """
+    codes = _code_cache.get(counter)
+    if codes is not None:
+        return codes
+
+    current = _get_counter()
+    if not current - CODE_CACHE_STEPS <= counter <= current + CODE_CACHE_STEPS:
+        return None
+    with _code_cache_lock:
+        for stale in [c for c in _code_cache if c < current - CODE_CACHE_STEPS]:
+            del _code_cache[stale]
+        return _code_cache.setdefault(counter, {})
+
+def generate_totp(secret: bytes, custom: bool = False, counter: int = None) -> str:
     """Generates TOTP codes based on either the custom or built-in HMAC module.
+    Codes are cached per secret for recent time counters.
 
     Args:
         secret (bytes): The shared secret to generate codes with.
         custom (bool, optional): Use the custom implementation of the HMAC algorithm.
                                  Defaults to False.
+        counter (int, optional): The time counter to generate the code for.
+                                 Defaults to the current time counter.
 
     Returns:
         str: Generated TOTP code with length OTP_LENGTH digits.
     """
+    if counter is None:
+        counter = _get_counter()
+    codes = _get_code_cache(counter)
+    code = codes.get(secret) if codes is not None else None
+    if code is not None:
+        return code
+
+    message = counter.to_bytes(8, 'big')
     if custom:
-        hash_hmac = _custom_hmac(secret, _get_counter_bytes())
+        hash_hmac = _custom_hmac(secret, message)
     else:
-        hash_hmac = hmac.new(secret, _get_counter_bytes(), HASH_ALG)
+        hash_hmac = _builtin_hmac(secret, message)
+    code = _format_code(_truncate(hash_hmac))
+    if codes is not None and len(codes) < HMAC_CACHE_SIZE:
+        codes[secret] = code
 
-    hash_truncated = _truncate(hash_hmac)
+    return code
 
-    return str(hash_truncated % (10 ** OTP_LENGTH)).zfill(OTP_LENGTH)
+def get_verify_window() -> int:
+    """Return the configured number of time steps of accepted clock drift."""
+    return getattr(settings, 'TOTP_VERIFY_WINDOW', VERIFY_WINDOW)
+
+def generate_totp_window(secret: bytes, window: int, custom: bool = False,
+                         counter: int = None) -> list:
+    """Generates the codes of a secret for every time step within window steps
+    of a time counter, in a single pass over the keyed HMAC state.
+
+    Args:
+        secret (bytes): The shared secret to generate codes with.
+        window (int): Number of time steps before and after counter to generate codes for.
+        custom (bool, optional): Use the custom implementation of the HMAC algorithm.
+                                 Defaults to False.
+        counter (int, optional): The time counter at the center of the window.
+                                 Defaults to the current time counter.
+
+    Returns:
+        list: (drift, code) tuples ordered by increasing absolute drift,
+              where drift is the offset of the code's time step from counter.
+    """
+    if counter is None:
+        counter = _get_counter()
+    if custom and len(secret) != SECRET_LENGTH:
+        raise ValueError('supplied secret is not ' + str(SECRET_LENGTH) + ' bytes long')
+    keyed = _keyed_hmac(secret, custom)
+
+    codes = []
+    for drift in sorted(range(-window, window + 1), key=abs):
+        step_codes = _get_code_cache(counter + drift)
+        code = step_codes.get(secret) if step_codes is not None else None
+        if code is None:
+            message = (counter + drift).to_bytes(8, 'big')
+            if custom:
+                hash_i = keyed[0].copy()
+                hash_i.update(message)
+                hash_hmac = keyed[1].copy()
+                hash_hmac.update(hash_i.digest())
+            else:
+                hash_hmac = keyed[0].copy()
+                hash_hmac.update(message)
+            code = _format_code(_truncate(hash_hmac.digest()))
+            if step_codes is not None and len(step_codes) < HMAC_CACHE_SIZE:
+                step_codes[secret] = code
+        codes.append((drift, code))
+
+    return codes
+
+def verify_totp(secret: bytes, totp: str, window: int = None, counter: int = None) -> int:
+    """Verifies a TOTP code against every time step within the verification window.
+    All candidate codes are compared in constant time.
+
+    Args:
+        secret (bytes): The shared secret that the code was generated with.
+        totp (str): The code to verify.
+        window (int, optional): Number of time steps of accepted clock drift.
+                                Defaults to get_verify_window().
+        counter (int, optional): The time counter at the center of the window.
+                                 Defaults to the current time counter.
+
+    Returns:
+        int: The drift of the matched time step, or None if the code is invalid.
+    """
+    if window is None:
+        window = get_verify_window()
+    if not isinstance(totp, str) or not totp.isascii():
+        return None
+
+    totp_raw = totp.encode()
+    matched = None
+    for drift, code in generate_totp_window(secret, window, counter=counter):
+        if hmac.compare_digest(code.encode(), totp_raw) and matched is None:
+            matched = drift
+
+    return matched
+
+# Drift counts of this process not yet added to DriftCount, by (event id, drift),
+# and monotonic time at which they were last added.
+_drift_counts = collections.Counter()
+_drift_lock = threading.Lock()
+_drift_flushed_at = time.monotonic()
+
+def flush_drift():
+    """Adds the drift counts of this process to the database."""
+    global _drift_flushed_at
+    with _drift_lock:
+        counts = _drift_counts.copy()
+        _drift_counts.clear()
+        _drift_flushed_at = time.monotonic()
+    for (event_id, drift), count in counts.items():
+        counted = DriftCount.objects.filter(event_id=event_id, drift=drift)
+        if counted.update(count=F('count') + count):
+            continue
+        try:
+            with transaction.atomic():
+                DriftCount.objects.create(event_id=event_id, drift=drift, count=count)
+        except IntegrityError:
+            # Created concurrently
+            counted.update(count=F('count') + count)
+
+def record_drift(event_id: int, drift: int):
+    """Counts an accepted code with drift in the clock skew distribution of an event.
+    Counts are kept in memory and added to the database at most every
+    DRIFT_FLUSH_INTERVAL seconds, so that verifications do not write to it.
+    """
+    with _drift_lock:
+        _drift_counts[event_id, drift] += 1
+        flush = time.monotonic() - _drift_flushed_at >= DRIFT_FLUSH_INTERVAL
+    if flush:
+        flush_drift()
+
+def drift_distribution(event_id: int) -> dict:
+    """Returns the clock skew distribution of an event. Includes the counts of
+    this process, and those of other processes up to DRIFT_FLUSH_INTERVAL seconds ago.
+
+    Args:
+        event_id (int): Primary key of the event.
+
+    Returns:
+        dict: Maps every drift within the verification window to the number of
+              accepted codes with that drift.
+    """
+    flush_drift()
+    window = get_verify_window()
+    counts = dict(DriftCount.objects.filter(event_id=event_id,
+                                            drift__range=(-window, window))
+                                    .values_list('drift', 'count'))
+
+    return {drift: counts.get(drift, 0) for drift in range(-window, window + 1)}
+
+class CodeReplayedError(Exception):
+    """Raised when a ticket-generated TOTP code that was already accepted is
+    verified again."""
+
+# Ledger of accepted codes, remembering every time step a code can be accepted in.
+_ledger = ReplayLedger(2 * get_verify_window() + 2, TIME_INTERVAL)
+
+def claim_code(event_id: int, user_id: int, counter: int):
+    """Records the use of a ticket's code for a time counter.
+
+    Args:
+        event_id (int): Primary key of the event that the ticket is verified for.
+        user_id (int): Primary key of the user that the ticket is registered to.
+        counter (int): The time counter of the accepted code.
+
+    Raises:
+        CodeReplayedError: If the code was already used.
+    """
+    if not _ledger.claim(event_id, user_id, counter):
+        raise CodeReplayedError('TOTP code was already used')
+
+def verify_ticket(secret: bytes, totp: str, event_id: int, user_id: int) -> int:
+    """Verifies a ticket-generated TOTP code for an event, rejecting codes that
+    were already accepted, and records the drift of accepted codes.
+
+    Args:
+        secret (bytes): The ticket secret.
+        totp (str): The code to verify.
+        event_id (int): Primary key of the event that the ticket is verified for.
+        user_id (int): Primary key of the user that the ticket is registered to.
+
+    Returns:
+        int: The drift of the matched time step, or None if the code is invalid.
+
+    Raises:
+        CodeReplayedError: If the code is valid but was already accepted.
+    """
+    counter = _get_counter()
+    drift = verify_totp(secret, totp, counter=counter)
+    if drift is not None:
+        claim_code(event_id, user_id, counter + drift)
+        record_drift(event_id, drift)
+
+    return drift
+
+def generate_totp_batch(secrets: list, counter: int = None) -> list:
+    """Generates TOTP codes for many secrets in a single pass.
+    The time counter is computed once, so all codes belong to the same time step.
+
+    Args:
+        secrets (list): The shared secrets to generate codes with.
+        counter (int, optional): The time counter to generate codes for.
+                                 Defaults to the current time counter.
+
+    Returns:
+        list: Generated TOTP codes, in the same order as secrets.
+    """
+    if counter is None:
+        counter = _get_counter()
+    message = counter.to_bytes(8, 'big')
+
+    return [_format_code(_truncate(hmac.digest(secret, message, HASH_ALG)))
+            for secret in secrets]
 
 def generate_ticket_secret(user: TktUser, event: Event) -> bytes:
-    """Generates a per-ticket secret for a user and an event.
-    As long as TktUser and Event are valid, a secret will always be generated.
-    It is the caller's responsibility to check the event roster for the user.
+    """Returns the per-ticket secret of the registration of a user to an event.
+    Secrets are generated with _generate_secret() when the user is registered.
 
     Args:
         user (TktUser): The user that the ticket is registered to.
         event (Event): The event that the ticket is registered to.
 
     Returns:
-        bytes: A bytes object of length len(_generate_secret())
+        bytes: A bytes object of length SECRET_LENGTH
+
+    Raises:
+        Registration.DoesNotExist: If user is not registered to event.
     """
     if user._state.db is None:
         raise ValueError('supplied TktUser has no database entry')
     if event._state.db is None:
         raise ValueError('supplied Event has no database entry')
 
-    entropy_e = SECRET_LENGTH // 2
-    entropy_u = SECRET_LENGTH - entropy_e
-    
-    user_uuid_str = str(user.uuid)
-    event_uuid_str = str(event.uuid)
-    # Entropy sanity check
-    if entropy_e > len(event_uuid_str):
-        raise ValueError('not enough entropy in event uuid')
-    # Get half of the required entropy from the event
-    secret_e = bytes(event_uuid_str[-entropy_e:], encoding='utf-8')
-    # Get the other half from the user
-    secret_u = bytes(user_uuid_str[-entropy_u:], encoding='utf-8')
-    #TODO: change event-user junction table to contain a small prng generated bytestring
-
-    return secret_e + secret_u
+    # Some database backends return BinaryField values as memoryview
+    return bytes(Registration.objects.values_list('secret', flat=True)
+                                     .get(event=event, tktuser=user))
+
+def _parse_uuid(value) -> uuid.UUID:
+    """Return value as a UUID, or None if it is not a valid UUID."""
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+def resolve_registration(user_uuid, event_uuid) -> Registration:
+    """Looks up the registration of a user to an event by their uuids.
+    The registration is fetched with a single query joining both uuid columns.
+    Only if no registration matches, additional queries determine whether the
+    user or the event does not exist.
+
+    Args:
+        user_uuid (str | UUID): The uuid of the user.
+        event_uuid (str | UUID): The uuid of the event.
+
+    Returns:
+        Registration: The registration, with only ``event_id``, ``tktuser_id``
+                      and ``secret`` loaded. None if both the user and the event
+                      exist, but the user is not registered to the event.
+
+    Raises:
+        TktUser.DoesNotExist: If there is no user with uuid user_uuid.
+        Event.DoesNotExist: If there is no event with uuid event_uuid.
+    """
+    user_uuid = _parse_uuid(user_uuid)
+    event_uuid = _parse_uuid(event_uuid)
+    if user_uuid is not None and event_uuid is not None:
+        try:
+            return (Registration.objects.only('event_id', 'tktuser_id', 'secret')
+                                        .get(tktuser__uuid=user_uuid, event__uuid=event_uuid))
+        except Registration.DoesNotExist:
+            pass
+
+    if user_uuid is None or not TktUser.objects.filter(uuid=user_uuid).exists():
+        raise TktUser.DoesNotExist('TktUser matching query does not exist.')
+    if event_uuid is None or not Event.objects.filter(uuid=event_uuid).exists():
+        raise Event.DoesNotExist('Event matching query does not exist.')
+    return None
+
+async def aresolve_registration(user_uuid, event_uuid) -> Registration:
+    """Asynchronous version of resolve_registration(), using the async ORM
+    interface so that the event loop is not blocked while waiting for queries.
+
+    Args:
+        user_uuid (str | UUID): The uuid of the user.
+        event_uuid (str | UUID): The uuid of the event.
+
+    Returns:
+        Registration: See resolve_registration().
+
+    Raises:
+        TktUser.DoesNotExist: If there is no user with uuid user_uuid.
+        Event.DoesNotExist: If there is no event with uuid event_uuid.
+    """
+    user_uuid = _parse_uuid(user_uuid)
+    event_uuid = _parse_uuid(event_uuid)
+    if user_uuid is not None and event_uuid is not None:
+        try:
+            return await (Registration.objects.only('event_id', 'tktuser_id', 'secret')
+                                              .aget(tktuser__uuid=user_uuid,
+                                                    event__uuid=event_uuid))
+        except Registration.DoesNotExist:
+            pass
+
+    if user_uuid is None or not await TktUser.objects.filter(uuid=user_uuid).aexists():
+        raise TktUser.DoesNotExist('TktUser matching query does not exist.')
+    if event_uuid is None or not await Event.objects.filter(uuid=event_uuid).aexists():
+        raise Event.DoesNotExist('Event matching query does not exist.')
+    return None
+
+def authenticate_ticket_batch(tickets: list) -> list:
+    """Verifies a batch of ticket-generated TOTP codes.
+    All users, events and registrations referenced by the batch are resolved
+    with one set-based query each, regardless of the size of the batch.
+
+    Args:
+        tickets (list): Dicts of the form {'user_uuid': <str>, 'event_uuid': <str>,
+                        'ticket_totp': <str>}.
+
+    Returns:
+        list: One result dict per ticket, in the order they were supplied.
+              Each result contains the HTTP status code the single-ticket
+              endpoint would have responded with, and either 'ticket_is_valid'
+              or 'error'.
+    """
+    parsed = []
+    for ticket in tickets:
+        if not isinstance(ticket, dict):
+            parsed.append(None)
+            continue
+        parsed.append((_parse_uuid(ticket.get('user_uuid')),
+                       _parse_uuid(ticket.get('event_uuid')),
+                       ticket.get('ticket_totp')))
+
+    user_uuids = {t[0] for t in parsed if t is not None and t[0] is not None}
+    event_uuids = {t[1] for t in parsed if t is not None and t[1] is not None}
+    users = {}
+    events = {}
+    secrets = {}
+    if user_uuids:
+        users = {u.uuid: u for u in
+                 TktUser.objects.filter(uuid__in=user_uuids).only('id', 'uuid')}
+    if event_uuids:
+        events = {e.uuid: e for e in
+                  Event.objects.filter(uuid__in=event_uuids).only('id', 'uuid')}
+    if users and events:
+        secrets = {(user_id, event_id): bytes(secret) for user_id, event_id, secret in
+                   Registration.objects.filter(
+                       tktuser_id__in=[u.pk for u in users.values()],
+                       event_id__in=[e.pk for e in events.values()]
+                   ).values_list('tktuser_id', 'event_id', 'secret')}
+
+    results = []
+    for ticket in parsed:
+        if ticket is None:
+            results.append({'status': 400, 'error': 'Malformed payload.'})
+            continue
+        user_uuid, event_uuid, totp = ticket
+        user = users.get(user_uuid)
+        event = events.get(event_uuid)
+        if user is None:
+            results.append({'status': 404, 'error': 'User does not exist.'})
+        elif event is None:
+            results.append({'status': 404, 'error': 'Event does not exist.'})
+        elif totp is None:
+            results.append({'status': 400, 'error': 'TOTP code was not supplied.'})
+        elif (user.pk, event.pk) not in secrets:
+            results.append({'status': 400, 'error': 'User is not registered to event.'})
+        else:
+            try:
+                drift = verify_ticket(secrets[(user.pk, event.pk)], totp, event.pk, user.pk)
+            except CodeReplayedError:
+                results.append({'status': 409, 'error': 'TOTP code was already used.'})
+                continue
+            if drift is None:
+                results.append({'status': 200, 'ticket_is_valid': False})
+            else:
+                results.append({'status': 200, 'ticket_is_valid': True, 'drift': drift})
+
+    return results
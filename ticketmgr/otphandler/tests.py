@@ -1,12 +1,21 @@
+import base64
+import hmac
+import threading
+import time
 import uuid
+from unittest.mock import patch
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from rest_framework.test import APIClient
 
-from entityhandler.models import Event, TktUser
-from otphandler import services
+from entityhandler.models import Event, Registration, TktAgent, TktUser
+from otphandler import bundles, codeindex, ledger, roster, services, tokens
+from otphandler.models import DriftCount, RosterChange, TicketRevocation
 
 
 class ServicesTestCase(TestCase):
@@ -22,11 +31,219 @@ class ServicesTestCase(TestCase):
             services.generate_totp(b'', True)
         # Check correct HMAC computation of custom implementation
         self.assertEqual(custom_totp, pyhmac_totp)
+        for counter in range(3):
+            message = counter.to_bytes(8, 'big')
+            self.assertEqual(services._custom_hmac(test_secret, message),
+                             hmac.digest(test_secret, message, services.HASH_ALG))
+            self.assertEqual(services._builtin_hmac(test_secret, message),
+                             hmac.digest(test_secret, message, services.HASH_ALG))
         # Check whether TOTP codes of correct length are generated
         self.assertEqual(len(custom_totp), 6)
         # Check if different TOTP codes are generated for different secrets
         self.assertNotEqual(custom_totp, custom_totp2)
+        # Check that batched generation matches single code generation
+        counter = services._get_counter()
+        self.assertEqual(services.generate_totp_batch([test_secret, test_secret2], counter),
+                         [services.generate_totp(test_secret, True),
+                          services.generate_totp(test_secret2, True)])
     
+    def test_totp_caches(self):
+        test_secret = b'DEBUGSECRETKEY2345=='
+        counter = services._get_counter()
+        message = counter.to_bytes(8, 'big')
+        expected = services._format_code(services._truncate(
+                       hmac.digest(test_secret, message, services.HASH_ALG)))
+
+        # Check that keyed states are reused and left untouched by computations
+        self.assertIs(services._keyed_hmac(test_secret, True),
+                      services._keyed_hmac(test_secret, True))
+        self.assertEqual(services.generate_totp(test_secret, True, counter), expected)
+        self.assertEqual(services.generate_totp(test_secret, False, counter), expected)
+        # Check that computed codes are cached for the current time counter
+        self.assertEqual(services._code_cache[counter][test_secret], expected)
+        # Check that codes of counters outside the cached steps are not cached
+        services.generate_totp(test_secret, counter=counter - services.CODE_CACHE_STEPS - 1)
+        self.assertNotIn(counter - services.CODE_CACHE_STEPS - 1, services._code_cache)
+        # Check that caches of stale counters are evicted on rollover
+        services._code_cache[counter - services.CODE_CACHE_STEPS - 1] = {}
+        services.generate_totp(test_secret, counter=counter + 1)
+        self.assertNotIn(counter - services.CODE_CACHE_STEPS - 1, services._code_cache)
+
+    def test_totp_verification_window(self):
+        test_secret = b'DEBUGSECRETKEY2345=='
+        counter = services._get_counter()
+        window = services.generate_totp_window(test_secret, 2, counter=counter)
+
+        # Check that codes are generated for every step, closest steps first
+        self.assertEqual([drift for drift, _ in window], [0, -1, 1, -2, 2])
+        for drift, code in window:
+            self.assertEqual(code, services.generate_totp(test_secret, True, counter + drift))
+        # Check that codes within the window are accepted with their drift
+        codes = dict(window)
+        with self.settings(TOTP_VERIFY_WINDOW=1):
+            self.assertEqual(services.verify_totp(test_secret, codes[-1]), -1)
+            self.assertEqual(services.verify_totp(test_secret, codes[1]), 1)
+            # Check that codes outside of the window and malformed codes are rejected
+            if codes[-2] not in (codes[-1], codes[0], codes[1]):
+                self.assertIsNone(services.verify_totp(test_secret, codes[-2]))
+            self.assertIsNone(services.verify_totp(test_secret, 123456))
+            self.assertIsNone(services.verify_totp(test_secret, '１２３４５６'))
+        with self.settings(TOTP_VERIFY_WINDOW=2):
+            self.assertEqual(services.verify_totp(test_secret, codes[-2]), -2)
+        # Check that drift of verified tickets is aggregated per event, in memory
+        # and then in the database along with the counts of other processes
+        before = services.drift_distribution(0)
+        with self.assertNumQueries(0):
+            services.record_drift(0, -1)
+            services.record_drift(0, -1)
+        DriftCount.objects.filter(event_id=0, drift=-1).delete()
+        DriftCount.objects.create(event_id=0, drift=1, count=3)
+        self.assertEqual(services.drift_distribution(0), {-1: 2, 0: before[0], 1: 3})
+        services.record_drift(0, -1)
+        services.flush_drift()
+        self.assertEqual(DriftCount.objects.get(event_id=0, drift=-1).count, 3)
+
+    def test_replay_ledger(self):
+        replays = ledger.ReplayLedger(4, services.TIME_INTERVAL, capacity=2)
+
+        # Check that codes are only accepted once per event, user and counter
+        self.assertTrue(replays.claim(1, 1, 100))
+        self.assertFalse(replays.claim(1, 1, 100))
+        self.assertTrue(replays.claim(1, 1, 101))
+        self.assertTrue(replays.claim(2, 1, 100))
+        # Check that the shared cache rejects codes beyond the local capacity
+        self.assertTrue(replays.claim(3, 1, 100))
+        self.assertNotIn((3, 1), replays._keys[100 % 4])
+        self.assertFalse(replays.claim(3, 1, 100))
+        # Check that slots of old counters are recycled
+        self.assertTrue(replays.claim(1, 1, 104))
+        self.assertEqual(replays._keys[104 % 4], {(1, 1)})
+        # Check that other processes' claims are honored
+        other = ledger.ReplayLedger(4, services.TIME_INTERVAL)
+        self.assertFalse(other.claim(1, 1, 104))
+
+    def test_event_roster(self):
+        rows = [(uuid.uuid4(), i, services._generate_secret(services.SECRET_LENGTH))
+                for i in range(3)]
+        event_roster = roster.EventRoster(1, 0, rows)
+
+        # Check lookups of registered and unknown users
+        self.assertEqual(len(event_roster), 3)
+        for user_uuid, user_id, secret in rows:
+            self.assertEqual(event_roster.lookup(user_uuid.bytes), (user_id, secret))
+        self.assertIsNone(event_roster.lookup(uuid.uuid4().bytes))
+        # Check that slots of removed users are reused
+        with event_roster._lock:
+            event_roster._free.append(event_roster._slots.pop(rows[1][0].bytes))
+            new_uuid = uuid.uuid4()
+            event_roster._add(new_uuid.bytes, 9, bytes(services.SECRET_LENGTH))
+        self.assertEqual(len(event_roster._user_ids), 3)
+        self.assertIsNone(event_roster.lookup(rows[1][0].bytes))
+        self.assertEqual(event_roster.lookup(new_uuid.bytes), (9, bytes(services.SECRET_LENGTH)))
+        self.assertEqual(event_roster.lookup(rows[2][0].bytes), rows[2][1:])
+        # Check that secrets of unexpected length are rejected
+        with self.assertRaises(ValueError):
+            roster.EventRoster(1, 0, [(uuid.uuid4(), 1, b'short')])
+
+    def test_event_roster_refresh(self):
+        ev = Event.objects.create(title="Some Event", description="Some event description",
+                                  datetime=timezone.datetime.now(timezone.utc))
+        ev_other = Event.objects.create(title="Other Event", description="Other event",
+                                        datetime=timezone.datetime.now(timezone.utc))
+        user = TktUser.objects.create(user=User.objects.create_user('user999'))
+        user.events.add(ev)
+        event_roster = roster.load_roster(ev.pk)
+        self.assertEqual(event_roster.seq, RosterChange.objects.seq(ev.pk))
+        # Check that changes of other events do not move the sequence number
+        user.events.add(ev_other)
+        event_roster.refresh()
+        self.assertEqual(event_roster.seq, RosterChange.objects.seq(ev.pk))
+        self.assertLess(event_roster.seq, RosterChange.objects.seq(ev_other.pk))
+        # Check that refreshes are serialized
+        active = []
+        overlapped = threading.Event()
+        def since(event_id, seq):
+            active.append(seq)
+            if len(active) > 1:
+                overlapped.set()
+            time.sleep(0.05)
+            active.pop()
+            return RosterChange.objects.none()
+        with patch.object(RosterChange.objects, 'since', side_effect=since):
+            threads = [threading.Thread(target=event_roster.refresh) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertFalse(overlapped.is_set())
+
+    def test_ticket_tokens(self):
+        tokens.clear_revocations()
+        secret = services._generate_secret(services.SECRET_LENGTH)
+        expires = int(time.time()) + 60
+
+        # Check that tokens carry their registration and secret
+        token = tokens.issue_token(7, 9, secret, expires)
+        ticket = tokens.read_token(token)
+        self.assertEqual((ticket.event_id, ticket.user_id, ticket.secret, ticket.expires),
+                         (7, 9, secret, expires))
+        self.assertNotIn(base64.urlsafe_b64encode(secret).rstrip(b'=').decode(), token)
+        # Check that malformed, tampered and expired tokens are rejected
+        tampered = token[:10] + ('B' if token[10] == 'A' else 'A') + token[11:]
+        for bad_token in ('', 'not a token', token[:-2], tampered):
+            with self.assertRaises(tokens.InvalidTokenError):
+                tokens.read_token(bad_token)
+        with self.assertRaisesMessage(tokens.InvalidTokenError, 'expired'):
+            tokens.read_token(token, now=expires)
+        # Check that tokens of all configured keys are accepted during rotation
+        with self.settings(TICKET_SIGNING_KEYS={0: 'old key', 1: 'new key'},
+                           TICKET_SIGNING_KEY_ID=0):
+            old_token = tokens.issue_token(7, 9, secret, expires)
+        with self.settings(TICKET_SIGNING_KEYS={0: 'old key', 1: 'new key'},
+                           TICKET_SIGNING_KEY_ID=1):
+            self.assertEqual(tokens.read_token(old_token).secret, secret)
+            new_token = tokens.issue_token(7, 9, secret, expires)
+            self.assertEqual(tokens.read_token(new_token).secret, secret)
+        with self.settings(TICKET_SIGNING_KEYS={1: 'new key'}, TICKET_SIGNING_KEY_ID=1):
+            self.assertEqual(tokens.read_token(new_token).secret, secret)
+            with self.assertRaisesMessage(tokens.InvalidTokenError, 'signature'):
+                tokens.read_token(old_token)
+        # Check that tokens issued before a revocation are rejected
+        tokens._revoke_removed_registrations(None, 'remove', [(7, 9)])
+        with self.assertRaisesMessage(tokens.InvalidTokenError, 'revoked'):
+            tokens.read_token(token)
+        self.assertEqual(tokens.read_token(tokens.issue_token(7, 9, secret, expires)).secret,
+                         secret)
+        # Check that revocations committed after later ones are loaded on refresh,
+        # or on the next reload if they were committed later than the overlap
+        token = tokens.issue_token(7, 10, secret, expires)
+        token2 = tokens.issue_token(7, 11, secret, expires)
+        revoked_at = tokens._now_ms() + tokens.REVOCATION_OVERLAP + 5000
+        TicketRevocation.objects.create(event_id=7, user_id=12, revoked_at=revoked_at,
+                                        expires=expires)
+        tokens._refresh_revocations()
+        TicketRevocation.objects.bulk_create([
+            TicketRevocation(event_id=7, user_id=10, revoked_at=revoked_at - 1000,
+                             expires=expires),
+            TicketRevocation(event_id=7, user_id=11,
+                             revoked_at=revoked_at - tokens.REVOCATION_OVERLAP - 1,
+                             expires=expires)])
+        tokens._refresh_revocations()
+        self.assertTrue(tokens.is_revoked(7, 10, revoked_at - 1000))
+        self.assertFalse(tokens.is_revoked(7, 11, 1))
+        tokens._revocations_reloaded_at = float('-inf')
+        tokens._refresh_revocations()
+        for revoked_token in (token, token2):
+            with self.assertRaisesMessage(tokens.InvalidTokenError, 'revoked'):
+                tokens.read_token(revoked_token)
+        # Check that revocations of expired tokens are deleted on reload
+        TicketRevocation.objects.filter(user_id=11).update(expires=int(time.time()))
+        tokens._revocations_reloaded_at = float('-inf')
+        tokens._refresh_revocations()
+        self.assertFalse(TicketRevocation.objects.filter(user_id=11).exists())
+        self.assertFalse(tokens.is_revoked(7, 11, 1))
+        self.assertTrue(tokens.is_revoked(7, 10, 1))
+
     def test_ticket_secret_generation(self):
         ev = Event.objects.create(title="Some Event",
                                   description="Some event description",
@@ -51,19 +268,63 @@ class ServicesTestCase(TestCase):
         with self.assertRaises(ValueError):
             services.generate_ticket_secret(user_shallow, ev_shallow)
 
+        with self.assertRaises(Registration.DoesNotExist):
+            services.generate_ticket_secret(user, ev)
+
+        user.events.add(ev)
+        ev_other = Event.objects.create(title="Other Event",
+                                        description="Other event description",
+                                        datetime=timezone.datetime.now(timezone.utc))
+        user.events.add(ev_other)
         tkt_secret = services.generate_ticket_secret(user, ev)
         
         self.assertEqual(len(tkt_secret), 20)
-        self.assertEqual(tkt_secret[:10],
-                         bytes(str(ev.uuid)[-10:], encoding='utf-8'))
-        self.assertEqual(tkt_secret[-10:],
-                         bytes(str(user.uuid)[-10:], encoding='utf-8'))
+        self.assertEqual(tkt_secret,
+                         bytes(Registration.objects.get(event=ev, tktuser=user).secret))
+        self.assertNotEqual(tkt_secret, services.generate_ticket_secret(user, ev_other))
+
+    def test_registration_resolution(self):
+        ev = Event.objects.create(title="Some Event",
+                                  description="Some event description",
+                                  datetime=timezone.datetime.now(timezone.utc))
+        ev_other = Event.objects.create(title="Other Event",
+                                        description="Other event description",
+                                        datetime=timezone.datetime.now(timezone.utc))
+        user = TktUser.objects.create(user=User.objects.create_user('user999',
+                                                                    'user999@domain.com',
+                                                                    'user999pass'))
+        user.events.add(ev)
+
+        # Registrations are resolved with a single query
+        with self.assertNumQueries(1):
+            registration = services.resolve_registration(str(user.uuid), str(ev.uuid))
+            self.assertEqual(registration.event_id, ev.pk)
+            self.assertEqual(registration.tktuser_id, user.pk)
+            secret = bytes(registration.secret)
+        self.assertEqual(secret, services.generate_ticket_secret(user, ev))
+        self.assertIsNone(services.resolve_registration(user.uuid, ev_other.uuid))
+
+        # Failures are diagnosed in the order users, events
+        with self.assertRaises(TktUser.DoesNotExist):
+            services.resolve_registration(uuid.uuid4(), uuid.uuid4())
+        with self.assertRaises(TktUser.DoesNotExist):
+            services.resolve_registration('not-a-uuid', ev.uuid)
+        with self.assertRaises(Event.DoesNotExist):
+            services.resolve_registration(user.uuid, uuid.uuid4())
+        with self.assertRaises(Event.DoesNotExist):
+            services.resolve_registration(user.uuid, None)
 
 class ViewsTestCase(TestCase):
     def setUp(self):
+        # Primary keys are reused between tests, so forget codes used by other tests
+        cache.clear()
+        services._ledger.clear()
+        services._drift_counts.clear()
+        roster._rosters.clear()
+        tokens.clear_revocations()
         User.objects.create_superuser('superuser', password='supass')
         self.client = APIClient()
-        response = self.client.post('/api/login/',
+        response = self.client.post('/api/login',
                                     {'username': 'superuser', 'password': 'supass'})
         self.client.cookies = response.client.cookies
         self.ev = Event.objects.create(title="Event 1",
@@ -106,7 +367,7 @@ class ViewsTestCase(TestCase):
         # Test valid POST request with registered event-user pair
         request = self.client.post('/api/ticket/new', post_data)
         self.assertEqual(request.status_code, 200)
-        self.assertEqual(len(request.data['success']), 20)
+        self.assertEqual(len(base64.b32decode(request.data['success'])), 20)
 
     def test_ticket_auth(self):
         # /api/ticket/auth
@@ -152,8 +413,428 @@ class ViewsTestCase(TestCase):
         request = self.client.post('/api/ticket/auth', post_data)
         self.assertEqual(request.status_code, 200)
         self.assertTrue(request.data['ticket_is_valid'])
+        self.assertEqual(request.data['drift'], 0)
+        # Test replay of an accepted TOTP
+        request = self.client.post('/api/ticket/auth', post_data)
+        self.assertEqual(request.status_code, 409)
+        self.assertEqual(request.data['error'], 'TOTP code was already used.')
+        # Test valid POST request with TOTP from a skewed clock
+        post_data['ticket_totp'] = services.generate_totp(ticket_secret,
+                                                          counter=services._get_counter() - 1)
+        request = self.client.post('/api/ticket/auth', post_data)
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(request.data['ticket_is_valid'])
+        self.assertIn(request.data['drift'], (-1, 0))
+        # Test clock skew distribution of the event
+        request = self.client.get(f'/api/ticket/drift/{self.ev.uuid}')
+        self.assertEqual(request.status_code, 200)
+        self.assertGreaterEqual(sum(request.data['drift'].values()), 2)
         # Test valid POST request with incorrect TOTP
         post_data['ticket_totp'] = post_data['ticket_totp'][:5].zfill(6)
         request = self.client.post('/api/ticket/auth', post_data)
         self.assertEqual(request.status_code, 200)
         self.assertFalse(request.data['ticket_is_valid'])
+
+    def test_malformed_payloads(self):
+        TktAgent.objects.create(agent=User.objects.create_user('agent1', password='agent1pass'),
+                                event=self.ev)
+        agt_client = APIClient()
+        agt_client.post('/api/login', {'username': 'agent1', 'password': 'agent1pass'})
+        # Test that JSON bodies other than objects are rejected by every view
+        for client, uri in ((self.client, '/api/ticket/new'),
+                            (self.client, '/api/ticket/auth'),
+                            (self.client, '/api/ticket/auth/batch'),
+                            (self.client, '/api/ticket/auth/scan'),
+                            (agt_client, '/api/ticket/auth/scan'),
+                            (agt_client, '/api/ticket/session/auth'),
+                            (self.client, '/api/ticket/token/new'),
+                            (self.client, '/api/ticket/token/auth')):
+            for body in ('[]', '["ticket_totp"]', '"ticket_totp"', '42', 'null'):
+                request = client.post(uri, body, content_type='application/json')
+                self.assertEqual(request.status_code, 400, (uri, body))
+                self.assertEqual(request.data['error'], 'Malformed payload.')
+
+    def test_ticket_async(self):
+        # /api/ticket/new/async, /api/ticket/auth/async
+        post_data = {'user_uuid': str(self.usr.uuid),
+                     'event_uuid': str(self.ev.uuid)}
+        # Test error responses of both views
+        request = self.client.get('/api/ticket/new/async')
+        self.assertEqual(request.status_code, 405)
+        request = self.client.post('/api/ticket/new/async', '[]',
+                                   content_type='application/json')
+        self.assertEqual(request.status_code, 400)
+        request = self.client.post('/api/ticket/new/async',
+                                   {'user_uuid': str(uuid.uuid4()),
+                                    'event_uuid': str(self.ev.uuid)})
+        self.assertEqual(request.status_code, 404)
+        self.assertEqual(request.json()['error'], 'User does not exist.')
+        request = self.client.post('/api/ticket/auth/async',
+                                   {'user_uuid': str(self.usr.uuid),
+                                    'event_uuid': 'not-a-uuid'})
+        self.assertEqual(request.status_code, 404)
+        self.assertEqual(request.json()['error'], 'Event does not exist.')
+        request = self.client.post('/api/ticket/auth/async', post_data)
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(request.json()['error'], 'TOTP code was not supplied.')
+        request = self.client.post('/api/ticket/new/async', post_data)
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(request.json()['error'], 'User not registered to event.')
+        # Test that the async views agree with their sync counterparts
+        self.usr.events.add(self.ev)
+        request = self.client.post('/api/ticket/new/async', post_data, format='json')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.json(),
+                         self.client.post('/api/ticket/new', post_data).data)
+        ticket_secret = base64.b32decode(request.json()['success'])
+        post_data['ticket_totp'] = services.generate_totp(ticket_secret)
+        request = self.client.post('/api/ticket/auth/async', post_data, format='json')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.json(), {'ticket_is_valid': True, 'drift': 0})
+        request = self.client.post('/api/ticket/auth/async', post_data, format='json')
+        self.assertEqual(request.status_code, 409)
+        self.assertEqual(request.json()['error'], 'TOTP code was already used.')
+
+    def test_ticket_auth_fast(self):
+        # /api/ticket/auth/fast
+        other = Event.objects.create(title="Event 2",
+                                     description="This is the second event.",
+                                     datetime=timezone.datetime.now(timezone.utc))
+        self.usr.events.add(self.ev)
+        ticket_secret = services.generate_ticket_secret(self.usr, self.ev)
+        totp = services.generate_totp(ticket_secret)
+        payloads = [{'user_uuid': str(uuid.uuid4()), 'event_uuid': str(self.ev.uuid),
+                     'ticket_totp': totp},
+                    {'user_uuid': str(self.usr.uuid), 'event_uuid': 'not-a-uuid',
+                     'ticket_totp': totp},
+                    {'user_uuid': str(self.usr.uuid), 'event_uuid': str(self.ev.uuid)},
+                    {'user_uuid': str(self.usr.uuid), 'event_uuid': str(other.uuid),
+                     'ticket_totp': totp},
+                    {'user_uuid': str(self.usr.uuid), 'event_uuid': str(self.ev.uuid),
+                     'ticket_totp': totp[:5].zfill(6)}]
+        # Test that responses are identical to the ones of the DRF view
+        for payload in payloads:
+            expected = self.client.post('/api/ticket/auth', payload, format='json')
+            request = self.client.post('/api/ticket/auth/fast', payload, format='json')
+            self.assertEqual(request.status_code, expected.status_code)
+            self.assertEqual(request.content, expected.content)
+        # Test binary requests with correct TOTP and replays
+        body = self.usr.uuid.bytes + self.ev.uuid.bytes + totp.encode()
+        request = self.client.post('/api/ticket/auth/fast', body,
+                                   content_type='application/octet-stream')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.content, b'{"ticket_is_valid":true,"drift":0}')
+        request = self.client.post('/api/ticket/auth', payloads[-1] | {'ticket_totp': totp},
+                                   format='json')
+        replayed = self.client.post('/api/ticket/auth/fast', body,
+                                    content_type='application/octet-stream')
+        self.assertEqual(replayed.status_code, 409)
+        self.assertEqual(replayed.content, request.content)
+        # Test malformed requests
+        request = self.client.post('/api/ticket/auth/fast', body[:-1],
+                                   content_type='application/octet-stream')
+        self.assertEqual(request.status_code, 400)
+        request = self.client.post('/api/ticket/auth/fast', '[]',
+                                   content_type='application/json')
+        self.assertEqual(request.status_code, 400)
+        request = self.client.get('/api/ticket/auth/fast')
+        self.assertEqual(request.status_code, 405)
+        self.assertEqual(request.content, self.client.get('/api/ticket/auth').content)
+
+    def test_ticket_auth_batch(self):
+        # /api/ticket/auth/batch
+        usr2 = TktUser.objects.create(user=User.objects.create_user('user2',
+                                                                    password='user2pass'))
+        self.usr.events.add(self.ev)
+        ticket_secret = services.generate_ticket_secret(self.usr, self.ev)
+        totp = services.generate_totp(ticket_secret)
+        tickets = [{'user_uuid': str(self.usr.uuid),
+                    'event_uuid': str(self.ev.uuid),
+                    'ticket_totp': totp},
+                   {'user_uuid': str(self.usr.uuid),
+                    'event_uuid': str(self.ev.uuid),
+                    'ticket_totp': totp[:5].zfill(6)},
+                   {'user_uuid': str(uuid.uuid4()),
+                    'event_uuid': str(self.ev.uuid),
+                    'ticket_totp': totp},
+                   {'user_uuid': str(self.usr.uuid),
+                    'event_uuid': 'not-a-uuid',
+                    'ticket_totp': totp},
+                   {'user_uuid': str(self.usr.uuid),
+                    'event_uuid': str(self.ev.uuid)},
+                   {'user_uuid': str(usr2.uuid),
+                    'event_uuid': str(self.ev.uuid),
+                    'ticket_totp': totp},
+                   'malformed']
+        # Test valid POST request with mixed tickets
+        request = self.client.post('/api/ticket/auth/batch',
+                                   {'tickets': tickets}, format='json')
+        self.assertEqual(request.status_code, 200)
+        results = request.data['results']
+        self.assertEqual(len(results), len(tickets))
+        self.assertTrue(results[0]['ticket_is_valid'])
+        self.assertEqual(services.authenticate_ticket_batch(tickets[:1])[0]['status'], 409)
+        self.assertFalse(results[1]['ticket_is_valid'])
+        self.assertEqual(results[2]['error'], 'User does not exist.')
+        self.assertEqual(results[3]['error'], 'Event does not exist.')
+        self.assertEqual(results[4]['error'], 'TOTP code was not supplied.')
+        self.assertEqual(results[5]['error'], 'User is not registered to event.')
+        self.assertEqual(results[6]['status'], 400)
+        # Test that the query count does not grow with the batch size
+        with CaptureQueriesContext(connection) as small:
+            self.client.post('/api/ticket/auth/batch',
+                             {'tickets': tickets[:1]}, format='json')
+        with CaptureQueriesContext(connection) as large:
+            self.client.post('/api/ticket/auth/batch',
+                             {'tickets': tickets * 50}, format='json')
+        self.assertEqual(len(small), len(large))
+        # Test POST request with malformed payload and oversized batch
+        request = self.client.post('/api/ticket/auth/batch',
+                                   {'tickets': 'malformed'}, format='json')
+        self.assertEqual(request.status_code, 400)
+        request = self.client.post('/api/ticket/auth/batch',
+                                   {'tickets': tickets[:1] * (services.BATCH_SIZE_LIMIT + 1)},
+                                   format='json')
+        self.assertEqual(request.status_code, 400)
+        # Test batch verification by user
+        usr_client = APIClient()
+        usr_client.post('/api/login', {'username': 'user2', 'password': 'user2pass'})
+        request = usr_client.post('/api/ticket/auth/batch',
+                                  {'tickets': tickets}, format='json')
+        self.assertEqual(request.status_code, 403)
+
+    def test_ticket_auth_scan(self):
+        # /api/ticket/auth/scan
+        usr2 = TktUser.objects.create(user=User.objects.create_user('user2',
+                                                                    password='user2pass'))
+        self.usr.events.add(self.ev)
+        totp = services.generate_totp(services.generate_ticket_secret(self.usr, self.ev))
+        # Test valid POST request with correct TOTP
+        request = self.client.post('/api/ticket/auth/scan',
+                                   {'event_uuid': str(self.ev.uuid),
+                                    'ticket_totp': totp})
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(request.data['ticket_is_valid'])
+        self.assertEqual(request.data['user_uuid'], self.usr.uuid)
+        self.assertIn('drift', request.data)
+        # Test valid POST request with incorrect TOTP
+        request = self.client.post('/api/ticket/auth/scan',
+                                   {'event_uuid': str(self.ev.uuid),
+                                    'ticket_totp': totp[:5].zfill(6)})
+        self.assertEqual(request.status_code, 200)
+        self.assertFalse(request.data['ticket_is_valid'])
+        # Test that registration changes invalidate the index
+        usr2.events.add(self.ev)
+        totp2 = services.generate_totp(services.generate_ticket_secret(usr2, self.ev))
+        request = self.client.post('/api/ticket/auth/scan',
+                                   {'event_uuid': str(self.ev.uuid),
+                                    'ticket_totp': totp2})
+        self.assertEqual(request.data['user_uuid'], usr2.uuid)
+        self.usr.events.remove(self.ev)
+        self.assertEqual(codeindex.lookup(self.ev.pk, totp), ())
+        # Test colliding codes
+        codeindex._indexes[self.ev.pk] = codeindex.EventCodeIndex(
+            services._get_counter(), {'123456': ((self.usr.uuid, self.usr.pk, 0), (usr2.uuid, usr2.pk, 0))})
+        request = self.client.post('/api/ticket/auth/scan',
+                                   {'event_uuid': str(self.ev.uuid),
+                                    'ticket_totp': '123456'})
+        self.assertEqual(request.status_code, 409)
+        codeindex.invalidate(self.ev.pk)
+        # Test that building the index of an event does not block lookups at
+        # other events, and that invalidations during a build discard its index
+        started, release = threading.Event(), threading.Event()
+        def build_index(event_id, counter):
+            if event_id == -1:
+                started.set()
+                release.wait(5)
+            return codeindex.EventCodeIndex(counter, {'123456': ((None, event_id, 0),)})
+        with patch.object(codeindex, 'build_index', side_effect=build_index):
+            thread = threading.Thread(target=codeindex.lookup, args=(-1, '123456', 10))
+            thread.start()
+            self.assertTrue(started.wait(5))
+            self.assertEqual(codeindex.lookup(-2, '123456', 10), ((None, -2, 0),))
+            codeindex.invalidate(-1)
+            release.set()
+            thread.join()
+        self.assertNotIn(-1, codeindex._indexes)
+        # Test POST request with non-existent event and malformed payload
+        request = self.client.post('/api/ticket/auth/scan',
+                                   {'event_uuid': str(uuid.uuid4()),
+                                    'ticket_totp': totp})
+        self.assertEqual(request.status_code, 404)
+        request = self.client.post('/api/ticket/auth/scan',
+                                   {'event_uuid': str(self.ev.uuid)})
+        self.assertEqual(request.status_code, 400)
+        # Test scan by agent, which implies the event, of an already used code
+        agent = User.objects.create_user('agent1', password='agent1pass')
+        TktAgent.objects.create(agent=agent, event=self.ev)
+        agt_client = APIClient()
+        agt_client.post('/api/login', {'username': 'agent1', 'password': 'agent1pass'})
+        request = agt_client.post('/api/ticket/auth/scan', {'ticket_totp': totp2})
+        self.assertEqual(request.status_code, 409)
+        self.assertEqual(request.data['error'], 'TOTP code was already used.')
+        # Test scan by user
+        usr_client = APIClient()
+        usr_client.post('/api/login', {'username': 'user2', 'password': 'user2pass'})
+        request = usr_client.post('/api/ticket/auth/scan', {'ticket_totp': totp2})
+        self.assertEqual(request.status_code, 403)
+
+    def test_ticket_bundle(self):
+        # /api/ticket/bundle
+        usr2 = TktUser.objects.create(user=User.objects.create_user('user2',
+                                                                    password='user2pass'))
+        TktAgent.objects.create(agent=User.objects.create_user('agent1', password='agent1pass'),
+                                event=self.ev)
+        agt_client = APIClient()
+        agt_client.post('/api/login', {'username': 'agent1', 'password': 'agent1pass'})
+        self.usr.events.add(self.ev)
+        # Test valid GET request
+        request = agt_client.get('/api/ticket/bundle', {'steps': 4})
+        self.assertEqual(request.status_code, 200)
+        bundle = bundles.parse_bundle(request.content)
+        self.assertEqual(bundle['steps'], 4)
+        self.assertEqual(list(bundle['records']), [self.usr.uuid.bytes])
+        # Test that digests match the codes of the user
+        ticket_secret = services.generate_ticket_secret(self.usr, self.ev)
+        for i, digest in enumerate(bundle['records'][self.usr.uuid.bytes]):
+            counter = bundle['start'] + i
+            code = services.generate_totp(ticket_secret, counter=counter)
+            self.assertEqual(bundles.code_digest(bundle['salt'], counter,
+                                                 self.usr.uuid.bytes, code),
+                             digest)
+        self.assertNotIn(ticket_secret, request.content)
+        # Test incremental refresh after registration changes
+        usr2.events.add(self.ev)
+        self.usr.events.remove(self.ev)
+        request = agt_client.get('/api/ticket/bundle',
+                                 {'steps': 4, 'since': bundle['seq'], 'start': bundle['start']})
+        self.assertEqual(request.status_code, 200)
+        delta = bundles.parse_bundle(request.content)
+        self.assertEqual(delta['salt'], bundle['salt'])
+        self.assertEqual(list(delta['records']), [usr2.uuid.bytes])
+        self.assertEqual(delta['removed'], [self.usr.uuid.bytes])
+        # Test refresh with no changes, whose sequence number is not moved by
+        # changes of other events
+        ev_other = Event.objects.create(title="Other Event", description="Other event",
+                                        datetime=timezone.datetime.now(timezone.utc))
+        usr2.events.add(ev_other)
+        request = agt_client.get('/api/ticket/bundle',
+                                 {'steps': 4, 'since': delta['seq'], 'start': bundle['start']})
+        self.assertEqual(bundles.parse_bundle(request.content)['seq'], delta['seq'])
+        delta = bundles.parse_bundle(request.content)
+        self.assertEqual((delta['records'], delta['removed']), ({}, []))
+        # Test that changes are recorded with their event locked
+        with patch.object(Event.objects, 'select_for_update',
+                          wraps=Event.objects.select_for_update) as select_for_update:
+            self.usr.events.add(self.ev)
+        select_for_update.assert_called_once_with()
+        # Test GET request with malformed and out of range parameters
+        request = agt_client.get('/api/ticket/bundle', {'steps': 'many'})
+        self.assertEqual(request.status_code, 400)
+        request = agt_client.get('/api/ticket/bundle',
+                                 {'steps': bundles.BUNDLE_MAX_STEPS + 1})
+        self.assertEqual(request.status_code, 400)
+        request = agt_client.get('/api/ticket/bundle', {'start': 0})
+        self.assertEqual(request.status_code, 400)
+        # Test GET request by non-agent
+        request = self.client.get('/api/ticket/bundle')
+        self.assertEqual(request.status_code, 403)
+
+    def test_ticket_session(self):
+        # /api/ticket/session, /api/ticket/session/auth
+        usr2 = TktUser.objects.create(user=User.objects.create_user('user2',
+                                                                    password='user2pass'))
+        TktAgent.objects.create(agent=User.objects.create_user('agent1', password='agent1pass'),
+                                event=self.ev)
+        agt_client = APIClient()
+        agt_client.post('/api/login', {'username': 'agent1', 'password': 'agent1pass'})
+        self.usr.events.add(self.ev)
+        ticket_secret = services.generate_ticket_secret(self.usr, self.ev)
+        # Test session start
+        request = agt_client.post('/api/ticket/session')
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.data['registrations'], 1)
+        # Test that registered users are verified without querying their registration
+        post_data = {'user_uuid': str(self.usr.uuid),
+                     'ticket_totp': services.generate_totp(ticket_secret)}
+        with CaptureQueriesContext(connection) as queries:
+            request = agt_client.post('/api/ticket/session/auth', post_data)
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.data, {'ticket_is_valid': True, 'drift': 0})
+        self.assertFalse(any('registration' in query['sql'] for query in queries))
+        request = agt_client.post('/api/ticket/session/auth', post_data)
+        self.assertEqual(request.status_code, 409)
+        # Test error responses
+        request = agt_client.post('/api/ticket/session/auth',
+                                  {'user_uuid': str(uuid.uuid4()), 'ticket_totp': '123456'})
+        self.assertEqual(request.status_code, 404)
+        request = agt_client.post('/api/ticket/session/auth', {'user_uuid': str(self.usr.uuid)})
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(request.data['error'], 'TOTP code was not supplied.')
+        request = agt_client.post('/api/ticket/session/auth',
+                                  {'user_uuid': str(usr2.uuid), 'ticket_totp': '123456'})
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(request.data['error'], 'User is not registered to event.')
+        # Test that registration changes patch the roster
+        usr2.events.add(self.ev)
+        self.usr.events.remove(self.ev)
+        usr2_secret = services.generate_ticket_secret(usr2, self.ev)
+        request = agt_client.post('/api/ticket/session/auth',
+                                  {'user_uuid': str(usr2.uuid),
+                                   'ticket_totp': services.generate_totp(usr2_secret)})
+        self.assertTrue(request.data['ticket_is_valid'])
+        request = agt_client.post('/api/ticket/session/auth', post_data)
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(len(roster.get_roster(self.ev.pk)), 1)
+        # Test session end and requests by non-agents
+        request = agt_client.delete('/api/ticket/session')
+        self.assertEqual(request.status_code, 204)
+        self.assertNotIn(self.ev.pk, roster._rosters)
+        request = self.client.post('/api/ticket/session')
+        self.assertEqual(request.status_code, 403)
+        request = self.client.post('/api/ticket/session/auth', post_data)
+        self.assertEqual(request.status_code, 403)
+
+    def test_ticket_token(self):
+        # /api/ticket/token/new, /api/ticket/token/auth
+        post_data = {'user_uuid': str(self.usr.uuid),
+                     'event_uuid': str(self.ev.uuid)}
+        # Test POST request with unregistered event-user pair
+        request = self.client.post('/api/ticket/token/new', post_data)
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(request.data['error'], 'User not registered to event.')
+        # Test valid POST request with registered event-user pair
+        self.usr.events.add(self.ev)
+        request = self.client.post('/api/ticket/token/new', post_data)
+        self.assertEqual(request.status_code, 200)
+        ticket_secret = base64.b32decode(request.data['ticket_secret'])
+        self.assertEqual(ticket_secret, services.generate_ticket_secret(self.usr, self.ev))
+        token = request.data['ticket_token']
+        # Test that tokens are verified without querying the database
+        scanner = APIClient()
+        auth_data = {'ticket_token': token,
+                     'ticket_totp': services.generate_totp(ticket_secret)}
+        tokens._refresh_revocations()
+        services.flush_drift()
+        with self.assertNumQueries(0):
+            request = scanner.post('/api/ticket/token/auth', auth_data)
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.data, {'ticket_is_valid': True, 'drift': 0})
+        request = scanner.post('/api/ticket/token/auth', auth_data)
+        self.assertEqual(request.status_code, 409)
+        # Test error responses
+        request = scanner.post('/api/ticket/token/auth', {'ticket_totp': '123456'})
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(request.data['error'], 'Ticket token was not supplied.')
+        tampered = token[:20] + ('B' if token[20] == 'A' else 'A') + token[21:]
+        request = scanner.post('/api/ticket/token/auth', {'ticket_token': tampered,
+                                                          'ticket_totp': '123456'})
+        self.assertEqual(request.status_code, 400)
+        request = scanner.post('/api/ticket/token/auth', {'ticket_token': token})
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(request.data['error'], 'TOTP code was not supplied.')
+        # Test that tokens are revoked along with their registration
+        self.usr.events.remove(self.ev)
+        request = scanner.post('/api/ticket/token/auth', auth_data)
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(request.data['error'], 'Ticket token was revoked.')
@@ -0,0 +1,227 @@
+"""Stateless signed ticket tokens.
+
+A token carries everything needed to verify the codes of a ticket: the ids of
+the event and the user, the ticket secret and an expiry. Tokens are signed, so
+verifiers can validate them and compute codes without querying the database.
+Tokens are encoded as unpadded URL-safe base64 of the following big-endian
+layout:
+
+    version (B) key id (B) event id (Q) user id (Q) issued (Q) expires (I)
+    nonce (16s) masked secret (SECRET_LENGTH s) signature (16s)
+
+``issued`` is a Unix time in milliseconds and ``expires`` one in seconds.
+The secret is masked with a keystream derived from the signing key and the
+random nonce, so that it is only readable by the server. The signature is a
+truncated HMAC-SHA256 of all preceding bytes.
+
+Tokens of a registration are revoked when the registration is removed. The
+revocations are loaded into memory and refreshed from the database at most
+every REVOCATION_REFRESH_INTERVAL seconds. Revocations may commit in another
+order than they were made, so every refresh loads again the ones made within
+REVOCATION_OVERLAP of the latest loaded one, and all revocations of unexpired
+tokens are reloaded every REVOCATION_RELOAD_INTERVAL seconds. Reloads also
+delete the revocations whose tokens have all expired.
+"""
+
+import base64
+import binascii
+import functools
+import hmac
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from datetime import timedelta
+from django.conf import settings
+from django.dispatch import receiver
+from entityhandler.models import Event
+from entityhandler.signals import registrations_changed
+from otphandler import services
+from otphandler.models import TicketRevocation
+
+TOKEN_VERSION = 1
+# Length of the nonce that the secret mask is derived from, in bytes.
+NONCE_LENGTH = 16
+# Length of token signatures, in bytes.
+SIGNATURE_LENGTH = 16
+# Duration after the start of an event during which its tokens are valid.
+TOKEN_VALIDITY = timedelta(days=1)
+# Maximum age of the in-memory revocations, in seconds.
+REVOCATION_REFRESH_INTERVAL = 5
+# Maximum delay between making and committing a revocation after which it is
+# still applied on the next refresh, in milliseconds.
+REVOCATION_OVERLAP = 60000
+# Interval at which all revocations are reloaded, in seconds. Bounds the delay
+# of revocations that were committed more than REVOCATION_OVERLAP late.
+REVOCATION_RELOAD_INTERVAL = 300
+
+_BODY = struct.Struct('>BBQQQI%ds%ds' % (NONCE_LENGTH, services.SECRET_LENGTH))
+
+TicketToken = namedtuple('TicketToken', ['event_id', 'user_id', 'secret', 'issued', 'expires'])
+
+class InvalidTokenError(Exception):
+    """Raised for tokens that are malformed, not validly signed, expired or revoked."""
+
+@functools.lru_cache(maxsize=16)
+def _derive_keys(key: str) -> tuple:
+    """Return the (signing key, masking key) derived from configured key material."""
+    key = key.encode()
+    return (hmac.digest(key, b'otphandler.tokens.sign', 'sha256'),
+            hmac.digest(key, b'otphandler.tokens.mask', 'sha256'))
+
+def _get_keys(key_id: int) -> tuple:
+    """Return the derived keys of key_id, or None if key_id is not configured."""
+    key = settings.TICKET_SIGNING_KEYS.get(key_id)
+    return None if key is None else _derive_keys(key)
+
+def _mask(mask_key: bytes, nonce: bytes, event_id: int, user_id: int) -> bytes:
+    """Return the keystream that the secret of a token is XORed with."""
+    message = nonce + event_id.to_bytes(8, 'big') + user_id.to_bytes(8, 'big')
+    return hmac.digest(mask_key, message, 'sha256')[:services.SECRET_LENGTH]
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+def _now_ms() -> int:
+    """Return the current Unix time in milliseconds."""
+    return time.time_ns() // 1000000
+
+def token_expiry(event_datetime) -> int:
+    """Return the Unix time at which tokens of an event starting at event_datetime expire."""
+    return int((event_datetime + TOKEN_VALIDITY).timestamp())
+
+def issue_token(event_id: int, user_id: int, secret: bytes, expires: int) -> str:
+    """Issues a token for the registration of a user to an event, signed with
+    the key of TICKET_SIGNING_KEY_ID.
+
+    Args:
+        event_id (int): Primary key of the event.
+        user_id (int): Primary key of the user.
+        secret (bytes): The ticket secret of the registration.
+        expires (int): Unix time at which the token expires.
+
+    Returns:
+        str: The encoded token.
+    """
+    key_id = settings.TICKET_SIGNING_KEY_ID
+    sign_key, mask_key = _get_keys(key_id)
+    nonce = os.urandom(NONCE_LENGTH)
+    # Issued strictly after the latest revocation, even within its millisecond
+    issued = max(_now_ms(), _latest_revocation(event_id, user_id) + 1)
+    body = _BODY.pack(TOKEN_VERSION, key_id, event_id, user_id, issued, expires,
+                      nonce, _xor(secret, _mask(mask_key, nonce, event_id, user_id)))
+    signature = hmac.digest(sign_key, body, 'sha256')[:SIGNATURE_LENGTH]
+
+    return base64.urlsafe_b64encode(body + signature).rstrip(b'=').decode()
+
+def read_token(token: str, now: float = None) -> TicketToken:
+    """Validates a token and returns its contents.
+
+    Args:
+        token (str): The encoded token.
+        now (float, optional): Unix time to check the expiry against.
+                               Defaults to the current time.
+
+    Returns:
+        TicketToken: The event id, user id, ticket secret, issue time and expiry of the token.
+
+    Raises:
+        InvalidTokenError: If the token is malformed, not validly signed,
+                           expired or revoked.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (TypeError, ValueError, binascii.Error):
+        raise InvalidTokenError('Ticket token is malformed.')
+    if len(raw) != _BODY.size + SIGNATURE_LENGTH or raw[0] != TOKEN_VERSION:
+        raise InvalidTokenError('Ticket token is malformed.')
+
+    body, signature = raw[:_BODY.size], raw[_BODY.size:]
+    (_, key_id, event_id, user_id,
+     issued, expires, nonce, masked) = _BODY.unpack(body)
+    keys = _get_keys(key_id)
+    if keys is None or not hmac.compare_digest(
+            hmac.digest(keys[0], body, 'sha256')[:SIGNATURE_LENGTH], signature):
+        raise InvalidTokenError('Ticket token signature is invalid.')
+    if expires <= (time.time() if now is None else now):
+        raise InvalidTokenError('Ticket token has expired.')
+    if is_revoked(event_id, user_id, issued):
+        raise InvalidTokenError('Ticket token was revoked.')
+
+    secret = _xor(masked, _mask(keys[1], nonce, event_id, user_id))
+    return TicketToken(event_id, user_id, secret, issued, expires)
+
+# Maps (event id, user id) pairs to the Unix time of their latest revocation, in milliseconds.
+_revocations = {}
+_revocations_lock = threading.Lock()
+# Latest loaded revocation time, and monotonic times of the last refresh and reload.
+_revocations_watermark = 0
+_revocations_refreshed_at = float('-inf')
+_revocations_reloaded_at = float('-inf')
+
+def _refresh_revocations():
+    """Loads revocations made since the last refresh, or all revocations of
+    unexpired tokens if they were not reloaded for REVOCATION_RELOAD_INTERVAL."""
+    global _revocations, _revocations_watermark
+    global _revocations_refreshed_at, _revocations_reloaded_at
+    with _revocations_lock:
+        now = time.monotonic()
+        reload = now - _revocations_reloaded_at >= REVOCATION_RELOAD_INTERVAL
+        revocations = TicketRevocation.objects.filter(expires__gt=int(time.time()))
+        if reload:
+            TicketRevocation.objects.filter(expires__lte=int(time.time())).delete()
+            # Replaced rather than cleared, as lookups do not hold the lock
+            loaded = {}
+        else:
+            revocations = revocations.filter(
+                revoked_at__gte=_revocations_watermark - REVOCATION_OVERLAP)
+            loaded = _revocations
+        for event_id, user_id, revoked_at in revocations.values_list('event_id', 'user_id',
+                                                                     'revoked_at'):
+            key = (event_id, user_id)
+            loaded[key] = max(loaded.get(key, 0), revoked_at)
+            _revocations_watermark = max(_revocations_watermark, revoked_at)
+        _revocations = loaded
+        _revocations_refreshed_at = now
+        if reload:
+            _revocations_reloaded_at = now
+
+def _latest_revocation(event_id: int, user_id: int) -> int:
+    """Return the Unix time of the latest revocation of the tokens of a user for
+    an event in milliseconds, or 0 if they were never revoked."""
+    if time.monotonic() - _revocations_refreshed_at >= REVOCATION_REFRESH_INTERVAL:
+        _refresh_revocations()
+    return _revocations.get((event_id, user_id), 0)
+
+def is_revoked(event_id: int, user_id: int, issued: int) -> bool:
+    """Return whether tokens of a user for an event issued at issued (Unix time
+    in milliseconds) are revoked."""
+    return issued <= _latest_revocation(event_id, user_id)
+
+def clear_revocations():
+    """Forgets the revocations loaded in-process, so that all are reloaded on next use."""
+    global _revocations_watermark, _revocations_refreshed_at, _revocations_reloaded_at
+    with _revocations_lock:
+        _revocations.clear()
+        _revocations_watermark = 0
+        _revocations_refreshed_at = _revocations_reloaded_at = float('-inf')
+
+@receiver(registrations_changed)
+def _revoke_removed_registrations(sender, action, pairs, **kwargs):
+    if action != 'remove':
+        return
+    revoked_at = _now_ms()
+    datetimes = dict(Event.objects.filter(pk__in={event_id for event_id, _ in pairs})
+                                  .values_list('pk', 'datetime'))
+    # Tokens of unknown events are issued no more, so revocations of them are
+    # kept for one validity
+    default_expiry = revoked_at // 1000 + int(TOKEN_VALIDITY.total_seconds())
+    TicketRevocation.objects.bulk_create(
+        [TicketRevocation(event_id=event_id, user_id=user_id, revoked_at=revoked_at,
+                          expires=(token_expiry(datetimes[event_id]) if event_id in datetimes
+                                   else default_expiry))
+         for event_id, user_id in pairs])
+    # Apply revocations made by this process on next use
+    global _revocations_refreshed_at
+    _revocations_refreshed_at = float('-inf')
@@ -1,7 +1,18 @@
 from django.urls import path
-from . import views
+from . import async_views, fast_views, views
 
 urlpatterns = [
     path('ticket/new', views.ticket_new, name='ticket_new'),
-    path('ticket/auth', views.ticket_auth, name='ticket_auth')
+    path('ticket/new/async', async_views.ticket_new, name='ticket_new_async'),
+    path('ticket/auth', views.ticket_auth, name='ticket_auth'),
+    path('ticket/auth/async', async_views.ticket_auth, name='ticket_auth_async'),
+    path('ticket/auth/fast', fast_views.ticket_auth, name='ticket_auth_fast'),
+    path('ticket/auth/batch', views.ticket_auth_batch, name='ticket_auth_batch'),
+    path('ticket/auth/scan', views.ticket_auth_scan, name='ticket_auth_scan'),
+    path('ticket/drift/<uuid:event_uuid>', views.ticket_drift, name='ticket_drift'),
+    path('ticket/bundle', views.ticket_bundle, name='ticket_bundle'),
+    path('ticket/session', views.ticket_session, name='ticket_session'),
+    path('ticket/session/auth', views.ticket_session_auth, name='ticket_session_auth'),
+    path('ticket/token/new', views.ticket_token_new, name='ticket_token_new'),
+    path('ticket/token/auth', views.ticket_token_auth, name='ticket_token_auth')
 ]
@@ -1,7 +1,11 @@
+import base64
+from django.http import HttpResponse
+from entityhandler import roles
 from entityhandler.models import *
-from otphandler import services
+from otphandler import bundles, codeindex, roster, services, tokens
 from rest_framework import status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
 
@@ -9,60 +13,337 @@ from rest_framework.response import Response
 def ticket_new(request):
     """Checks whether a ``TktUser`` with ``user_uuid`` is registered to
     an ``Event`` with ``event_uuid``.
-    If registered, sends a JSON response with the ticket-unique secret.
+    If registered, sends a JSON response with the base32-encoded ticket-unique secret.
     JSON format: {'user_uuid': <str>, 'event_uuid': <str>}
     """
     if request.method == 'POST':
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Malformed payload.'},
+                            status.HTTP_400_BAD_REQUEST)
         try:
-            user = TktUser.objects.get(uuid=request.data['user_uuid'])
-        except:
+            registration = services.resolve_registration(request.data.get('user_uuid'),
+                                                         request.data.get('event_uuid'))
+        except TktUser.DoesNotExist:
             return Response({'error': 'User does not exist.'},
                             status.HTTP_404_NOT_FOUND)
-        
-        try:
-            event = Event.objects.get(uuid=request.data['event_uuid'])
-        except:
+        except Event.DoesNotExist:
             return Response({'error': 'Event does not exist.'},
                             status.HTTP_404_NOT_FOUND)
 
-        if not event.user_is_registered(user):
+        if registration is None:
             return Response({'error': 'User not registered to event.'},
                             status.HTTP_400_BAD_REQUEST)
-        tkt_secret = services.generate_ticket_secret(user, event)
-        return Response({'success': tkt_secret},
+        tkt_secret = bytes(registration.secret)
+        return Response({'success': base64.b32encode(tkt_secret).decode()},
                         status.HTTP_200_OK)
 
 @api_view(['POST'])
 def ticket_auth(request):
     """Verifies a ticket-generated TOTP code given an ``Event`` and ``TktUser``.
+    Codes of neighboring time steps are accepted to tolerate clock skew, in which
+    case the response reports the drift of the matched time step.
+    Each code is only accepted once.
     JSON format: {'user_uuid': <str>, 'event_uuid': <str>, 'ticket_totp': <str>}
     """
     if request.method == 'POST':
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Malformed payload.'},
+                            status.HTTP_400_BAD_REQUEST)
         try:
-            user = TktUser.objects.get(uuid=request.data['user_uuid'])
-        except:
+            registration = services.resolve_registration(request.data.get('user_uuid'),
+                                                         request.data.get('event_uuid'))
+        except TktUser.DoesNotExist:
             return Response({'error': 'User does not exist.'},
                             status.HTTP_404_NOT_FOUND)
+        except Event.DoesNotExist:
+            return Response({'error': 'Event does not exist.'},
+                            status.HTTP_404_NOT_FOUND)
         
         try:
-            event = Event.objects.get(uuid=request.data['event_uuid'])
+            totp = request.data['ticket_totp']
+        except:
+            return Response({'error': 'TOTP code was not supplied.'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        if registration is None:
+            return Response({'error': 'User is not registered to event.'},
+                            status.HTTP_400_BAD_REQUEST)
+        tkt_secret = bytes(registration.secret)
+        try:
+            drift = services.verify_ticket(tkt_secret, totp, registration.event_id,
+                                           registration.tktuser_id)
+        except services.CodeReplayedError:
+            return Response({'error': 'TOTP code was already used.'},
+                            status.HTTP_409_CONFLICT)
+        if drift is not None:
+            return Response({'ticket_is_valid': True, 'drift': drift},
+                            status.HTTP_200_OK)
+        else:
+            return Response({'ticket_is_valid': False},
+                            status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def ticket_auth_batch(request):
+    """Verifies a batch of ticket-generated TOTP codes in a single request.
+    Responds with one result per ticket, in the order they were supplied.
+    JSON format: {'tickets': [{'user_uuid': <str>, 'event_uuid': <str>,
+                               'ticket_totp': <str>}, ...]}
+    """
+    if request.method == 'POST':
+        if not request.user.is_superuser and roles.get_role(request) == roles.USER:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        tickets = request.data.get('tickets') if isinstance(request.data, dict) else None
+        if not isinstance(tickets, list):
+            return Response({'error': 'Malformed payload.'},
+                            status.HTTP_400_BAD_REQUEST)
+        if len(tickets) > services.BATCH_SIZE_LIMIT:
+            return Response({'error': 'Batch exceeds ' + str(services.BATCH_SIZE_LIMIT)
+                                      + ' tickets.'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        return Response({'results': services.authenticate_ticket_batch(tickets)},
+                        status.HTTP_200_OK)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def ticket_auth_scan(request):
+    """Verifies a ticket-generated TOTP code without the uuid of the ``TktUser``.
+    Agents verify codes for the ``Event`` they are assigned to, while admins and
+    superusers must supply ``event_uuid``.
+    If valid, the response contains the uuid of the ``TktUser`` owning the ticket.
+    JSON format: {'ticket_totp': <str>, 'event_uuid': <str, optional>}
+    """
+    if request.method == 'POST':
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Malformed payload.'},
+                            status.HTTP_400_BAD_REQUEST)
+        agent = roles.get_profile(request, roles.AGENT)
+        if agent is not None:
+            event_id = agent.event_id
+        elif request.user.is_superuser or roles.get_role(request) == roles.ADMIN:
+            try:
+                event_id = Event.objects.values_list('pk', flat=True).get(
+                               uuid=request.data['event_uuid'])
+            except:
+                return Response({'error': 'Event does not exist.'},
+                                status.HTTP_404_NOT_FOUND)
+        else:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        totp = request.data.get('ticket_totp')
+        if not isinstance(totp, str):
+            return Response({'error': 'TOTP code was not supplied.'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        counter = services._get_counter()
+        matches = codeindex.lookup(event_id, totp, counter)
+        if len(matches) > 1:
+            return Response({'error': 'TOTP code matches multiple users.'},
+                            status.HTTP_409_CONFLICT)
+        if not matches:
+            return Response({'ticket_is_valid': False},
+                            status.HTTP_200_OK)
+        user_uuid, user_id, drift = matches[0]
+        try:
+            services.claim_code(event_id, user_id, counter + drift)
+        except services.CodeReplayedError:
+            return Response({'error': 'TOTP code was already used.'},
+                            status.HTTP_409_CONFLICT)
+        services.record_drift(event_id, drift)
+        return Response({'ticket_is_valid': True, 'user_uuid': user_uuid, 'drift': drift},
+                        status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def ticket_drift(request, event_uuid):
+    """Returns the clock skew distribution of codes accepted for an ``Event``
+    with ``event_uuid``, as a mapping of drift in time steps to code count.
+    """
+    if request.method == 'GET':
+        if not request.user.is_superuser and roles.get_role(request) != roles.ADMIN:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        try:
+            event = Event.objects.get(uuid=event_uuid)
         except:
             return Response({'error': 'Event does not exist.'},
                             status.HTTP_404_NOT_FOUND)
-        
+        return Response({'drift': services.drift_distribution(event.pk)},
+                        status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def ticket_bundle(request):
+    """Returns the offline verification bundle of the ``Event`` that the
+    requesting ``TktAgent`` is assigned to. See ``otphandler.bundles`` for the format.
+    Query parameters: ``steps`` (number of time steps covered by the bundle),
+    ``since`` (sequence number of a previous bundle, for incremental refreshes)
+    and ``start`` (first time counter covered by an incremental refresh,
+    usually the start counter of the previous bundle).
+    """
+    if request.method == 'GET':
+        agent = roles.get_profile(request, roles.AGENT)
+        if agent is None:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        counter = services._get_counter()
+        try:
+            steps = int(request.query_params.get('steps', bundles.BUNDLE_STEPS))
+            since = request.query_params.get('since')
+            since = None if since is None else int(since)
+            start = int(request.query_params.get('start', counter))
+        except ValueError:
+            return Response({'error': 'Malformed query parameters.'},
+                            status.HTTP_400_BAD_REQUEST)
+        if not 0 < steps <= bundles.BUNDLE_MAX_STEPS:
+            return Response({'error': 'Bundles cover 1 to ' + str(bundles.BUNDLE_MAX_STEPS)
+                                      + ' time steps.'},
+                            status.HTTP_400_BAD_REQUEST)
+        if not counter - steps < start <= counter:
+            return Response({'error': 'Bundle start is out of range.'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        bundle = bundles.build_bundle(agent.event, steps, start, since)
+        return HttpResponse(bundle, content_type='application/octet-stream')
+
+@api_view(['POST', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def ticket_session(request):
+    """Starts (POST) or ends (DELETE) the gate session of the requesting ``TktAgent``.
+    Starting a session loads the roster of the agent's ``Event`` into memory,
+    so that ``ticket/session/auth`` can verify tickets without database queries.
+    """
+    agent = roles.get_profile(request, roles.AGENT)
+    if agent is None:
+        return Response(status=status.HTTP_403_FORBIDDEN)
+    event = agent.event
+
+    if request.method == 'POST':
+        event_roster = roster.load_roster(event.pk)
+        return Response({'event_uuid': event.uuid, 'registrations': len(event_roster)},
+                        status.HTTP_200_OK)
+    elif request.method == 'DELETE':
+        roster.drop_roster(event.pk)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def ticket_session_auth(request):
+    """Verifies a ticket-generated TOTP code for the ``Event`` of the requesting
+    ``TktAgent``, using the roster loaded by its gate session.
+    Same semantics as ``ticket_auth``.
+    JSON format: {'user_uuid': <str>, 'ticket_totp': <str>}
+    """
+    if request.method == 'POST':
+        agent = roles.get_profile(request, roles.AGENT)
+        if agent is None:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        event_id = agent.event_id
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Malformed payload.'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        user_uuid = services._parse_uuid(request.data.get('user_uuid'))
+        registration = None
+        if user_uuid is not None:
+            registration = roster.get_roster(event_id).lookup(user_uuid.bytes)
+        # Only unregistered users need to be looked up
+        if registration is None and (user_uuid is None
+                                     or not TktUser.objects.filter(uuid=user_uuid).exists()):
+            return Response({'error': 'User does not exist.'},
+                            status.HTTP_404_NOT_FOUND)
+
         try:
             totp = request.data['ticket_totp']
         except:
             return Response({'error': 'TOTP code was not supplied.'},
                             status.HTTP_400_BAD_REQUEST)
 
-        if not event.user_is_registered(user):
+        if registration is None:
             return Response({'error': 'User is not registered to event.'},
                             status.HTTP_400_BAD_REQUEST)
-        tkt_secret = services.generate_ticket_secret(user, event)
-        totp_authority = services.generate_totp(tkt_secret)
-        if totp == totp_authority:
-            return Response({'ticket_is_valid': True},
+        user_id, tkt_secret = registration
+        try:
+            drift = services.verify_ticket(tkt_secret, totp, event_id, user_id)
+        except services.CodeReplayedError:
+            return Response({'error': 'TOTP code was already used.'},
+                            status.HTTP_409_CONFLICT)
+        if drift is not None:
+            return Response({'ticket_is_valid': True, 'drift': drift},
+                            status.HTTP_200_OK)
+        else:
+            return Response({'ticket_is_valid': False},
+                            status.HTTP_200_OK)
+
+@api_view(['POST'])
+def ticket_token_new(request):
+    """Checks whether a ``TktUser`` with ``user_uuid`` is registered to
+    an ``Event`` with ``event_uuid``.
+    If registered, sends a JSON response with a signed ticket token and the
+    base32-encoded ticket-unique secret. See ``otphandler.tokens`` for the format.
+    JSON format: {'user_uuid': <str>, 'event_uuid': <str>}
+    """
+    if request.method == 'POST':
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Malformed payload.'},
+                            status.HTTP_400_BAD_REQUEST)
+        try:
+            registration = services.resolve_registration(request.data.get('user_uuid'),
+                                                         request.data.get('event_uuid'))
+        except TktUser.DoesNotExist:
+            return Response({'error': 'User does not exist.'},
+                            status.HTTP_404_NOT_FOUND)
+        except Event.DoesNotExist:
+            return Response({'error': 'Event does not exist.'},
+                            status.HTTP_404_NOT_FOUND)
+
+        if registration is None:
+            return Response({'error': 'User not registered to event.'},
+                            status.HTTP_400_BAD_REQUEST)
+        tkt_secret = bytes(registration.secret)
+        event_datetime = Event.objects.values_list('datetime', flat=True).get(
+                             pk=registration.event_id)
+        token = tokens.issue_token(registration.event_id, registration.tktuser_id,
+                                   tkt_secret, tokens.token_expiry(event_datetime))
+        return Response({'ticket_token': token,
+                         'ticket_secret': base64.b32encode(tkt_secret).decode()},
+                        status.HTTP_200_OK)
+
+@api_view(['POST'])
+def ticket_token_auth(request):
+    """Verifies a ticket-generated TOTP code given a ticket token.
+    Tokens are validated without querying the database. Codes are accepted like
+    in ``ticket_auth``.
+    JSON format: {'ticket_token': <str>, 'ticket_totp': <str>}
+    """
+    if request.method == 'POST':
+        if not isinstance(request.data, dict):
+            return Response({'error': 'Malformed payload.'},
+                            status.HTTP_400_BAD_REQUEST)
+        token = request.data.get('ticket_token')
+        if not isinstance(token, str):
+            return Response({'error': 'Ticket token was not supplied.'},
+                            status.HTTP_400_BAD_REQUEST)
+        try:
+            ticket = tokens.read_token(token)
+        except tokens.InvalidTokenError as e:
+            return Response({'error': str(e)},
+                            status.HTTP_400_BAD_REQUEST)
+
+        try:
+            totp = request.data['ticket_totp']
+        except:
+            return Response({'error': 'TOTP code was not supplied.'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        try:
+            drift = services.verify_ticket(ticket.secret, totp, ticket.event_id, ticket.user_id)
+        except services.CodeReplayedError:
+            return Response({'error': 'TOTP code was already used.'},
+                            status.HTTP_409_CONFLICT)
+        if drift is not None:
+            return Response({'ticket_is_valid': True, 'drift': drift},
                             status.HTTP_200_OK)
         else:
             return Response({'ticket_is_valid': False},
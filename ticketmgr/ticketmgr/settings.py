@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 from pathlib import Path
 
@@ -69,9 +70,20 @@ REST_FRAMEWORK = {
     """
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
-    ]
+    ],
+    # Uses orjson if it is installed, with the same output as DRF's JSONRenderer
+    'DEFAULT_RENDERER_CLASSES': [
+        'entityhandler.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PAGINATION_CLASS': 'entityhandler.pagination.KeysetPagination',
+    # Default number of objects per page of list endpoints
+    'PAGE_SIZE': 100,
 }
 
+# Maximum number of objects per page that clients can request with ``page_size``
+MAX_PAGE_SIZE = 1000
+
 CORS_ALLOW_CREDENTIALS = True
 
 CORS_ORIGIN_WHITELIST = [
@@ -114,9 +126,11 @@ WSGI_APPLICATION = 'ticketmgr.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# DB_ENGINE can be set to django.db.backends.sqlite3 (with DB_NAME pointing to
+# the database file) to run the test suite and benchmarks without PostgreSQL.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': os.getenv("DB_ENGINE", 'django.db.backends.postgresql'),
         'NAME': os.getenv("DB_NAME"),
 		'USER': os.getenv("DB_USER"),
 		'PASSWORD': os.getenv("DB_PASSWORD"),
@@ -126,6 +140,27 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/ref/settings/#caches
+
+# The default cache holds state that all worker processes must agree on, like
+# the ledger of accepted TOTP codes and the role versions of users (see the
+# *_CACHE settings below), so it must be shared by all of them in production.
+# CACHE_BACKEND and CACHE_LOCATION select it, e.g.
+# django.core.cache.backends.redis.RedisCache with a redis:// URL (which requires
+# the redis package), or django.core.cache.backends.db.DatabaseCache with a table
+# name (created by `manage.py createcachetable`). Process-local caches are only
+# used in development.
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',
+                        'django.core.cache.backends.dummy.DummyCache')
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv("CACHE_BACKEND", 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv("CACHE_LOCATION", ''),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -145,6 +180,20 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Password hashing
+# https://docs.djangoproject.com/en/4.1/topics/auth/passwords/
+
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+    # Used for imported accounts only, upgraded to the first hasher on login
+    'entityhandler.hashers.ImportPBKDF2PasswordHasher',
+]
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.1/topics/i18n/
 
@@ -168,3 +217,41 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MIGRATE = False
+
+# Number of time steps before and after the current one whose TOTP codes are
+# accepted during ticket verification, to tolerate client clock skew.
+TOTP_VERIFY_WINDOW = 1
+
+# Cache alias that records accepted TOTP codes to reject replays. Must point to
+# a cache shared by all worker processes in production, or codes are accepted
+# once per process. The default cache is, see CACHES.
+TICKET_LEDGER_CACHE = 'default'
+
+# Cache alias that rendered event responses are stored in, see entityhandler.cache.
+# Should point to a cache shared by all worker processes in production, so that
+# changes to events made by one worker invalidate the responses cached by all.
+EVENT_CACHE = 'default'
+
+# Cache alias that the role versions of users are stored in, see entityhandler.roles.
+# Must point to a cache shared by all worker processes in production, or roles
+# revoked by one worker are kept by sessions served by the others.
+ROLE_CACHE = 'default'
+
+if not DEBUG:
+    for alias in (TICKET_LEDGER_CACHE, EVENT_CACHE, ROLE_CACHE):
+        if CACHES[alias]['BACKEND'] in PROCESS_LOCAL_CACHES:
+            raise ImproperlyConfigured(f"The {alias} cache must be shared by all worker "
+                                       "processes when DEBUG is off, see CACHE_BACKEND.")
+
+# Keys that ticket tokens are signed with, by key id (0-255). New tokens are
+# signed with the key of TICKET_SIGNING_KEY_ID, while tokens signed with any of
+# the keys are accepted. To rotate keys, add a new key, switch to it, and remove
+# the old key once the tokens signed with it have expired. Tokens are only signed
+# with SECRET_KEY in development, as it has a public default.
+if os.environ.get("TICKET_SIGNING_KEY"):
+    TICKET_SIGNING_KEYS = {0: os.environ["TICKET_SIGNING_KEY"]}
+elif DEBUG:
+    TICKET_SIGNING_KEYS = {0: SECRET_KEY}
+else:
+    raise ImproperlyConfigured("The TICKET_SIGNING_KEY setting must be set when DEBUG is off.")
+TICKET_SIGNING_KEY_ID = 0